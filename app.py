@@ -6,10 +6,10 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-import os, glob, json, base64, re, io, zipfile
-import xml.etree.ElementTree as ET
+import os, glob, json, base64, zipfile, threading, time, bisect, shutil
 from datetime import datetime, date, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # ==============================================================================
 # CONFIG
@@ -25,6 +25,16 @@ st.set_page_config(
 from sso_auth import require_sso
 sso_user = require_sso()
 
+from cotahist import parse_cotahist, list_cotahist_files
+from synta_xml import parse_synta_xml
+from cvm_cache import (
+    QUOTA_COLUMNS, format_cnpj, read_blc4_month, inf_diario_month, read_inf_diario,
+)
+from classificacao import (
+    TICKER_TIPOS_ACAO, TICKER_FUNDO, TICKER_OUTRO, TICKER_OPCAO,
+    ticker_tipo, classificar_tickers, classificar_setor, classificar_setor_series,
+)
+
 # ==============================================================================
 # PATHS
 # ==============================================================================
@@ -35,8 +45,17 @@ XML_FECHAMENTO = r"G:\Drives compartilhados\Arquivos_XML_Fechamento"
 
 # Cloud mode: use pre-exported parquets when local XMLs not available
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# Local-only caches (price warehouse etc.), not committed
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+# Carteiras dos masters extraidas do cache BLC_4 da CVM (gerado por export_data.py)
+MASTER_HOLDINGS_PATH = os.path.join(DATA_DIR, "master_holdings.parquet")
+# Arquivos COTAHIST da B3 (TXT/ZIP) usados como fonte offline de precos
+COTAHIST_DIR = os.environ.get("COTAHIST_DIR", os.path.join(CACHE_DIR, "cotahist"))
 HAS_LOCAL_XML = os.path.isdir(XML_BASE)
-HAS_PARQUET_DATA = os.path.isdir(DATA_DIR) and any(f.endswith(".parquet") for f in os.listdir(DATA_DIR) if "timeseries" in f)
+# Timeseries exportada por export_data.py: dataset fundo=<nome>/ano=<YYYY> (ou parquet unico antigo)
+TIMESERIES_DIR = os.path.join(DATA_DIR, "timeseries")
+HAS_PARQUET_DATA = os.path.isdir(TIMESERIES_DIR) or (
+    os.path.isdir(DATA_DIR) and any(f.endswith(".parquet") for f in os.listdir(DATA_DIR) if "timeseries" in f))
 
 FUNDOS_CONFIG = {
     "Synta FIA II": {"cnpj": "51564188000131", "xml_prefix": "FD51564188000131"},
@@ -215,151 +234,19 @@ def _chart_layout(fig, title="", height=450, y_title="", y_suffix="", margin_b=5
 # ==============================================================================
 # SETOR MAP
 # ==============================================================================
-SETOR_MAP = {
-    'ITUB4': 'Financeiro', 'ITUB3': 'Financeiro', 'BBDC4': 'Financeiro', 'BBDC3': 'Financeiro',
-    'BBAS3': 'Financeiro', 'SANB11': 'Financeiro', 'B3SA3': 'Financeiro', 'BPAC11': 'Financeiro',
-    'CIEL3': 'Financeiro', 'PSSA3': 'Financeiro', 'BBSE3': 'Financeiro', 'IRBR3': 'Financeiro',
-    'SULA11': 'Financeiro', 'CXSE3': 'Financeiro', 'ABCB4': 'Financeiro',
-    'PETR4': 'Petroleo e Gas', 'PETR3': 'Petroleo e Gas', 'PRIO3': 'Petroleo e Gas',
-    'RECV3': 'Petroleo e Gas', 'UGPA3': 'Petroleo e Gas', 'CSAN3': 'Petroleo e Gas',
-    'VBBR3': 'Petroleo e Gas', 'ENAT3': 'Petroleo e Gas',
-    'VALE3': 'Mineracao e Siderurgia', 'CSNA3': 'Mineracao e Siderurgia',
-    'GGBR4': 'Mineracao e Siderurgia', 'USIM5': 'Mineracao e Siderurgia',
-    'GOAU4': 'Mineracao e Siderurgia', 'CMIN3': 'Mineracao e Siderurgia',
-    'ELET3': 'Energia Eletrica', 'ELET6': 'Energia Eletrica', 'EGIE3': 'Energia Eletrica',
-    'EQTL3': 'Energia Eletrica', 'CMIG4': 'Energia Eletrica', 'CPFE3': 'Energia Eletrica',
-    'TAEE11': 'Energia Eletrica', 'ENGI11': 'Energia Eletrica', 'NEOE3': 'Energia Eletrica',
-    'CPLE6': 'Energia Eletrica', 'ENEV3': 'Energia Eletrica',
-    'SBSP3': 'Saneamento', 'SAPR11': 'Saneamento', 'CSMG3': 'Saneamento',
-    'HAPV3': 'Saude', 'RDOR3': 'Saude', 'RADL3': 'Saude', 'FLRY3': 'Saude',
-    'HYPE3': 'Saude', 'ONCO3': 'Saude',
-    'MGLU3': 'Varejo e Consumo', 'VIVA3': 'Varejo e Consumo', 'ARZZ3': 'Varejo e Consumo',
-    'LREN3': 'Varejo e Consumo', 'PETZ3': 'Varejo e Consumo', 'NTCO3': 'Varejo e Consumo',
-    'AZZA3': 'Varejo e Consumo', 'ASAI3': 'Varejo e Consumo', 'CRFB3': 'Varejo e Consumo',
-    'PCAR3': 'Varejo e Consumo', 'ALPA4': 'Varejo e Consumo',
-    'TOTS3': 'Tecnologia', 'LWSA3': 'Tecnologia', 'CASH3': 'Tecnologia',
-    'ABEV3': 'Alimentos e Bebidas', 'JBSS3': 'Alimentos e Bebidas',
-    'MRFG3': 'Alimentos e Bebidas', 'BEEF3': 'Alimentos e Bebidas',
-    'BRFS3': 'Alimentos e Bebidas', 'SMTO3': 'Alimentos e Bebidas',
-    'SLCE3': 'Alimentos e Bebidas',
-    'CYRE3': 'Construcao e Imob.', 'EZTC3': 'Construcao e Imob.',
-    'MRVE3': 'Construcao e Imob.', 'CURY3': 'Construcao e Imob.',
-    'RENT3': 'Transporte e Logistica', 'CCRO3': 'Transporte e Logistica',
-    'AZUL4': 'Transporte e Logistica', 'RAIL3': 'Transporte e Logistica',
-    'VIVT3': 'Telecomunicacoes', 'TIMS3': 'Telecomunicacoes',
-    'WEGE3': 'Industrial', 'EMBR3': 'Industrial',
-    'SUZB3': 'Papel e Celulose', 'KLBN11': 'Papel e Celulose',
-    'YDUQ3': 'Educacao', 'COGN3': 'Educacao',
-    'MULT3': 'Shoppings', 'IGTI11': 'Shoppings', 'ALSO3': 'Shoppings',
-    'GGPS3': 'Concessoes e Infra.', 'RAIZ4': 'Industrial',
-    'BRAV3': 'Petroleo e Gas', 'RRRP3': 'Petroleo e Gas',
-    'BRAP4': 'Mineracao e Siderurgia',
-    'ALOS3': 'Shoppings', 'IGTI3': 'Shoppings',
-    'AURE3': 'Energia Eletrica', 'CPLE3': 'Energia Eletrica',
-    'ALUP11': 'Energia Eletrica', 'ISAE4': 'Energia Eletrica',
-    'COCE5': 'Energia Eletrica', 'CLSC4': 'Energia Eletrica', 'TRPL4': 'Energia Eletrica',
-    'ITSA4': 'Financeiro', 'BRBI11': 'Financeiro', 'BPAN4': 'Financeiro',
-    'BRSR6': 'Financeiro',
-    'BMOB3': 'Tecnologia', 'DESK3': 'Tecnologia', 'INTB3': 'Tecnologia',
-    'POSI3': 'Tecnologia', 'LWSA3': 'Tecnologia',
-    'MATD3': 'Saude', 'ANIM3': 'Saude', 'DASA3': 'Saude', 'QUAL3': 'Saude',
-    'ODPV3': 'Saude', 'PNVL3': 'Saude',
-    'MLAS3': 'Varejo e Consumo', 'SMFT3': 'Varejo e Consumo',
-    'CAML3': 'Alimentos e Bebidas', 'MDIA3': 'Alimentos e Bebidas',
-    'CVCB3': 'Varejo e Consumo', 'GRND3': 'Varejo e Consumo',
-    'VULC3': 'Varejo e Consumo',
-    'LAVV3': 'Construcao e Imob.', 'TRIS3': 'Construcao e Imob.',
-    'DIRR3': 'Construcao e Imob.', 'EVEN3': 'Construcao e Imob.',
-    'MDNE3': 'Construcao e Imob.', 'JHSF3': 'Construcao e Imob.',
-    'PLPL3': 'Construcao e Imob.', 'TEND3': 'Construcao e Imob.',
-    'RDNI3': 'Construcao e Imob.', 'MELK3': 'Construcao e Imob.',
-    'HBSA3': 'Construcao e Imob.', 'TCSA3': 'Construcao e Imob.',
-    'FRAS3': 'Industrial', 'TUPY3': 'Industrial', 'KEPL3': 'Industrial',
-    'LEVE3': 'Industrial', 'SHUL4': 'Industrial', 'MYPK3': 'Industrial',
-    'POMO4': 'Industrial', 'POMO3': 'Industrial', 'DXCO3': 'Industrial',
-    'TGMA3': 'Transporte e Logistica', 'STBP3': 'Transporte e Logistica',
-    'ECOR3': 'Transporte e Logistica', 'LOGN3': 'Transporte e Logistica',
-    'SIMH3': 'Transporte e Logistica', 'MILS3': 'Transporte e Logistica',
-    'PORT3': 'Transporte e Logistica', 'RAPT4': 'Transporte e Logistica',
-    'RAPT3': 'Transporte e Logistica',
-    'MOTV3': 'Varejo e Consumo', 'ORVR3': 'Varejo e Consumo',
-    'SBFG3': 'Financeiro',
-    'SRNA3': 'Industrial', 'LOGG3': 'Transporte e Logistica',
-    'CSED3': 'Educacao', 'PASS5': 'Varejo e Consumo',
-    'OPCT3': 'Saude', 'VLID3': 'Tecnologia',
-    'BRKM5': 'Petroquimica', 'UNIP6': 'Petroquimica',
-    'OFSA3': 'Saude', 'GMAT3': 'Construcao e Imob.',
-    'SOJA3': 'Alimentos e Bebidas', 'PRNR3': 'Varejo e Consumo',
-    'ZAMP3': 'Alimentos e Bebidas', 'TFCO4': 'Varejo e Consumo',
-    'CSUD3': 'Industrial', 'BRST3': 'Industrial',
-    'PGMN3': 'Construcao e Imob.', 'TTEN3': 'Industrial',
-    'VIVA3': 'Varejo e Consumo', 'HBRE3': 'Construcao e Imob.',
-    'MGEL4': 'Industrial', 'FBMC4': 'Financeiro',
-    'TOKY3': 'Tecnologia', 'MBRF3': 'Alimentos e Bebidas',
-    'NATU3': 'Varejo e Consumo',
-    'ROXO34': 'Financeiro (US)', 'XPBR31': 'Financeiro (US)',
-    'INBR32': 'Financeiro (US)', 'AURA33': 'Mineracao e Siderurgia',
-    'STOC34': 'Financeiro (US)',
-    'BOVA11': 'ETF - Ibovespa', 'DIVO11': 'ETF - Dividendos',
-    'LVOL11': 'ETF - Low Vol', 'SMAL11': 'ETF - Small Cap',
-    # ── Acoes listadas nos EUA (via BDR ou posicao direta) ──
-    'AMZN US': 'Tecnologia (US)', 'AMZN': 'Tecnologia (US)',
-    'META US': 'Tecnologia (US)', 'META': 'Tecnologia (US)',
-    'MELI US': 'E-Commerce (US)', 'MELI': 'E-Commerce (US)',
-    'NU US': 'Financeiro (US)', 'NU': 'Financeiro (US)',
-    'STNE US': 'Financeiro (US)', 'STNE': 'Financeiro (US)',
-    'INTR US': 'Financeiro (US)', 'INTR': 'Financeiro (US)',
-    'XP US': 'Financeiro (US)', 'XP': 'Financeiro (US)',
-    'DLO US': 'Financeiro (US)', 'DLO': 'Financeiro (US)',
-    'VTEX US': 'Tecnologia (US)', 'VTEX': 'Tecnologia (US)',
-    'PAGS US': 'Financeiro (US)', 'PAGS': 'Financeiro (US)',
-    'GGAL US': 'Financeiro (US)', 'GGAL': 'Financeiro (US)',
-    'BBAR US': 'Financeiro (US)', 'BBAR': 'Financeiro (US)',
-    'GLOB US': 'Tecnologia (US)', 'GLOB': 'Tecnologia (US)',
-    'MSFT US': 'Tecnologia (US)', 'GOOGL US': 'Tecnologia (US)',
-    'AAPL US': 'Tecnologia (US)', 'NVDA US': 'Tecnologia (US)',
-    'TSLA US': 'Automotivo (US)',
-}
-
-# Tickers que sao acoes (listadas fora do BR ou com formato nao-padrao) e NAO fundos
-# Usado para evitar que aparecam como "Fundos nao explodidos"
-US_STOCK_SUFFIXES = (" US",)  # Bloomberg-style tickers from CVM
+# Setores e tipos de ticker: ver classificacao.py
+SUBFUNDO_NOMES = frozenset(SUBFUNDO_NAMES.values())  # aparecem no lugar do ticker nas carteiras
 
 
 def _is_stock_ticker(ticker: str) -> bool:
     """Determina se um ticker e uma acao (BR ou US) e nao um fundo/opcao/futuro."""
-    tk = ticker.strip().upper()
-    # Brazilian standard: 4 letters + 1-2 digits (PETR4, KLBN11, BOVA11, etc.)
-    import re
-    if re.match(r'^[A-Z]{4}\d{1,2}$', tk):
-        return True
-    # US stocks: XXXX US or similar Bloomberg-style
-    if any(tk.endswith(sfx) for sfx in US_STOCK_SUFFIXES):
-        return True
-    # Explicit in SETOR_MAP as stock (not ETF-like)
-    if tk in SETOR_MAP:
-        return True
-    return False
+    return ticker_tipo(ticker, SUBFUNDO_NOMES) in TICKER_TIPOS_ACAO
 
 
 def _is_option_ticker(ticker: str) -> bool:
     """Determina se um ticker e uma opcao (ex: IBOVV136, PETRM25, etc.)."""
-    tk = ticker.strip().upper()
-    import re
-    # Opcoes BR: 4 letras + 1 letra (serie) + digitos (strike) — ex: IBOVV136, PETRM25, VALEC30
-    if re.match(r'^[A-Z]{4}[A-Z]\d+$', tk):
-        return True
-    return False
-
+    return ticker_tipo(ticker, SUBFUNDO_NOMES) == TICKER_OPCAO
 
-def classificar_setor(ticker: str) -> str:
-    tk = ticker.strip().upper()
-    if tk in SETOR_MAP:
-        return SETOR_MAP[tk]
-    # Opcoes
-    if _is_option_ticker(tk):
-        return 'Opcoes/Protecao'
-    return 'Outros'
 
 def _classificar_componente(nome: str, tipo: str) -> str:
     """Classificar componente do fundo em categoria broad."""
@@ -384,10 +271,25 @@ def _classificar_componente(nome: str, tipo: str) -> str:
 # ==============================================================================
 # DATA: B3 IBOV / ETF COMPOSITION
 # ==============================================================================
-@st.cache_data(ttl=86400, show_spinner=False)
-def fetch_index_composition(index_code: str) -> dict:
-    """Fetch index/ETF composition {ticker: weight%} from B3 API."""
+B3_MAX_WORKERS = 8  # requisicoes simultaneas a API de indices da B3
+
+@st.cache_resource(show_spinner=False)
+def _b3_session():
+    """Shared HTTP session (keep-alive + connection pool) for the B3 index API."""
     import requests as req
+    from requests.adapters import HTTPAdapter
+    session = req.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    adapter = HTTPAdapter(pool_connections=B3_MAX_WORKERS, pool_maxsize=B3_MAX_WORKERS)
+    session.mount("https://", adapter)
+    return session
+
+COMPOSITION_CACHE_PATH = os.path.join(CACHE_DIR, "composicao_b3.json")
+COMPOSITION_MAX_AGE = 86400  # segundos ate uma composicao ser revalidada em segundo plano
+COMPOSITION_RETRY_AFTER = 300  # segundos sem nova chamada a B3 (sincrona ou em segundo plano) apos falha
+
+def _request_index_composition(index_code: str) -> dict:
+    """Fetch index/ETF composition {ticker: weight%} from B3 API ({} on failure)."""
     try:
         payload = json.dumps({
             "language": "pt-br", "pageNumber": 1, "pageSize": 200,
@@ -395,7 +297,7 @@ def fetch_index_composition(index_code: str) -> dict:
         })
         encoded = base64.b64encode(payload.encode()).decode()
         url = f"https://sistemaswebb3-listados.b3.com.br/indexProxy/indexCall/GetPortfolioDay/{encoded}"
-        r = req.get(url, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
+        r = _b3_session().get(url, timeout=15)
         if r.status_code != 200:
             return {}
         data = r.json()
@@ -413,35 +315,645 @@ def fetch_index_composition(index_code: str) -> dict:
     except Exception:
         return {}
 
+@st.cache_resource(show_spinner=False)
+def _composition_cache() -> dict:
+    """Ultima composicao boa de cada indice, persistida em COMPOSITION_CACHE_PATH.
+
+    entries: {index_code: {"fetched_at": Timestamp | None, "comp": {ticker: peso%}}}.
+    fetched_at None marca snapshot semeado do historico (sempre revalidado).
+    """
+    cache = {"lock": threading.Lock(), "entries": {}, "refreshing": set(), "failed": {}}
+    if os.path.exists(COMPOSITION_CACHE_PATH):
+        try:
+            with open(COMPOSITION_CACHE_PATH, encoding="utf-8") as f:
+                raw = json.load(f)
+            cache["entries"] = {code: {"fetched_at": pd.Timestamp(e["fetched_at"]), "comp": e["comp"]}
+                                for code, e in raw.items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return cache
+
+def _save_composition_cache(entries: dict):
+    raw = {code: {"fetched_at": e["fetched_at"].isoformat(), "comp": e["comp"]}
+           for code, e in entries.items() if e["fetched_at"] is not None}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = COMPOSITION_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(raw, f)
+        os.replace(tmp_path, COMPOSITION_CACHE_PATH)
+    except OSError:
+        pass
+
+def _refresh_composition(cache: dict, index_code: str) -> dict:
+    """Busca a composicao na B3 e, se vier algo, atualiza o cache em disco e o historico."""
+    comp = _request_index_composition(index_code)
+    with cache["lock"]:
+        cache["refreshing"].discard(index_code)
+        if comp:
+            cache["entries"][index_code] = {"fetched_at": pd.Timestamp.now(), "comp": comp}
+            cache["failed"].pop(index_code, None)
+            _save_composition_cache(cache["entries"])
+        else:
+            cache["failed"][index_code] = time.time()
+    if comp:
+        record_composition_snapshot(index_code, comp)
+    return comp
+
+def fetch_index_composition(index_code: str) -> dict:
+    """Index/ETF composition {ticker: weight%}, served from the last good snapshot.
+
+    Stale-while-revalidate: a cached snapshot is returned immediately and, when older
+    than COMPOSITION_MAX_AGE, refreshed from B3 in a background thread. Only an index
+    never seen before (no disk cache, no history) waits on the live B3 call. After a
+    failed B3 call, the index is not requested again for COMPOSITION_RETRY_AFTER.
+    """
+    cache = _composition_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(index_code)
+        if entry is None:
+            seed = composition_as_of(index_code, date.today())
+            if seed:
+                entry = cache["entries"][index_code] = {"fetched_at": None, "comp": seed}
+        backoff = time.time() - cache["failed"].get(index_code, 0) < COMPOSITION_RETRY_AFTER
+        if entry is not None:
+            age = None if entry["fetched_at"] is None else (pd.Timestamp.now() - entry["fetched_at"]).total_seconds()
+            if ((age is None or age > COMPOSITION_MAX_AGE) and not backoff
+                    and index_code not in cache["refreshing"]):
+                cache["refreshing"].add(index_code)
+                threading.Thread(target=_refresh_composition, args=(cache, index_code), daemon=True).start()
+            return dict(entry["comp"])
+        if backoff:
+            return {}
+    return dict(_refresh_composition(cache, index_code))
+
 def fetch_ibov_composition() -> dict:
     return fetch_index_composition("IBOV")
 
-@st.cache_data(ttl=86400, show_spinner=False)
+# ==============================================================================
+# DATA: POINT-IN-TIME COMPOSITION HISTORY
+# ==============================================================================
+COMPOSITION_HISTORY_PATH = os.path.join(CACHE_DIR, "composicao_indices.parquet")
+# Rebalanceamento: mudou o conjunto de tickers ou o giro (metade da soma das variacoes
+# absolutas de peso, em p.p.) contra o ultimo snapshot passou deste limite
+COMPOSITION_REBALANCE_TURNOVER = 5.0
+
+@st.cache_resource(show_spinner=False)
+def _composition_history() -> dict:
+    """Snapshots datados de composicao por indice, carregados uma vez por processo.
+
+    Em disco: parquet longo (indice, data, ticker, peso) ordenado por (indice, data), so
+    com os rebalanceamentos. Em memoria: {indice: {"datas": datetime64 ordenado,
+    "snapshots": [dict]}}, de modo que a consulta as-of e um searchsorted, mais
+    "latest" {indice: (data, composicao)} com os pesos do dia (nao e rebalanceamento).
+    Cada entrada e substituida inteira na gravacao, entao a leitura dispensa o lock.
+    """
+    hist = {"lock": threading.Lock(), "indices": {}, "latest": {}}
+    if not os.path.exists(COMPOSITION_HISTORY_PATH):
+        return hist
+    try:
+        df = pd.read_parquet(COMPOSITION_HISTORY_PATH)
+    except Exception:
+        return hist
+    df["data"] = pd.to_datetime(df["data"])
+    for index_code, df_idx in df.groupby("indice", sort=False):
+        datas, snapshots = [], []
+        for dt, grp in df_idx.groupby("data", sort=True):
+            datas.append(dt)
+            snapshots.append(dict(zip(grp["ticker"], grp["peso"].astype(float))))
+        hist["indices"][index_code] = {
+            "datas": pd.DatetimeIndex(datas).values, "snapshots": snapshots,
+        }
+    return hist
+
+def _save_composition_history(hist: dict):
+    rows = []
+    for index_code, entry in hist["indices"].items():
+        for dt, comp in zip(entry["datas"], entry["snapshots"]):
+            rows.extend((index_code, dt, tk, w) for tk, w in comp.items())
+    df = pd.DataFrame(rows, columns=["indice", "data", "ticker", "peso"])
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = COMPOSITION_HISTORY_PATH + ".tmp"
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, COMPOSITION_HISTORY_PATH)
+    except OSError:
+        pass
+
+def _is_rebalance(old: dict, new: dict) -> bool:
+    if set(old) != set(new):
+        return True
+    turnover = sum(abs(new[tk] - old[tk]) for tk in new) / 2
+    return turnover > COMPOSITION_REBALANCE_TURNOVER
+
+def record_composition_snapshot(index_code: str, comp: dict, as_of=None):
+    """Registra a composicao do dia: vira o "latest" do indice e, se for um
+    rebalanceamento contra o snapshot vigente, entra no historico em disco."""
+    if not comp:
+        return
+    as_of = pd.Timestamp(as_of or date.today()).normalize().to_datetime64()
+    comp = dict(comp)
+    hist = _composition_history()
+    with hist["lock"]:
+        latest = hist["latest"].get(index_code)
+        if latest is None or latest[0] <= as_of:
+            hist["latest"][index_code] = (as_of, comp)
+        entry = hist["indices"].get(index_code, {"datas": np.array([], dtype="datetime64[ns]"), "snapshots": []})
+        pos = int(entry["datas"].searchsorted(as_of, side="right"))
+        if pos > 0 and not _is_rebalance(entry["snapshots"][pos - 1], comp):
+            return
+        # Novos objetos (nao altera as listas em uso por leitores sem lock)
+        if pos > 0 and entry["datas"][pos - 1] == as_of:
+            datas = entry["datas"]
+            snapshots = entry["snapshots"][:pos - 1] + [comp] + entry["snapshots"][pos:]
+        else:
+            datas = np.insert(entry["datas"], pos, as_of)
+            snapshots = entry["snapshots"][:pos] + [comp] + entry["snapshots"][pos:]
+        hist["indices"][index_code] = {"datas": datas, "snapshots": snapshots}
+        _save_composition_history(hist)
+
+def composition_as_of(index_code: str, ref_date) -> dict:
+    """Composicao vigente em ref_date; antes do primeiro snapshot, usa o mais antigo.
+
+    A partir da data do "latest", vale a composicao do dia.
+    """
+    hist = _composition_history()
+    ref = pd.Timestamp(ref_date).to_datetime64()
+    latest = hist["latest"].get(index_code)
+    if latest is not None and ref >= latest[0]:
+        return dict(latest[1])
+    entry = hist["indices"].get(index_code)
+    if not entry or not entry["snapshots"]:
+        return dict(latest[1]) if latest is not None else {}
+    pos = int(entry["datas"].searchsorted(ref, side="right")) - 1
+    return dict(entry["snapshots"][max(pos, 0)])
+
+def composition_rebalances(index_code: str, start, end) -> list:
+    """Rebalanceamentos com data em (start, end], como [(data, composicao)] em ordem."""
+    entry = _composition_history()["indices"].get(index_code)
+    if not entry or not entry["snapshots"]:
+        return []
+    datas = entry["datas"]
+    lo = int(datas.searchsorted(pd.Timestamp(start).to_datetime64(), side="right"))
+    hi = int(datas.searchsorted(pd.Timestamp(end).to_datetime64(), side="right"))
+    return [(pd.Timestamp(datas[i]), dict(entry["snapshots"][i])) for i in range(lo, hi)]
+
+def composition_tickers(index_code: str, start, end) -> set:
+    """Todos os tickers que fizeram parte do indice em [start, end]."""
+    tickers = set(composition_as_of(index_code, start))
+    for _, comp in composition_rebalances(index_code, start, end):
+        tickers.update(comp)
+    return tickers
+
+def _etf_index_code(ticker: str) -> str:
+    """B3 index behind an ETF ticker, or "" when it cannot be decomposed via the B3 API."""
+    idx = ETF_INDEX_MAP.get(ticker.upper(), "")
+    if idx in ("S&P500", "CRYPTO", "IFIX"):
+        return ""
+    return idx
+
 def fetch_etf_composition(ticker: str) -> dict:
     """Fetch ETF underlying composition via B3 index API."""
-    idx = ETF_INDEX_MAP.get(ticker.upper(), "")
-    if not idx or idx in ("S&P500", "CRYPTO", "IFIX"):
+    idx = _etf_index_code(ticker)
+    if not idx:
         return {}
     return fetch_index_composition(idx)
 
+def prefetch_etf_compositions(tickers) -> dict:
+    """Fetch the compositions of all ETFs in tickers at once: {ticker: {ticker: weight%}}.
+
+    Each distinct underlying index is requested once, in parallel, over the shared
+    B3 session; results land in fetch_index_composition's cache as usual.
+    """
+    by_index = defaultdict(list)
+    for tk in set(tickers):
+        idx = _etf_index_code(tk)
+        if idx:
+            by_index[idx].append(tk)
+    if not by_index:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(B3_MAX_WORKERS, len(by_index))) as pool:
+        comps = dict(zip(by_index, pool.map(fetch_index_composition, by_index)))
+    return {tk: comps[idx] for idx, tks in by_index.items() for tk in tks}
+
 # ==============================================================================
-# DATA: YFINANCE PRICES
+# DATA: YFINANCE PRICES (local warehouse + incremental top-up)
 # ==============================================================================
-@st.cache_data(ttl=3600, show_spinner="Buscando precos historicos...")
-def fetch_prices(tickers_sa: tuple, start: str, end: str) -> pd.DataFrame:
-    try:
-        import yfinance as yf
-    except ImportError:
-        return pd.DataFrame()
-    all_tickers = list(tickers_sa) + ["^BVSP"]
-    df = yf.download(all_tickers, start=start, end=end, auto_adjust=True, progress=False)
+# Armazem ajustado particionado por ano: precos/ano=<YYYY>/lote-<ns>.parquet. Cada gravacao
+# acrescenta um lote por ano tocado (em caso de repeticao, vale o lote mais novo); acima
+# de PRICE_STORE_MAX_PARTS lotes, o ano e compactado num unico arquivo
+PRICE_STORE_DIR = os.path.join(CACHE_DIR, "precos")
+PRICE_STORE_MAX_PARTS = 16
+# Arquivo unico da versao anterior, migrado para PRICE_STORE_DIR na primeira carga
+LEGACY_PRICE_STORE_PATH = os.path.join(CACHE_DIR, "precos.parquet")
+PRICE_COVERAGE_PATH = os.path.join(CACHE_DIR, "precos_cobertura.json")
+PRICE_OVERLAP_DAYS = 10  # dias ja conhecidos rebaixados junto com cada lacuna (detecta reajuste de proventos)
+# Fechamentos COTAHIST (sem ajuste por proventos) ficam num armazem proprio, nunca
+# misturados aos fechamentos ajustados do Yahoo (ver _read_price_store)
+COTAHIST_STORE_PATH = os.path.join(CACHE_DIR, "precos_cotahist.parquet")
+COTAHIST_MANIFEST_PATH = os.path.join(CACHE_DIR, "precos_cotahist.json")
+# O COTAHIST nao traz indices: o ^BVSP offline vem do export (export_data.export_ibov_series)
+IBOV_EXPORT_PATH = os.path.join(DATA_DIR, "ibov.parquet")
+IBOV_MISSING_MSG = ("Serie do IBOV (^BVSP) indisponivel: o Yahoo Finance nao respondeu e o COTAHIST "
+                    "local nao traz indices. Rode export_data.py com acesso a internet para gravar "
+                    "data/ibov.parquet.")
+# Manifesto da versao que gravava o COTAHIST no armazem ajustado
+LEGACY_COTAHIST_MANIFEST_PATH = os.path.join(CACHE_DIR, "cotahist_ingeridos.json")
+
+@st.cache_resource(show_spinner=False)
+def _price_store() -> dict:
+    """Cobertura do armazem local de precos: {ticker: [(inicio, fim), ...]} em dias corridos.
+
+    Os fechamentos ficam em PRICE_STORE_DIR, formato longo (ticker, data, close) em
+    lotes por ano; a cobertura lembra quais trechos ja foram baixados, inclusive
+    feriados e fins de semana, para nao pedi-los de novo ao Yahoo.
+    """
+    store = {"lock": threading.Lock(), "coverage": {}, "cotahist": {}}
+    if os.path.exists(LEGACY_COTAHIST_MANIFEST_PATH):
+        # Armazem antigo tem fechamentos brutos do COTAHIST no lugar dos ajustados: descarta
+        shutil.rmtree(PRICE_STORE_DIR, ignore_errors=True)
+        for path in (LEGACY_PRICE_STORE_PATH, PRICE_COVERAGE_PATH, LEGACY_COTAHIST_MANIFEST_PATH):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    if os.path.exists(LEGACY_PRICE_STORE_PATH):
+        try:
+            _append_price_parts(pd.read_parquet(LEGACY_PRICE_STORE_PATH))
+            os.remove(LEGACY_PRICE_STORE_PATH)
+        except Exception:
+            pass
+    if os.path.exists(PRICE_COVERAGE_PATH):
+        try:
+            with open(PRICE_COVERAGE_PATH, encoding="utf-8") as f:
+                raw = json.load(f)
+            store["coverage"] = {tk: [(pd.Timestamp(a), pd.Timestamp(b)) for a, b in rngs]
+                                 for tk, rngs in raw.items()}
+        except (OSError, ValueError):
+            pass
+    if os.path.exists(COTAHIST_MANIFEST_PATH):
+        try:
+            with open(COTAHIST_MANIFEST_PATH, encoding="utf-8") as f:
+                store["cotahist"] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return store
+
+def _missing_ranges(covered: list, start: pd.Timestamp, end: pd.Timestamp) -> list:
+    """Trechos de [start, end] (inclusive) fora dos intervalos cobertos (ordenados, disjuntos)."""
+    one_day = pd.Timedelta(days=1)
+    gaps, cursor = [], start
+    for c_start, c_end in covered:
+        if c_end < cursor:
+            continue
+        if c_start > end:
+            break
+        if c_start > cursor:
+            gaps.append((cursor, c_start - one_day))
+        cursor = c_end + one_day
+        if cursor > end:
+            return gaps
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+def _merge_ranges(covered: list, start: pd.Timestamp, end: pd.Timestamp) -> list:
+    one_day = pd.Timedelta(days=1)
+    merged = []
+    for c_start, c_end in sorted(covered + [(start, end)]):
+        if merged and c_start <= merged[-1][1] + one_day:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], c_end))
+        else:
+            merged.append((c_start, c_end))
+    return merged
+
+def _download_prices(tickers: list, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    """Fechamentos ajustados do Yahoo em [start, end], formato longo (ticker, data, close)."""
+    import yfinance as yf
+    df = yf.download(tickers, start=start.strftime("%Y-%m-%d"),
+                     end=(end + pd.Timedelta(days=1)).strftime("%Y-%m-%d"),
+                     auto_adjust=True, progress=False)
     if df.empty:
-        return df
+        return pd.DataFrame(columns=["ticker", "data", "close"])
     if isinstance(df.columns, pd.MultiIndex):
         df = df["Close"]
+    else:
+        df = df[["Close"]].rename(columns={"Close": tickers[0]})
     df.index = pd.to_datetime(df.index).tz_localize(None)
+    df.index.name = "data"
+    long = df.reset_index().melt(id_vars="data", var_name="ticker", value_name="close").dropna()
+    return long[["ticker", "data", "close"]]
+
+def _read_price_store(tickers: list, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    """Fechamentos de [start, end]; cada ticker vem inteiro de uma unica fonte.
+
+    Vale o armazem ajustado (Yahoo); o COTAHIST so serve tickers sem nenhum
+    fechamento ajustado na janela, de modo que precos brutos e ajustados nunca
+    se misturam na mesma serie. Sem ^BVSP do Yahoo, usa o exportado em IBOV_EXPORT_PATH.
+    """
+    frames = []
+    parts = _price_parts(start.year, end.year)
+    if tickers and parts:
+        df = _read_price_parts([("ticker", "in", list(tickers)), ("data", ">=", start), ("data", "<=", end)],
+                               parts)
+        frames.append(df)
+        tickers = sorted(set(tickers) - set(df["ticker"].unique()))
+    if tickers and os.path.exists(COTAHIST_STORE_PATH):
+        frames.append(pd.read_parquet(COTAHIST_STORE_PATH, filters=[
+            ("ticker", "in", list(tickers)), ("data", ">=", start), ("data", "<=", end)]))
+    if "^BVSP" in tickers and os.path.exists(IBOV_EXPORT_PATH):
+        frames.append(pd.read_parquet(IBOV_EXPORT_PATH, filters=[("data", ">=", start), ("data", "<=", end)]))
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=["ticker", "data", "close"])
+    return pd.concat(frames, ignore_index=True)
+
+def _price_parts(first_year=None, last_year=None) -> list:
+    """Lotes do armazem ajustado (dos anos pedidos), em ordem de gravacao dentro de cada ano."""
+    parts = []
+    for year_dir in sorted(glob.glob(os.path.join(PRICE_STORE_DIR, "ano=*"))):
+        year = int(os.path.basename(year_dir)[len("ano="):])
+        if (first_year is None or year >= first_year) and (last_year is None or year <= last_year):
+            parts.extend(sorted(glob.glob(os.path.join(year_dir, "lote-*.parquet"))))
+    return parts
+
+def _read_price_parts(filters, parts=None) -> pd.DataFrame:
+    parts = _price_parts() if parts is None else parts
+    if not parts:
+        return pd.DataFrame(columns=["ticker", "data", "close"])
+    df = pd.read_parquet(parts, columns=["ticker", "data", "close"], filters=filters)
+    return df.drop_duplicates(subset=["ticker", "data"], keep="last")
+
+def _append_price_parts(df: pd.DataFrame):
+    """Grava df como um novo lote em cada ano que ele toca e compacta anos com lotes demais."""
+    os.makedirs(PRICE_STORE_DIR, exist_ok=True)
+    years = df["data"].dt.year
+    for year, df_year in df.groupby(years):
+        year_dir = os.path.join(PRICE_STORE_DIR, f"ano={int(year)}")
+        os.makedirs(year_dir, exist_ok=True)
+        out_path = os.path.join(year_dir, f"lote-{time.time_ns()}.parquet")
+        df_year.sort_values(["ticker", "data"]).to_parquet(out_path + ".tmp", index=False)
+        os.replace(out_path + ".tmp", out_path)
+        parts = sorted(glob.glob(os.path.join(year_dir, "lote-*.parquet")))
+        if len(parts) > PRICE_STORE_MAX_PARTS:
+            # Compactacao: o lote unico e gravado antes de remover os antigos (e o mais novo)
+            df_all = (_read_price_parts(None, parts)
+                      .sort_values(["ticker", "data"]).reset_index(drop=True))
+            out_path = os.path.join(year_dir, f"lote-{time.time_ns()}.parquet")
+            df_all.to_parquet(out_path + ".tmp", index=False)
+            os.replace(out_path + ".tmp", out_path)
+            for path in parts:
+                os.remove(path)
+
+def _write_price_store(df_new: pd.DataFrame):
+    """Acrescenta df_new ao armazem; historico antigo e reescalado se o Yahoo reajustou a serie.
+
+    So as linhas ja gravadas na janela de df_new sao lidas para detectar o reajuste; o
+    historico reescalado de um ticker entra no mesmo lote (substitui o anterior).
+    """
+    df_new = df_new.drop_duplicates(subset=["ticker", "data"], keep="last")
+    tickers = sorted(df_new["ticker"].unique())
+    df_old = _read_price_parts([("ticker", "in", tickers), ("data", ">=", df_new["data"].min()),
+                                ("data", "<=", df_new["data"].max())])
+    # Reajuste de proventos: razao novo/antigo no ultimo dia em comum, aplicada ao que e anterior
+    overlap = df_old.merge(df_new, on=["ticker", "data"], suffixes=("_old", ""))
+    if not overlap.empty:
+        last = overlap.sort_values("data").groupby("ticker").tail(1)
+        ratio = (last["close"] / last["close_old"]).where(last["close_old"] > 0, 1.0)
+        ratio = pd.Series(ratio.values, index=last["ticker"].values)
+        ratio = ratio[(ratio - 1).abs() > 1e-6]
+        if not ratio.empty:
+            first_new = df_new.groupby("ticker")["data"].min()
+            df_hist = _read_price_parts([("ticker", "in", sorted(ratio.index)),
+                                         ("data", "<", first_new[ratio.index].max())])
+            df_hist = df_hist[df_hist["data"] < df_hist["ticker"].map(first_new)].copy()
+            df_hist["close"] *= df_hist["ticker"].map(ratio)
+            df_new = pd.concat([df_hist, df_new], ignore_index=True)
+    _append_price_parts(df_new)
+
+def _save_price_coverage(coverage: dict):
+    raw = {tk: [(a.strftime("%Y-%m-%d"), b.strftime("%Y-%m-%d")) for a, b in rngs]
+           for tk, rngs in coverage.items()}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(PRICE_COVERAGE_PATH, "w", encoding="utf-8") as f:
+        json.dump(raw, f)
+
+def _ingest_cotahist(store: dict):
+    """Carrega em COTAHIST_STORE_PATH os arquivos COTAHIST novos ou alterados de COTAHIST_DIR.
+
+    Os fechamentos do COTAHIST nao sao ajustados por proventos, entao nao entram
+    no armazem do Yahoo nem na sua cobertura. Deve ser chamado com store["lock"]
+    adquirido.
+    """
+    seen = store["cotahist"]
+    frames = []
+    for path in list_cotahist_files(COTAHIST_DIR):
+        name = os.path.basename(path)
+        st_file = os.stat(path)
+        sig = [st_file.st_size, int(st_file.st_mtime)]
+        if seen.get(name) == sig:
+            continue
+        try:
+            df_file = parse_cotahist(path)
+        except (OSError, ValueError, zipfile.BadZipFile, StopIteration):
+            continue
+        frames.append(df_file)
+        seen[name] = sig
+    if not frames:
+        return
+    frames = [f for f in frames if not f.empty]
+    if frames:
+        if os.path.exists(COTAHIST_STORE_PATH):
+            frames.insert(0, pd.read_parquet(COTAHIST_STORE_PATH))
+        df_raw = (pd.concat(frames, ignore_index=True)
+                  .drop_duplicates(subset=["ticker", "data"], keep="last")
+                  .sort_values(["ticker", "data"]).reset_index(drop=True))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = COTAHIST_STORE_PATH + ".tmp"
+        df_raw.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, COTAHIST_STORE_PATH)
+    with open(COTAHIST_MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(seen, f)
+
+def _top_up_price_store(tickers: list, start: pd.Timestamp, end: pd.Timestamp):
+    """Completa o armazem com os trechos de [start, end] que ele ainda nao cobre.
+
+    Os arquivos COTAHIST locais sao carregados no armazem proprio (fonte offline,
+    usada so para tickers sem fechamento ajustado); as lacunas do armazem ajustado
+    sao baixadas do Yahoo. Tickers com as mesmas lacunas sao baixados juntos. O pregao de hoje e gravado, mas nao entra
+    na cobertura (fechamento ainda pode mudar).
+    """
+    store = _price_store()
+    with store["lock"]:
+        try:
+            _ingest_cotahist(store)
+        except OSError:
+            pass
+    try:
+        import yfinance  # noqa: F401
+    except ImportError:
+        return
+    last_closed = pd.Timestamp(date.today()) - pd.Timedelta(days=1)
+    with store["lock"]:
+        coverage = store["coverage"]
+        by_gap = defaultdict(list)
+        for tk in tickers:
+            for gap in _missing_ranges(coverage.get(tk, []), start, end):
+                by_gap[gap].append(tk)
+        if not by_gap:
+            return
+        frames = []
+        for (gap_start, gap_end), gap_tickers in sorted(by_gap.items()):
+            has_history = any(coverage.get(tk) and coverage[tk][0][0] < gap_start for tk in gap_tickers)
+            dl_start = gap_start - pd.Timedelta(days=PRICE_OVERLAP_DAYS) if has_history else gap_start
+            try:
+                df_gap = _download_prices(gap_tickers, dl_start, gap_end)
+            except Exception:
+                continue
+            # Download vazio so conta como coberto se a lacuna nao tem dia util (falha de rede)
+            if df_gap.empty and np.busday_count(gap_start.date(), (gap_end + pd.Timedelta(days=1)).date()) > 0:
+                continue
+            frames.append(df_gap)
+            covered_end = min(gap_end, last_closed)
+            # Tickers que falharam dentro do lote voltam so com NaN (descartados): ficam
+            # fora da cobertura para serem tentados de novo na proxima chamada
+            got = gap_tickers if df_gap.empty else set(df_gap["ticker"].unique())
+            if covered_end >= gap_start:
+                for tk in (tk for tk in gap_tickers if tk in got):
+                    coverage[tk] = _merge_ranges(coverage.get(tk, []), gap_start, covered_end)
+        frames = [f for f in frames if not f.empty]
+        try:
+            if frames:
+                _write_price_store(pd.concat(frames, ignore_index=True))
+            _save_price_coverage(coverage)
+        except OSError:
+            pass
+
+PRICE_PANEL_TTL = 3600  # segundos ate o painel em memoria ser recarregado do armazem
+
+@st.cache_resource(show_spinner=False)
+def _price_panel() -> dict:
+    """Painel largo em memoria (datas x tickers) compartilhado por todas as paginas.
+
+    Pedidos contidos no painel sao respondidos por fatiamento; pedidos fora dele
+    alargam o painel (uniao de tickers e de datas) em vez de criar um novo.
+    """
+    return {"lock": threading.Lock(), "df": None, "tickers": frozenset(),
+            "start": None, "end": None, "loaded_at": 0.0}
+
+def _load_price_panel(tickers: list, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    _top_up_price_store(tickers, start, end)
+    df_long = _read_price_store(tickers, start, end)
+    if df_long.empty:
+        return pd.DataFrame(columns=sorted(tickers), index=pd.DatetimeIndex([], name="Date"))
+    df = df_long.pivot_table(index="data", columns="ticker", values="close", aggfunc="last")
+    df = df.reindex(columns=sorted(tickers)).sort_index()
+    df.index = pd.DatetimeIndex(df.index, name="Date")
+    df.columns.name = None
     return df
 
+def fetch_prices(tickers_sa: tuple, start: str, end: str) -> pd.DataFrame:
+    """Fechamentos ajustados de tickers_sa + ^BVSP em [start, end), servidos do armazem local.
+
+    So os dias ainda nao cobertos de cada ticker sao baixados (_top_up_price_store);
+    pedidos dentro do painel ja carregado sao apenas fatiados (_price_panel).
+    """
+    all_tickers = sorted(set(tickers_sa) | {"^BVSP"})
+    start_ts = pd.Timestamp(start)
+    end_ts = pd.Timestamp(end) - pd.Timedelta(days=1)
+    panel = _price_panel()
+    with panel["lock"]:
+        fresh = time.time() - panel["loaded_at"] < PRICE_PANEL_TTL
+        contained = (panel["df"] is not None and panel["tickers"].issuperset(all_tickers)
+                     and panel["start"] <= start_ts and end_ts <= panel["end"])
+        if not (fresh and contained):
+            if panel["df"] is not None:
+                # Alarga o painel existente: uniao de tickers e de datas
+                all_union = sorted(panel["tickers"].union(all_tickers))
+                start_union, end_union = min(panel["start"], start_ts), max(panel["end"], end_ts)
+            else:
+                all_union, start_union, end_union = all_tickers, start_ts, end_ts
+            with st.spinner("Buscando precos historicos..."):
+                panel["df"] = _load_price_panel(all_union, start_union, end_union)
+            panel.update(tickers=frozenset(all_union), start=start_union, end=end_union,
+                         loaded_at=time.time())
+        df = panel["df"]
+    df = df.loc[(df.index >= start_ts) & (df.index <= end_ts), all_tickers].dropna(how="all")
+    if df.empty:
+        return pd.DataFrame()
+    return df.copy()
+
+def ibov_available(df_prices: pd.DataFrame) -> bool:
+    """Avisa na pagina (e retorna False) quando o painel nao tem fechamentos do ^BVSP."""
+    if "^BVSP" in df_prices.columns and df_prices["^BVSP"].notna().any():
+        return True
+    st.warning(IBOV_MISSING_MSG)
+    return False
+
+def ibov_history_range(dt_inicio: date, dt_fim: date) -> tuple:
+    """Janela de precos compartilhada pelas paginas que usam o IBOV.
+
+    Cobre pelo menos o ultimo ano ate hoje, de modo que trocar de preset ou de datas
+    dentro dela reaproveita o mesmo download e o mesmo indice de atribuicao.
+    """
+    today = date.today()
+    start = min(dt_inicio, today - timedelta(days=365)) - timedelta(days=10)
+    end = max(dt_fim, today) + timedelta(days=1)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+def build_attribution_index(df_prices: pd.DataFrame) -> dict:
+    """Indice de somas prefixadas para a atribuicao IBOV com drift de pesos.
+
+    Com drift, a contribuicao da acao i em (t0, t1] e
+      w_i(t0) * I(t0) / G_i(t0) * sum_{t0 < t <= t1} (G_i(t) - G_i(t-1)) / I(t-1)
+    com G_i e I os niveis acumulados da acao e do ^BVSP. Guardando S_i(t), a soma
+    acumulada desse termo, qualquer janela sai de S_i(t1) - S_i(t0) em O(tickers).
+    """
+    if "^BVSP" not in df_prices.columns:
+        return {}
+    ibov_prices = df_prices["^BVSP"].dropna()
+    if len(ibov_prices) < 2:
+        return {}
+    cols = [c for c in df_prices.columns if isinstance(c, str) and c.endswith(".SA")]
+    dates = ibov_prices.index
+    px = df_prices[cols].reindex(dates).to_numpy(dtype=float)
+    ibov_px = ibov_prices.to_numpy(dtype=float)
+
+    # Retornos diarios; pregao sem preco = retorno zero
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rets = px[1:] / px[:-1] - 1.0
+    rets = np.nan_to_num(rets, nan=0.0, posinf=0.0, neginf=0.0)
+    growth = 1.0 + rets
+    ibov_growth = ibov_px[1:] / ibov_px[:-1]
+    no_drift = ibov_growth == 0
+    growth[no_drift] = 1.0
+    ibov_growth[no_drift] = 1.0
+    level = np.vstack([np.ones(len(cols)), np.cumprod(growth, axis=0)])
+    ibov_level = np.concatenate([[1.0], np.cumprod(ibov_growth)])
+    steps = np.vstack([np.zeros(len(cols)), np.diff(level, axis=0) / ibov_level[:-1, None]])
+
+    # Ultimo / proximo pregao com preco valido, para o retorno simples de cada janela
+    valid = ~np.isnan(px)
+    rows = np.arange(len(dates))[:, None]
+    last_valid = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    next_valid = np.minimum.accumulate(np.where(valid, rows, len(dates))[::-1], axis=0)[::-1]
+    return {
+        "dates": dates, "tickers": [c[:-3] for c in cols], "px": px,
+        "level": level, "ibov_level": ibov_level,
+        "steps": steps, "cum": np.cumsum(steps, axis=0),
+        "last_valid": last_valid, "next_valid": next_valid,
+    }
+
+def ibov_tickers_sa(composition: dict, start: str, end: str) -> tuple:
+    """Tickers .SA da composicao atual + todos os que passaram pelo IBOV na janela."""
+    tickers = set(composition) | composition_tickers("IBOV", start, end)
+    return tuple(sorted(f"{tk}.SA" for tk in tickers))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_attribution_index(tickers_sa: tuple, start: str, end: str) -> dict:
+    """build_attribution_index sobre fetch_prices, montado uma vez por janela de precos."""
+    return build_attribution_index(fetch_prices(tickers_sa, start, end))
+
 # ==============================================================================
 # MASTER CNPJ MAPPING (Feeder -> Master fund that holds the stocks in CVM)
 # ==============================================================================
@@ -469,136 +981,89 @@ MASTER_CNPJ_MAP = {
 # ==============================================================================
 # DATA: SUB-FUND POSITIONS (from carteira_rv parquets + CVM BLC_4 fallback)
 # ==============================================================================
-@st.cache_data(ttl=3600, show_spinner="Carregando posicoes dos sub-fundos...")
-def load_subfund_positions() -> pd.DataFrame:
-    """Load sub-fund stock positions from multiple sources, keeping most recent per fund.
+SUBFUND_POSITION_COLUMNS = ["cnpj_fundo", "data", "ativo", "valor", "pl", "pct_pl", "setor", "fonte"]
 
-    Priority order (all are checked, most recent date wins per fund):
-      1. posicoes_consolidado.parquet (pre-merged XML+CVM data — may use master CNPJs)
-      2. posicoes_xml.parquet (BNY Mellon XMLs — uses master CNPJs)
-      3. posicoes_cvm.parquet (CVM downloads — uses master CNPJs)
-      4. CVM BLC_4 cache parquets (oldest fallback)
 
-    All sources apply master→feeder CNPJ remapping via MASTER_CNPJ_MAP.
-    """
-    frames = []
+def _master_feeder_table() -> pd.DataFrame:
+    """MASTER_CNPJ_MAP como tabela (cnpj_master, cnpj_feeder, ordem) para o remap via merge.
 
-    # Build master→feeder mapping (used by all sources)
+    Primeiro os pares master -> feeder agrupados por master, depois os auto-mapeados
+    (feeder == master, ex. SPX Apache); "ordem" reproduz a ordem de saida do remap.
+    """
     master_to_feeders = {}  # master_cnpj -> [feeder_cnpj, ...]
     for feeder, master in MASTER_CNPJ_MAP.items():
         if master and master != feeder:
             master_to_feeders.setdefault(master, []).append(feeder)
+    pairs = [(master, feeder) for master, feeders in master_to_feeders.items() for feeder in feeders]
+    pairs += [(feeder, feeder) for feeder, master in MASTER_CNPJ_MAP.items() if master == feeder]
+    table = pd.DataFrame(pairs, columns=["cnpj_master", "cnpj_feeder"])
+    table["ordem"] = np.arange(len(table))
+    return table
 
-    def _remap_master_to_feeder(df_src):
-        """Create copies of master-CNPJ rows with feeder CNPJs."""
-        remapped = []
-        for master_cnpj, feeders in master_to_feeders.items():
-            master_data = df_src[df_src["cnpj_fundo"] == master_cnpj]
-            if master_data.empty:
-                continue
-            for feeder_cnpj in feeders:
-                df_copy = master_data.copy()
-                df_copy["cnpj_fundo"] = feeder_cnpj
-                remapped.append(df_copy)
-        # Self-mapped entries (feeder == master, e.g. SPX Apache)
-        for feeder, master in MASTER_CNPJ_MAP.items():
-            if master == feeder:
-                direct = df_src[df_src["cnpj_fundo"] == feeder]
-                if not direct.empty:
-                    remapped.append(direct)
-        return remapped
 
-    # --- Source 1: posicoes_consolidado.parquet ---
-    parquet_path = os.path.join(CARTEIRA_RV_DATA, "posicoes_consolidado.parquet")
-    if not os.path.exists(parquet_path):
-        parquet_path = os.path.join(DATA_DIR, "posicoes_consolidado.parquet")
-    if os.path.exists(parquet_path):
-        df = pd.read_parquet(parquet_path)
-        df["data"] = pd.to_datetime(df["data"])
-        if "setor" in df.columns:
-            df["setor"] = df["ativo"].apply(classificar_setor)
-        frames.append(df)
-        # Remap master→feeder in consolidado (it may contain master CNPJs)
-        remapped = _remap_master_to_feeder(df)
-        if remapped:
-            frames.append(pd.concat(remapped, ignore_index=True))
+def _remap_master_to_feeder(df_src: pd.DataFrame, table: pd.DataFrame) -> pd.DataFrame:
+    """Copies of the master-CNPJ rows under each feeder CNPJ (plus self-mapped funds).
 
-    # --- Source 2 & 3: posicoes_xml.parquet and posicoes_cvm.parquet ---
-    for extra_file in ["posicoes_xml.parquet", "posicoes_cvm.parquet"]:
-        extra_path = os.path.join(CARTEIRA_RV_DATA, extra_file)
-        if not os.path.exists(extra_path):
-            extra_path = os.path.join(DATA_DIR, extra_file)  # Cloud fallback
-        if not os.path.exists(extra_path):
-            continue
-        try:
-            df_extra = pd.read_parquet(extra_path)
-            df_extra["data"] = pd.to_datetime(df_extra["data"])
-            if "setor" in df_extra.columns:
-                df_extra["setor"] = df_extra["ativo"].apply(classificar_setor)
-            # Remap master CNPJs to feeder CNPJs
-            remapped = _remap_master_to_feeder(df_extra)
-            if remapped:
-                frames.append(pd.concat(remapped, ignore_index=True))
-        except Exception:
-            pass
+    One merge of the matching CNPJs (pre-filtered with isin) against the mapping table
+    gives the source row of each output row; rows come out grouped by mapping entry and, within it, in
+    source order. Only the matching rows are copied, once.
+    """
+    cnpjs = df_src["cnpj_fundo"]
+    pos = np.flatnonzero(cnpjs.isin(table["cnpj_master"]).to_numpy())
+    keys = pd.DataFrame({"cnpj_master": cnpjs.iloc[pos].to_numpy(), "pos": pos})
+    hits = table.merge(keys, on="cnpj_master").sort_values(["ordem", "pos"], kind="stable")
+    out = df_src.iloc[hits["pos"].to_numpy()].reset_index(drop=True)
+    out["cnpj_fundo"] = hits["cnpj_feeder"].to_numpy()
+    return out
+
+
+def _fund_slices(df: pd.DataFrame) -> dict:
+    """{cnpj_fundo: (inicio, fim)} das linhas de cada fundo num DataFrame ordenado por cnpj_fundo."""
+    codes = df["cnpj_fundo"].to_numpy()
+    if len(codes) == 0:
+        return {}
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops = np.r_[starts[1:], len(codes)]
+    return {codes[i]: (int(i), int(j)) for i, j in zip(starts, stops)}
 
-    # --- Source 4: CVM BLC_4 cache (oldest fallback) ---
-    existing_cnpjs = set()
-    if frames:
-        existing_cnpjs = set(pd.concat(frames, ignore_index=True)["cnpj_fundo"].unique())
 
-    cvm_rows = _load_cvm_blc4_positions(existing_cnpjs)
-    if cvm_rows:
-        df_cvm = pd.DataFrame(cvm_rows)
-        frames.append(df_cvm)
+def _snapshot_index(df: pd.DataFrame, slices: dict) -> dict:
+    """{cnpj_fundo: (datas, offsets)} de um DataFrame ordenado por (cnpj_fundo, data).
 
-    if not frames:
-        return pd.DataFrame(columns=["cnpj_fundo", "data", "ativo", "valor", "pl", "pct_pl", "setor", "fonte"])
-
-    # Merge all sources — for each fund, keep only the MOST RECENT date across all sources
-    result = pd.concat(frames, ignore_index=True)
-    # Find latest date per fund
-    latest_per_fund = result.groupby("cnpj_fundo")["data"].max().reset_index()
-    latest_per_fund.columns = ["cnpj_fundo", "latest_data"]
-    result = result.merge(latest_per_fund, on="cnpj_fundo")
-    result = result[result["data"] == result["latest_data"]].drop(columns=["latest_data"])
-    result = result.drop_duplicates(subset=["cnpj_fundo", "data", "ativo"], keep="last")
-    return result
-
-
-@st.cache_data(ttl=3600, show_spinner="Carregando historico de composicoes...")
-def load_subfund_positions_all() -> pd.DataFrame:
-    """Load ALL historical sub-fund stock positions (all dates, not just latest).
-
-    Same sources as load_subfund_positions() but keeps all historical dates.
-    Used for historical sector evolution charts where we need the closest
-    composition snapshot for each day.
+    datas sao as datas de snapshot do fundo (ordenadas) e as linhas do snapshot i
+    sao df.iloc[offsets[i]:offsets[i + 1]].
     """
-    frames = []
+    codes = df["cnpj_fundo"].to_numpy()
+    datas = df["data"].to_numpy()
+    if len(codes) == 0:
+        return {}
+    breaks = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (datas[1:] != datas[:-1])])
+    index = {}
+    for cnpj, (lo, hi) in slices.items():
+        i0, i1 = np.searchsorted(breaks, [lo, hi])
+        index[cnpj] = (datas[breaks[i0:i1]], np.r_[breaks[i0:i1], hi])
+    return index
 
-    # Build master→feeder mapping (used by all sources)
-    master_to_feeders = {}
-    for feeder, master in MASTER_CNPJ_MAP.items():
-        if master and master != feeder:
-            master_to_feeders.setdefault(master, []).append(feeder)
 
-    def _remap(df_src):
-        """Create copies of master-CNPJ rows with feeder CNPJs."""
-        remapped = []
-        for master_cnpj, feeders in master_to_feeders.items():
-            master_data = df_src[df_src["cnpj_fundo"] == master_cnpj]
-            if master_data.empty:
-                continue
-            for feeder_cnpj in feeders:
-                df_copy = master_data.copy()
-                df_copy["cnpj_fundo"] = feeder_cnpj
-                remapped.append(df_copy)
-        for feeder, master in MASTER_CNPJ_MAP.items():
-            if master == feeder:
-                direct = df_src[df_src["cnpj_fundo"] == feeder]
-                if not direct.empty:
-                    remapped.append(direct)
-        return remapped
+@st.cache_resource(ttl=3600, show_spinner="Carregando posicoes dos sub-fundos...")
+def load_subfund_store() -> dict:
+    """Load sub-fund stock positions (all dates) from every source into one shared store.
+
+    Sources, later ones winning on the same (cnpj, date, ativo):
+      1. posicoes_consolidado.parquet (pre-merged XML+CVM data — may use master CNPJs)
+      2. posicoes_xml.parquet (BNY Mellon XMLs — uses master CNPJs)
+      3. posicoes_cvm.parquet (CVM downloads — uses master CNPJs)
+      4. CVM BLC_4 cache parquets (fallback for funds missing from 1-3)
+
+    All sources apply master→feeder CNPJ remapping via MASTER_CNPJ_MAP.
+
+    Returns {"all": positions sorted by (cnpj_fundo, data), "latest": only the most
+    recent date of each fund, "index"/"latest_index": {cnpj_fundo: (start, stop)}
+    row ranges, "snapshots": per-fund snapshot dates and row offsets into "all"
+    (see _snapshot_index)}. The store is shared between sessions: never modify the frames.
+    """
+    frames = []
+    mapping = _master_feeder_table()
 
     # --- Source 1: posicoes_consolidado.parquet ---
     parquet_path = os.path.join(CARTEIRA_RV_DATA, "posicoes_consolidado.parquet")
@@ -607,13 +1072,11 @@ def load_subfund_positions_all() -> pd.DataFrame:
     if os.path.exists(parquet_path):
         df = pd.read_parquet(parquet_path)
         df["data"] = pd.to_datetime(df["data"])
-        if "setor" in df.columns:
-            df["setor"] = df["ativo"].apply(classificar_setor)
         frames.append(df)
-        # Remap master→feeder in consolidado too
-        remapped = _remap(df)
-        if remapped:
-            frames.append(pd.concat(remapped, ignore_index=True))
+        # Remap master→feeder in consolidado (it may contain master CNPJs)
+        remapped = _remap_master_to_feeder(df, mapping)
+        if not remapped.empty:
+            frames.append(remapped)
 
     # --- Source 2 & 3: posicoes_xml.parquet and posicoes_cvm.parquet ---
     for extra_file in ["posicoes_xml.parquet", "posicoes_cvm.parquet"]:
@@ -625,222 +1088,222 @@ def load_subfund_positions_all() -> pd.DataFrame:
         try:
             df_extra = pd.read_parquet(extra_path)
             df_extra["data"] = pd.to_datetime(df_extra["data"])
-            if "setor" in df_extra.columns:
-                df_extra["setor"] = df_extra["ativo"].apply(classificar_setor)
-            remapped = _remap(df_extra)
-            if remapped:
-                frames.append(pd.concat(remapped, ignore_index=True))
+            # Remap master CNPJs to feeder CNPJs
+            remapped = _remap_master_to_feeder(df_extra, mapping)
+            if not remapped.empty:
+                frames.append(remapped)
         except Exception:
             pass
 
-    if not frames:
-        return pd.DataFrame(columns=["cnpj_fundo", "data", "ativo", "valor", "pl", "pct_pl", "setor", "fonte"])
+    # --- Source 4: CVM BLC_4 cache (fallback for funds without parquet data) ---
+    existing_cnpjs = set()
+    for df_src in frames:
+        existing_cnpjs.update(df_src["cnpj_fundo"].unique())
+    df_blc4 = _load_cvm_blc4_positions(existing_cnpjs)
+    if not df_blc4.empty:
+        frames.append(df_blc4)
 
-    result = pd.concat(frames, ignore_index=True)
-    # Deduplicate: for same (cnpj, date, ativo), keep last source
-    result = result.drop_duplicates(subset=["cnpj_fundo", "data", "ativo"], keep="last")
-    return result
+    if frames:
+        result = pd.concat(frames, ignore_index=True)
+        # Deduplicate: for same (cnpj, date, ativo), keep last source
+        result = result.drop_duplicates(subset=["cnpj_fundo", "data", "ativo"], keep="last")
+        # Setor reclassificado uma vez, por ticker distinto, para todas as fontes
+        result["setor"] = classificar_setor_series(result["ativo"])
+        result = result.sort_values(["cnpj_fundo", "data"], kind="stable").reset_index(drop=True)
+    else:
+        result = pd.DataFrame(columns=SUBFUND_POSITION_COLUMNS)
 
+    # Visao "mais recente": so a ultima data de cada fundo (continua ordenada por fundo)
+    latest_data = result.groupby("cnpj_fundo")["data"].transform("max")
+    latest = result[result["data"] == latest_data].reset_index(drop=True)
+    index = _fund_slices(result)
+    return {"all": result, "latest": latest, "index": index, "latest_index": _fund_slices(latest),
+            "snapshots": _snapshot_index(result, index)}
 
-def _get_subfund_snapshot(subfund_positions_all: pd.DataFrame, cnpj: str,
-                          ref_date: pd.Timestamp) -> pd.DataFrame:
-    """Get the closest composition snapshot for a fund at or before ref_date.
 
-    Returns the DataFrame of positions for that fund on the closest available date.
-    """
-    df_fund = subfund_positions_all[subfund_positions_all["cnpj_fundo"] == cnpj]
-    if df_fund.empty:
-        return pd.DataFrame()
-    # Find closest date <= ref_date
-    available_dates = df_fund["data"].unique()
-    valid_dates = available_dates[available_dates <= ref_date]
-    if len(valid_dates) == 0:
-        # No date before ref_date — use earliest available
-        valid_dates = available_dates
-    closest_date = valid_dates.max()
-    return df_fund[df_fund["data"] == closest_date]
-
-
-def _load_cvm_blc4_positions(existing_cnpjs: set) -> list:
-    """Load stock positions from CVM BLC_4 cache for funds not in existing data.
-    Uses MASTER_CNPJ_MAP to map feeder CNPJs to their master fund CNPJs."""
-    cache_dir = CARTEIRA_RV_CACHE
-    if not os.path.isdir(cache_dir):
-        return []
+def subfund_positions(store: dict, cnpj: str, latest: bool = False) -> pd.DataFrame:
+    """Positions of one sub-fund from the store (all dates, or only its latest snapshot)."""
+    df = store["latest"] if latest else store["all"]
+    span = store["latest_index" if latest else "index"].get(cnpj)
+    if span is None:
+        return df.iloc[0:0]
+    return df.iloc[span[0]:span[1]]
 
-    # Determine which master CNPJs we need to look up
-    needed = {}  # master_cnpj -> [feeder_cnpj1, feeder_cnpj2, ...]
-    for feeder_cnpj, master_cnpj in MASTER_CNPJ_MAP.items():
-        if master_cnpj is None:
-            continue
-        if feeder_cnpj in existing_cnpjs:
-            continue  # already have data from parquet
-        if master_cnpj not in needed:
-            needed[master_cnpj] = []
-        needed[master_cnpj].append(feeder_cnpj)
-
-    if not needed:
-        return []
-
-    # Find BLC_4 cache files, try from most recent backward
-    blc4_files = sorted(glob.glob(os.path.join(cache_dir, "cvm_blc4_*.parquet")), reverse=True)
-    if not blc4_files:
-        return []
 
-    # Format master CNPJs as xx.xxx.xxx/xxxx-xx for matching CVM format
-    def format_cnpj(c):
-        c = c.zfill(14)
-        return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:14]}"
+def _get_subfund_snapshot(store: dict, cnpj: str, ref_date: pd.Timestamp) -> pd.DataFrame:
+    """Get the closest composition snapshot for a fund at or before ref_date.
 
-    master_formatted = {format_cnpj(m): m for m in needed.keys()}
-    rows = []
-    found_masters = set()
+    Returns the DataFrame of positions for that fund on the closest available date
+    (searchsorted over the fund's snapshot dates, then one slice of store["all"]).
+    """
+    snapshots = store["snapshots"].get(cnpj)
+    if snapshots is None:
+        return pd.DataFrame()
+    datas, offsets = snapshots
+    i = int(np.searchsorted(datas, np.datetime64(ref_date), side="right")) - 1
+    if i < 0:
+        # No date before ref_date — use the most recent snapshot
+        i = len(datas) - 1
+    return store["all"].iloc[offsets[i]:offsets[i + 1]]
 
-    # Also load PL data for percentage calculation
-    pl_data = {}
 
-    for blc4_file in blc4_files:
-        if len(found_masters) == len(needed):
+def _read_blc4_cache_latest(masters) -> pd.DataFrame:
+    """Ultimo mes com acoes de cada master, direto do cache BLC_4 local (sem MASTER_HOLDINGS_PATH)."""
+    if not os.path.isdir(CARTEIRA_RV_CACHE):
+        return pd.DataFrame()
+    pending = {format_cnpj(m): m for m in masters}
+    frames = []
+    for blc4_file in sorted(glob.glob(os.path.join(CARTEIRA_RV_CACHE, "cvm_blc4_*.parquet")), reverse=True):
+        if not pending:
             break  # All masters found
-
         try:
-            df_blc = pd.read_parquet(blc4_file)
+            df_month = read_blc4_month(blc4_file, pending)
         except Exception:
             continue
-
-        # Determine CNPJ column name (changed between CVM format versions)
-        cnpj_col = "CNPJ_FUNDO_CLASSE" if "CNPJ_FUNDO_CLASSE" in df_blc.columns else "CNPJ_FUNDO"
-
-        # Filter for stock-like assets
-        if "TP_APLIC" not in df_blc.columns or "CD_ATIVO" not in df_blc.columns:
+        if df_month is None or df_month.empty:
             continue
+        frames.append(df_month)
+        found = set(df_month["cnpj_fundo"])
+        pending = {fmt: raw for fmt, raw in pending.items() if raw not in found}
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
 
-        # Match: Acoes, Ações, Acoes (various accents)
-        mask_stocks = df_blc["TP_APLIC"].str.contains(r"(?:A.{1,3}es|Brazilian Depository)", case=False, na=False)
-        mask_value = df_blc["VL_MERC_POS_FINAL"].fillna(0) > 0
-        df_stocks = df_blc[mask_stocks & mask_value].copy()
 
-        if df_stocks.empty:
-            continue
+def _load_cvm_blc4_positions(existing_cnpjs: set) -> pd.DataFrame:
+    """Load stock positions from CVM BLC_4 data for funds not in existing data.
 
-        # Extract month from filename for date
-        fname = os.path.basename(blc4_file)
-        month_str = fname.replace("cvm_blc4_", "").replace(".parquet", "")
-        try:
-            ref_date = pd.Timestamp(f"{month_str[:4]}-{month_str[4:6]}-28")
-        except Exception:
+    Uses MASTER_CNPJ_MAP to map feeder CNPJs to their master fund CNPJs, then takes
+    the latest month of each needed master from the master-holdings dataset built
+    by export_data.py (MASTER_HOLDINGS_PATH; CNPJ filter pushed into the reader).
+    Without the dataset, the monthly BLC_4 files of the local CVM cache are read
+    newest first until every master is found.
+    """
+    # Determine which master CNPJs we need to look up
+    needed = {}  # master_cnpj -> [feeder_cnpj1, feeder_cnpj2, ...]
+    for feeder_cnpj, master_cnpj in MASTER_CNPJ_MAP.items():
+        if master_cnpj is None:
             continue
+        if feeder_cnpj in existing_cnpjs:
+            continue  # already have data from parquet
+        needed.setdefault(master_cnpj, []).append(feeder_cnpj)
 
-        # Try to load PL for this month
-        pl_file = os.path.join(cache_dir, f"cvm_pl_{month_str}.parquet")
-        if os.path.exists(pl_file) and month_str not in pl_data:
-            try:
-                df_pl = pd.read_parquet(pl_file)
-                pl_cnpj_col = "CNPJ_FUNDO_CLASSE" if "CNPJ_FUNDO_CLASSE" in df_pl.columns else "CNPJ_FUNDO"
-                for _, row in df_pl.iterrows():
-                    cnpj_val = str(row.get(pl_cnpj_col, ""))
-                    vl_pl = row.get("VL_PATRIM_LIQ", 0)
-                    if cnpj_val and vl_pl and vl_pl > 0:
-                        pl_data[(cnpj_val, month_str)] = vl_pl
-            except Exception:
-                pass
-
-        for fmt_cnpj, raw_master in master_formatted.items():
-            if raw_master in found_masters:
-                continue
-
-            df_fund = df_stocks[df_stocks[cnpj_col] == fmt_cnpj]
-            if df_fund.empty:
-                continue
-
-            found_masters.add(raw_master)
-            feeder_cnpjs = needed[raw_master]
-
-            # Get PL for this master
-            fund_pl = pl_data.get((fmt_cnpj, month_str), 0)
-            if fund_pl <= 0:
-                # Estimate PL from sum of positions (rough)
-                fund_pl = df_fund["VL_MERC_POS_FINAL"].sum() * 1.05  # +5% for non-stock assets
+    if not needed:
+        return pd.DataFrame()
 
-            for _, row in df_fund.iterrows():
-                ticker = str(row.get("CD_ATIVO", "")).strip()
-                valor = float(row.get("VL_MERC_POS_FINAL", 0))
-                if not ticker or valor <= 0:
-                    continue
-                pct = (valor / fund_pl * 100) if fund_pl > 0 else 0
-
-                # Add row for EACH feeder that maps to this master
-                for feeder_cnpj in feeder_cnpjs:
-                    rows.append({
-                        "cnpj_fundo": feeder_cnpj,
-                        "data": ref_date,
-                        "ativo": ticker,
-                        "valor": valor,
-                        "pl": fund_pl,
-                        "pct_pl": pct,
-                        "setor": classificar_setor(ticker),
-                        "fonte": "CVM",
-                    })
-
-    return rows
+    if os.path.exists(MASTER_HOLDINGS_PATH):
+        df = pd.read_parquet(MASTER_HOLDINGS_PATH, filters=[("cnpj_fundo", "in", sorted(needed))])
+        df = df[df["data"] == df.groupby("cnpj_fundo")["data"].transform("max")]
+    else:
+        df = _read_blc4_cache_latest(needed)
+        if df.empty:
+            return pd.DataFrame()
+    table = pd.DataFrame([(m, f) for m, feeders in needed.items() for f in feeders],
+                         columns=["cnpj_master", "cnpj_feeder"])
+    table["ordem"] = np.arange(len(table))
+    # Add rows for EACH feeder that maps to the master
+    df = _remap_master_to_feeder(df, table)
+    df["fonte"] = "CVM"
+    return df
 
 # ==============================================================================
 # COMPUTATION: DAILY CUMULATIVE ATTRIBUTION (IBOV) — with weight drift
 # ==============================================================================
-def compute_ibov_daily_attribution(composition: dict, df_prices: pd.DataFrame):
-    tickers = sorted(composition.keys())
-    col_map = {}
-    for tk in tickers:
-        sa = f"{tk}.SA"
-        if sa in df_prices.columns:
-            col_map[tk] = sa
-    if not col_map or "^BVSP" not in df_prices.columns:
+def _attribution_window(attr_index: dict, composition: dict, i0: int, i1: int):
+    """Contribuicoes com drift em (i0, i1] para uma composicao fixa na posicao i0.
+
+    Retorna (tickers, contribuicao total, matriz diaria com a linha zero de i0).
+    Contribuicao = w_i(t0) * I(t0) / G_i(t0) * (S_i(t1) - S_i(t0)).
+    """
+    col_pos = {tk: j for j, tk in enumerate(attr_index["tickers"])}
+    tickers = [tk for tk in sorted(composition.keys()) if tk in col_pos]
+    if not tickers:
+        return [], np.zeros(0), np.zeros((i1 - i0 + 1, 0))
+    cols = np.array([col_pos[tk] for tk in tickers])
+    weights_0 = np.array([composition[tk] for tk in tickers], dtype=float)
+    weights_0 = weights_0 / weights_0.sum()
+    scale = weights_0 * attr_index["ibov_level"][i0] / attr_index["level"][i0, cols]
+    cum = attr_index["cum"]
+    contrib = scale * (cum[i1, cols] - cum[i0, cols])
+    daily = np.vstack([np.zeros(len(tickers)), scale * attr_index["steps"][i0 + 1:i1 + 1][:, cols]])
+    return tickers, contrib, daily
+
+def _window_returns(attr_index: dict, tickers: list, i0: int, i1: int) -> np.ndarray:
+    """Retorno (%) do primeiro ao ultimo preco valido de cada acao dentro de [i0, i1]."""
+    col_pos = {tk: j for j, tk in enumerate(attr_index["tickers"])}
+    cols = np.array([col_pos[tk] for tk in tickers], dtype=int)
+    first = attr_index["next_valid"][i0, cols]
+    last = attr_index["last_valid"][i1, cols]
+    px = attr_index["px"]
+    first_px = px[np.minimum(first, len(px) - 1), cols]
+    last_px = px[np.maximum(last, 0), cols]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(first < last, (last_px / first_px - 1) * 100, 0.0)
+
+def compute_ibov_daily_attribution(composition: dict, df_prices: pd.DataFrame, attr_index: dict = None,
+                                   rebalances: list = None):
+    """Atribuicao diaria do IBOV com drift de pesos, consultada no indice de somas prefixadas.
+
+    O primeiro pregao de df_prices e a data base (sem contribuicao) e o ultimo fecha a
+    janela. Se attr_index (ver build_attribution_index) cobrir a janela, a consulta
+    custa O(tickers); sem ele, o indice e montado a partir do proprio df_prices.
+
+    composition e a carteira na data base. rebalances, se informado, e uma lista de
+    (data, composicao) que entram em vigor dentro da janela: cada snapshot vale a partir
+    do ultimo pregao anterior a sua data, e os segmentos sao somados em sequencia.
+    Nesse caso weight_pct e a media dos pesos ponderada pelos pregoes de cada segmento.
+    """
+    if attr_index is None:
+        attr_index = build_attribution_index(df_prices)
+    if not attr_index or "^BVSP" not in df_prices.columns:
         return pd.DataFrame(), pd.DataFrame()
-    ibov_prices = df_prices["^BVSP"].dropna()
-    if len(ibov_prices) < 2:
+    ibov_window = df_prices["^BVSP"].dropna()
+    if len(ibov_window) < 2:
         return pd.DataFrame(), pd.DataFrame()
-    ibov_ret = ibov_prices.pct_change(fill_method=None)
-    common_dates = ibov_ret.dropna().index
-    ticker_returns = {}
-    for tk in col_map:
-        prices_tk = df_prices[col_map[tk]].reindex(common_dates)
-        ticker_returns[tk] = prices_tk.pct_change(fill_method=None)
-    total_weight = sum(composition[tk] for tk in col_map)
-    current_weights = {tk: composition[tk] / total_weight for tk in col_map}
-    daily_contribs = {tk: pd.Series(0.0, index=common_dates) for tk in col_map}
-    for i in range(1, len(common_dates)):
-        ibov_r = ibov_ret.iloc[i]
-        if pd.isna(ibov_r):
-            ibov_r = 0.0
-        for tk in col_map:
-            r = ticker_returns[tk].iloc[i]
-            if pd.isna(r):
-                r = 0.0
-            daily_contribs[tk].iloc[i] = current_weights.get(tk, 0) * r
-        if ibov_r != -1:
-            for tk in col_map:
-                r = ticker_returns[tk].iloc[i]
-                if pd.isna(r):
-                    r = 0.0
-                current_weights[tk] = current_weights.get(tk, 0) * (1 + r) / (1 + ibov_r)
-    df_daily = pd.DataFrame(daily_contribs, index=common_dates)
-    cumulative_contrib = df_daily.iloc[1:].sum()
-    rows = []
-    for tk in col_map:
-        prices_tk = df_prices[col_map[tk]].reindex(common_dates).dropna()
-        ret_pct = (prices_tk.iloc[-1] / prices_tk.iloc[0] - 1) * 100 if len(prices_tk) >= 2 else 0.0
-        rows.append({
-            "ticker": tk, "setor": classificar_setor(tk),
-            "weight_pct": composition[tk], "return_pct": ret_pct,
-            "contribution_pct": cumulative_contrib.get(tk, 0) * 100,
-        })
-    df_attr = pd.DataFrame(rows).sort_values("contribution_pct", ascending=False)
+    dates = attr_index["dates"]
+    i0 = dates.searchsorted(ibov_window.index[0])
+    i1 = dates.searchsorted(ibov_window.index[-1], side="right") - 1
+    if i0 >= len(dates) or i1 <= i0:
+        return pd.DataFrame(), pd.DataFrame()
+
+    # Segmentos entre rebalanceamentos: {posicao inicial: composicao}, o ultimo vence
+    starts = {i0: composition}
+    for eff_date, comp in sorted(rebalances or [], key=lambda x: pd.Timestamp(x[0])):
+        pos = max(int(dates.searchsorted(pd.Timestamp(eff_date))) - 1, i0)
+        if pos < i1 and comp:
+            starts[pos] = comp
+    bounds = sorted(starts)
+
+    contrib_total, weight_days = defaultdict(float), defaultdict(float)
+    daily_frames = []
+    for k, s in enumerate(bounds):
+        e = bounds[k + 1] if k + 1 < len(bounds) else i1
+        tickers, contrib, daily = _attribution_window(attr_index, starts[s], s, e)
+        for tk, c in zip(tickers, contrib):
+            contrib_total[tk] += c
+            weight_days[tk] += starts[s][tk] * (e - s)
+        daily_frames.append(pd.DataFrame(daily[1:], index=dates[s + 1:e + 1], columns=tickers))
+    tickers = sorted(contrib_total)
+    if not tickers:
+        return pd.DataFrame(), pd.DataFrame()
+    zero_row = pd.DataFrame(0.0, index=dates[i0:i0 + 1], columns=tickers)
+    df_daily = pd.concat([zero_row] + daily_frames).reindex(columns=tickers).fillna(0.0)
+
+    if len(bounds) == 1:
+        weight_pct = [composition[tk] for tk in tickers]
+    else:
+        weight_pct = [weight_days[tk] / (i1 - i0) for tk in tickers]
+    df_attr = pd.DataFrame({
+        "ticker": tickers, "setor": classificar_setor_series(pd.Series(tickers)),
+        "weight_pct": weight_pct, "return_pct": _window_returns(attr_index, tickers, i0, i1),
+        "contribution_pct": np.array([contrib_total[tk] for tk in tickers]) * 100,
+    }).sort_values("contribution_pct", ascending=False)
     return df_attr, df_daily
 
 def aggregate_by_sector(df_attr: pd.DataFrame) -> pd.DataFrame:
     if df_attr.empty:
         return pd.DataFrame()
-    grouped = df_attr.groupby("setor").agg(
+    grouped = df_attr.groupby("setor", observed=True).agg(
         weight_pct=("weight_pct", "sum"), contribution_pct=("contribution_pct", "sum"),
         n_stocks=("ticker", "count"),
     ).reset_index()
@@ -851,106 +1314,89 @@ def aggregate_by_sector(df_attr: pd.DataFrame) -> pd.DataFrame:
 # ==============================================================================
 # DATA: PARSE SYNTA XML
 # ==============================================================================
-def _find_synta_xml(date_str: str, xml_prefix: str):
-    folder = os.path.join(XML_BASE, date_str)
-    if not os.path.isdir(folder):
-        return None
-    files = glob.glob(os.path.join(folder, f"{xml_prefix}_*"))
-    return files[0] if files else None
-
-def parse_synta_xml(filepath: str) -> dict:
-    tree = ET.parse(filepath)
-    root = tree.getroot()
-    fundo = root.find("fundo")
-    if fundo is None:
-        return {}
-    header = fundo.find("header")
-    result = {
-        "cnpj": header.findtext("cnpj", ""),
-        "nome": header.findtext("nome", ""),
-        "dtposicao": header.findtext("dtposicao", ""),
-        "patliq": float(header.findtext("patliq", "0") or 0),
-        "valorcota": float(header.findtext("valorcota", "0") or 0),
-        "quantidade_cotas": float(header.findtext("quantidade", "0") or 0),
-        "posicoes": [],
-    }
-    pl = result["patliq"]
-    if pl <= 0:
-        return result
-    # RF — agrupar todos titulos publicos; calcular PU medio ponderado para retorno
-    rf_valor = 0.0
-    rf_qtd = 0.0
-    for tp in fundo.findall("titpublico"):
-        vf = float(tp.findtext("valorfindisp", "0") or 0)
-        qtd = float(tp.findtext("qtdisponivel", "0") or 0)
-        rf_valor += vf
-        rf_qtd += qtd
-    if rf_valor > 0:
-        rf_pu = rf_valor / rf_qtd if rf_qtd > 0 else 0
-        result["posicoes"].append({"componente": "Renda Fixa (LFT)", "tipo": "RF", "valor": rf_valor,
-                                    "peso_pct": rf_valor / pl * 100, "pu": rf_pu, "qtd": rf_qtd, "vlajuste": 0})
-    # Acoes — agregar por codigo, guardar PU e QTD total
-    acoes_map = {}
-    for ac in fundo.findall("acoes"):
-        cod = ac.findtext("codativo", "")
-        classe = ac.findtext("classeoperacao", "C")
-        vf_disp = float(ac.findtext("valorfindisp", "0") or 0)
-        qtd_gar = float(ac.findtext("qtgarantia", "0") or 0)
-        pu = float(ac.findtext("puposicao", "0") or 0)
-        qtd_disp = float(ac.findtext("qtdisponivel", "0") or 0)
-        if cod not in acoes_map:
-            acoes_map[cod] = {"valor": 0.0, "qtd": 0.0, "pu": pu}
-        if classe == "C":
-            acoes_map[cod]["valor"] += vf_disp
-            acoes_map[cod]["qtd"] += qtd_disp
-        else:
-            acoes_map[cod]["valor"] += qtd_gar * pu
-            acoes_map[cod]["qtd"] += qtd_gar
-    for cod, info in acoes_map.items():
-        if info["valor"] > 0:
-            result["posicoes"].append({"componente": cod, "tipo": "Acao/ETF", "valor": info["valor"],
-                                        "peso_pct": info["valor"] / pl * 100, "pu": info["pu"], "qtd": info["qtd"], "vlajuste": 0})
-    # Futuros — usar vlajuste (ajuste diario = P&L real), nao vltotalpos
-    for fut in fundo.findall("futuros"):
-        ativo = fut.findtext("ativo", "")
-        serie = fut.findtext("serie", "")
-        vl = float(fut.findtext("vltotalpos", "0") or 0)
-        vlaj = float(fut.findtext("vlajuste", "0") or 0)
-        result["posicoes"].append({"componente": f"FUT {ativo} {serie}", "tipo": "Futuro", "valor": vl,
-                                    "peso_pct": vl / pl * 100, "pu": 0, "qtd": 0, "vlajuste": vlaj})
-    # Opcoes
-    for op in fundo.findall("opcoes"):
-        cod = op.findtext("codativo", "")
-        vf = float(op.findtext("valorfinanceiro", "0") or 0)
-        pu = float(op.findtext("puposicao", "0") or 0)
-        qtd = float(op.findtext("qtdisponivel", "0") or 0)
-        if vf != 0:
-            result["posicoes"].append({"componente": f"OPC {cod}", "tipo": "Opcao", "valor": vf,
-                                        "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
-    for od in fundo.findall("opcoesderiv"):
-        serie = od.findtext("serie", "")
-        vf = float(od.findtext("valorfinanceiro", "0") or 0)
-        pu = float(od.findtext("puposicao", "0") or 0)
-        qtd = float(od.findtext("qtd", "0") or 0)
-        if vf != 0:
-            result["posicoes"].append({"componente": f"OPFUT {serie}", "tipo": "Opcao Futuro", "valor": vf,
-                                        "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
-    # Caixa
-    for cx in fundo.findall("caixa"):
-        saldo = float(cx.findtext("saldo", "0") or 0)
-        if saldo != 0:
-            result["posicoes"].append({"componente": "Caixa", "tipo": "Caixa", "valor": saldo,
-                                        "peso_pct": saldo / pl * 100, "pu": 0, "qtd": 0, "vlajuste": 0})
-    # Cotas de fundos
-    for cota in fundo.findall("cotas"):
-        cnpj_f = cota.findtext("cnpjfundo", "")
-        qtd = float(cota.findtext("qtdisponivel", "0") or 0)
-        pu = float(cota.findtext("puposicao", "0") or 0)
-        valor = qtd * pu
-        nome = SUBFUNDO_NAMES.get(cnpj_f, f"Fundo {cnpj_f}")
-        result["posicoes"].append({"componente": nome, "tipo": "Fundo", "cnpj": cnpj_f, "valor": valor,
-                                    "peso_pct": valor / pl * 100, "qtd_cotas": qtd, "pu": pu, "qtd": qtd, "vlajuste": 0})
-    return result
+XML_INDEX_REFRESH = 60  # segundos entre verificacoes de novas pastas em XML_BASE
+XML_INDEX_RESCAN_LAST = 3  # pastas mais recentes sempre revarridas (XMLs do dia chegam aos poucos)
+
+@st.cache_resource(show_spinner=False)
+def _synta_xml_store() -> dict:
+    """Indice em memoria (data, prefixo) -> caminho dos XMLs de todos os fundos.
+
+    index: {xml_prefix: {"datas": [date], "paths": [caminho]}} com datas ordenadas,
+    consultado com bisect. folders guarda as pastas ja varridas, para que o refresh
+    so liste XML_BASE e percorra as pastas novas.
+    """
+    return {"lock": threading.Lock(), "folders": set(), "checked_at": 0.0,
+            "index": {cfg["xml_prefix"]: {"datas": [], "paths": []} for cfg in FUNDOS_CONFIG.values()}}
+
+def _refresh_synta_xml_store(store: dict):
+    from export_data import scan_xml_tree
+    names = {n for n in os.listdir(XML_BASE) if n.isdigit() and len(n) == 8}
+    to_scan = (names - store["folders"]) | set(sorted(names)[-XML_INDEX_RESCAN_LAST:])
+    found = scan_xml_tree(XML_BASE, store["index"].keys(), sorted(to_scan))
+    for prefix, entries in found.items():
+        idx = store["index"][prefix]
+        for d, path in entries:
+            pos = bisect.bisect_left(idx["datas"], d)
+            if pos < len(idx["datas"]) and idx["datas"][pos] == d:
+                idx["paths"][pos] = path
+            else:
+                idx["datas"].insert(pos, d)
+                idx["paths"].insert(pos, path)
+    store["folders"] |= names
+
+def _synta_xml_prefix_index(store: dict, xml_prefix: str) -> dict:
+    """{"datas", "paths"} do prefixo; procura pastas novas a cada XML_INDEX_REFRESH s (com lock)."""
+    if time.time() - store["checked_at"] > XML_INDEX_REFRESH and os.path.isdir(XML_BASE):
+        _refresh_synta_xml_store(store)
+        store["checked_at"] = time.time()
+    return store["index"].get(xml_prefix, {"datas": [], "paths": []})
+
+def synta_xml_as_of(xml_prefix: str, ref_date: date):
+    """XML mais recente do fundo com data <= ref_date (ou None)."""
+    store = _synta_xml_store()
+    with store["lock"]:
+        idx = _synta_xml_prefix_index(store, xml_prefix)
+        pos = bisect.bisect_right(idx["datas"], ref_date)
+        return idx["paths"][pos - 1] if pos > 0 else None
+
+def synta_xml_range(xml_prefix: str, start: date, end: date) -> list:
+    """[(data, caminho)] dos XMLs do fundo com start <= data <= end, em ordem."""
+    store = _synta_xml_store()
+    with store["lock"]:
+        idx = _synta_xml_prefix_index(store, xml_prefix)
+        lo = bisect.bisect_left(idx["datas"], start)
+        hi = bisect.bisect_right(idx["datas"], end)
+        return list(zip(idx["datas"][lo:hi], idx["paths"][lo:hi]))
+
+def read_synta_timeseries(fundo_key: str, start=None, end=None) -> pd.DataFrame:
+    """Exported timeseries of a fund between start and end (dates, inclusive).
+
+    The date filter is pushed into the parquet reader: year partitions outside the
+    range are never opened and row-group statistics skip months within a year.
+    Falls back to the legacy single file timeseries_<nome>.parquet.
+    """
+    safe_name = fundo_key.lower().replace(" ", "_")
+    filters = []
+    if start is not None:
+        filters.append(("data", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("data", "<", pd.Timestamp(end) + pd.Timedelta(days=1)))
+    fund_dir = os.path.join(TIMESERIES_DIR, f"fundo={safe_name}")
+    if os.path.isdir(fund_dir):
+        year_filters = []
+        if start is not None:
+            year_filters.append(("ano", ">=", start.year))
+        if end is not None:
+            year_filters.append(("ano", "<=", end.year))
+        df = pd.read_parquet(fund_dir, filters=(year_filters + filters) or None)
+        df = df.drop(columns="ano", errors="ignore")
+    else:
+        parquet_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
+        if not os.path.exists(parquet_path):
+            return pd.DataFrame()
+        df = pd.read_parquet(parquet_path, filters=filters or None)
+    df["data"] = pd.to_datetime(df["data"])
+    return df.sort_values("data", kind="stable").reset_index(drop=True)
 
 @st.cache_data(ttl=600, show_spinner="Carregando posicoes do fundo...")
 def load_synta_timeseries(fundo_key: str, start_str: str, end_str: str) -> pd.DataFrame:
@@ -962,40 +1408,15 @@ def load_synta_timeseries(fundo_key: str, start_str: str, end_str: str) -> pd.Da
 
     # --- Cloud mode: read from pre-exported parquet ---
     if not HAS_LOCAL_XML and HAS_PARQUET_DATA:
-        safe_name = fundo_key.lower().replace(" ", "_")
-        parquet_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
-        if os.path.exists(parquet_path):
-            df = pd.read_parquet(parquet_path)
-            df["data"] = pd.to_datetime(df["data"])
-            df = df[(df["data"].dt.date >= fetch_start) & (df["data"].dt.date <= end_dt)]
-            return df
-        return pd.DataFrame()
+        return read_synta_timeseries(fundo_key, fetch_start, end_dt)
 
-    # --- Local mode: parse XMLs ---
+    # --- Local mode: parse XMLs (em paralelo, via export_data: o worker precisa ser importavel) ---
     if not os.path.isdir(XML_BASE):
         return pd.DataFrame()
-    all_rows = []
-    for folder_name in sorted(os.listdir(XML_BASE)):
-        try:
-            folder_date = datetime.strptime(folder_name, "%Y%m%d").date()
-        except ValueError:
-            continue
-        if folder_date < fetch_start or folder_date > end_dt:
-            continue
-        xml_path = _find_synta_xml(folder_name, prefix)
-        if not xml_path:
-            continue
-        parsed = parse_synta_xml(xml_path)
-        if not parsed or not parsed.get("posicoes"):
-            continue
-        for pos in parsed["posicoes"]:
-            all_rows.append({
-                "data": pd.Timestamp(folder_date), "componente": pos["componente"],
-                "tipo": pos["tipo"], "valor": pos["valor"], "peso_pct": pos["peso_pct"],
-                "patliq": parsed["patliq"], "valorcota": parsed["valorcota"],
-                "pu": pos.get("pu", 0), "vlajuste": pos.get("vlajuste", 0),
-            })
-    return pd.DataFrame(all_rows) if all_rows else pd.DataFrame()
+    from export_data import parse_xml_files
+    items = synta_xml_range(prefix, fetch_start, end_dt)
+    df = parse_xml_files(items)
+    return df.drop(columns="cnpj", errors="ignore")
 
 # ==============================================================================
 # COMPUTATION: SYNTA ATTRIBUTION
@@ -1151,48 +1572,44 @@ def explode_fund_to_stocks(fundo_key: str, ref_date_str: str) -> pd.DataFrame:
     parsed = None
     # --- Cloud mode: reconstruct positions from parquet ---
     if not HAS_LOCAL_XML and HAS_PARQUET_DATA:
-        safe_name = fundo_key.lower().replace(" ", "_")
-        parquet_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
-        if os.path.exists(parquet_path):
-            df_pq = pd.read_parquet(parquet_path)
-            df_pq["data"] = pd.to_datetime(df_pq["data"])
-            df_pq = df_pq[df_pq["data"].dt.date <= ref_dt]
-            if not df_pq.empty:
-                latest_date = df_pq["data"].max()
-                df_snap = df_pq[df_pq["data"] == latest_date]
-                pl = df_snap["patliq"].iloc[0]
-                posicoes = []
-                for _, row in df_snap.iterrows():
-                    pos = {
-                        "componente": row["componente"], "tipo": row["tipo"],
-                        "valor": row["valor"], "peso_pct": row["peso_pct"],
-                        "pu": row.get("pu", 0),
-                    }
-                    if "cnpj" in row and pd.notna(row.get("cnpj")):
-                        pos["cnpj"] = row["cnpj"]
-                    posicoes.append(pos)
-                parsed = {"patliq": pl, "posicoes": posicoes}
+        # Ultimo mes basta para a carteira mais recente; sem dados nele, leitura sem limite
+        df_pq = read_synta_timeseries(fundo_key, start=ref_dt - timedelta(days=31), end=ref_dt)
+        if df_pq.empty:
+            df_pq = read_synta_timeseries(fundo_key, end=ref_dt)
+        if not df_pq.empty:
+            latest_date = df_pq["data"].max()
+            df_snap = df_pq[df_pq["data"] == latest_date]
+            pl = df_snap["patliq"].iloc[0]
+            posicoes = []
+            for _, row in df_snap.iterrows():
+                pos = {
+                    "componente": row["componente"], "tipo": row["tipo"],
+                    "valor": row["valor"], "peso_pct": row["peso_pct"],
+                    "pu": row.get("pu", 0),
+                }
+                if "cnpj" in row and pd.notna(row.get("cnpj")):
+                    pos["cnpj"] = row["cnpj"]
+                posicoes.append(pos)
+            parsed = {"patliq": pl, "posicoes": posicoes}
 
     # --- Local mode: parse XML ---
     if parsed is None and HAS_LOCAL_XML:
-        xml_path = None
-        for folder_name in sorted(os.listdir(XML_BASE), reverse=True):
-            try:
-                folder_date = datetime.strptime(folder_name, "%Y%m%d").date()
-            except ValueError:
-                continue
-            if folder_date <= ref_dt:
-                xml_path = _find_synta_xml(folder_name, prefix)
-                if xml_path:
-                    break
+        xml_path = synta_xml_as_of(prefix, ref_dt)
         if xml_path:
-            parsed = parse_synta_xml(xml_path)
+            parsed = parse_synta_xml(xml_path, SUBFUNDO_NAMES)
 
     if not parsed or not parsed.get("posicoes"):
         return pd.DataFrame()
 
     pl = parsed["patliq"]
-    subfund_positions = load_subfund_positions()
+    subfund_store = load_subfund_store()
+
+    # Resolve todas as composicoes de ETF de uma vez (diretos + dentro dos sub-fundos)
+    etf_candidates = [p["componente"] for p in parsed["posicoes"] if p["tipo"] == "Acao/ETF"]
+    sub_cnpjs = {p.get("cnpj") for p in parsed["posicoes"] if p["tipo"] == "Fundo" and p.get("cnpj")}
+    for cnpj_sub in sub_cnpjs:
+        etf_candidates += subfund_positions(subfund_store, cnpj_sub, latest=True)["ativo"].tolist()
+    etf_comps = prefetch_etf_compositions(tk for tk in etf_candidates if tk in ETF_INDEX_MAP)
 
     exposures = []
 
@@ -1207,12 +1624,9 @@ def explode_fund_to_stocks(fundo_key: str, ref_date_str: str) -> pd.DataFrame:
             nome_sub = comp
 
             # Try to find stock positions for this sub-fund
-            if cnpj_sub and not subfund_positions.empty:
-                df_sub = subfund_positions[subfund_positions["cnpj_fundo"] == cnpj_sub]
-                if not df_sub.empty:
-                    latest = df_sub["data"].max()
-                    df_snap = df_sub[df_sub["data"] == latest]
-
+            if cnpj_sub:
+                df_snap = subfund_positions(subfund_store, cnpj_sub, latest=True)
+                if not df_snap.empty:
                     # Normalize: if sum of pct_pl > 100%, scale down to 100%
                     # (handles leveraged funds or CVM data with guarantees)
                     total_pct = df_snap["pct_pl"].sum()
@@ -1225,7 +1639,7 @@ def explode_fund_to_stocks(fundo_key: str, ref_date_str: str) -> pd.DataFrame:
 
                         # Check if this is an ETF that needs further explosion
                         if ticker in ETF_INDEX_MAP:
-                            etf_comp = fetch_etf_composition(ticker)
+                            etf_comp = etf_comps.get(ticker, {})
                             if etf_comp:
                                 for etf_tk, etf_w in etf_comp.items():
                                     expo_etf = expo / 100 * etf_w
@@ -1269,7 +1683,7 @@ def explode_fund_to_stocks(fundo_key: str, ref_date_str: str) -> pd.DataFrame:
         elif tipo == "Acao/ETF":
             ticker = comp
             if ticker in ETF_INDEX_MAP:
-                etf_comp = fetch_etf_composition(ticker)
+                etf_comp = etf_comps.get(ticker, {})
                 if etf_comp:
                     for etf_tk, etf_w in etf_comp.items():
                         expo_etf = peso_no_fundo * etf_w / 100
@@ -1364,16 +1778,18 @@ def render_tab_ibov():
     if not composition:
         st.error("Não foi possível obter a composição do IBOV via B3 API.")
         return
-    tickers_sa = tuple(sorted(f"{tk}.SA" for tk in composition.keys()))
-    # Buscar precos a partir de ~5 dias antes do inicio para garantir que temos
-    # o Close do dia anterior (base do primeiro retorno). yfinance precisa de margem
-    # para dias nao-uteis / feriados.
-    start_fetch = (dt_inicio - timedelta(days=7)).strftime("%Y-%m-%d")
-    end_str = (dt_fim + timedelta(days=1)).strftime("%Y-%m-%d")
+    # Buscar precos de uma janela longa (>= 1 ano, com margem antes do inicio para ter
+    # o Close do dia anterior). Trocar de periodo dentro dela nao baixa nada de novo:
+    # a atribuicao sai do indice de somas prefixadas.
+    start_fetch, end_str = ibov_history_range(dt_inicio, dt_fim)
+    tickers_sa = ibov_tickers_sa(composition, start_fetch, end_str)
     df_prices = fetch_prices(tickers_sa, start_fetch, end_str)
     if df_prices.empty:
         st.error("Não foi possível baixar preços históricos.")
         return
+    if not ibov_available(df_prices):
+        return
+    attr_index = fetch_attribution_index(tickers_sa, start_fetch, end_str)
     # Filtrar para incluir apenas: ultimo dia ANTES de dt_inicio + todos os dias do periodo
     ibov_all = df_prices["^BVSP"].dropna()
     dates_before = ibov_all.index[ibov_all.index < pd.Timestamp(dt_inicio)]
@@ -1381,9 +1797,12 @@ def render_tab_ibov():
         st.warning("Sem dados suficientes antes da data de inicio para calcular retornos.")
         return
     base_date = dates_before[-1]  # ultimo dia util ANTES do periodo
-    mask = df_prices.index >= base_date
+    mask = (df_prices.index >= base_date) & (df_prices.index <= pd.Timestamp(dt_fim))
     df_prices_full = df_prices.loc[mask].copy()
-    df_attr, df_daily = compute_ibov_daily_attribution(composition, df_prices_full)
+    # Composicao point-in-time: carteira vigente na data base + rebalanceamentos no periodo
+    comp_base = composition_as_of("IBOV", base_date) or composition
+    rebalances = composition_rebalances("IBOV", base_date, pd.Timestamp(dt_fim))
+    df_attr, df_daily = compute_ibov_daily_attribution(comp_base, df_prices_full, attr_index, rebalances)
     if df_attr.empty:
         st.warning("Sem dados suficientes para o período.")
         return
@@ -1561,6 +1980,8 @@ def render_tab_synta():
     # Explode sub-fund contributions to individual stocks
     df_exp = explode_fund_to_stocks(fundo_sel, end_str)
     if not df_exp.empty:
+        # Linhas de df_exp que sao acoes (BR/US); opcoes, fundos e outros nao recebem contribuicao
+        is_stock_exp = classificar_tickers(df_exp["ativo"], SUBFUNDO_NOMES).isin(TICKER_TIPOS_ACAO)
         # For each sub-fund in df_attr, distribute its contribution among its stocks
         stock_contribs = {}  # ticker -> cumulative contribution
         stock_setores = {}   # ticker -> sector
@@ -1581,10 +2002,8 @@ def render_tab_synta():
                 if not df_sub_stocks.empty and df_sub_stocks["exposicao_pct"].sum() > 0:
                     # Distribute contribution proportionally by exposure weight
                     total_expo = df_sub_stocks["exposicao_pct"].sum()
-                    for _, stk_row in df_sub_stocks.iterrows():
+                    for _, stk_row in df_sub_stocks[is_stock_exp[df_sub_stocks.index]].iterrows():
                         tk = stk_row["ativo"]
-                        if not _is_stock_ticker(tk) or _is_option_ticker(tk):
-                            continue
                         prop = stk_row["exposicao_pct"] / total_expo
                         stk_contrib = comp_contrib * prop
                         stock_contribs[tk] = stock_contribs.get(tk, 0) + stk_contrib
@@ -1600,10 +2019,8 @@ def render_tab_synta():
                     df_etf_stocks = df_exp[(df_exp["origem"].str.contains(tk, na=False)) & (df_exp["tipo_origem"].isin(["ETF", "Fundo>ETF"]))]
                     if not df_etf_stocks.empty and df_etf_stocks["exposicao_pct"].sum() > 0:
                         total_expo = df_etf_stocks["exposicao_pct"].sum()
-                        for _, stk_row in df_etf_stocks.iterrows():
+                        for _, stk_row in df_etf_stocks[is_stock_exp[df_etf_stocks.index]].iterrows():
                             etk = stk_row["ativo"]
-                            if not _is_stock_ticker(etk) or _is_option_ticker(etk):
-                                continue
                             prop = stk_row["exposicao_pct"] / total_expo
                             stk_contrib = comp_contrib * prop
                             stock_contribs[etk] = stock_contribs.get(etk, 0) + stk_contrib
@@ -1704,21 +2121,25 @@ def render_tab_brinson():
     if not composition:
         st.error("Composição IBOV indisponível.")
         return
-    tickers_sa = tuple(sorted(f"{tk}.SA" for tk in composition.keys()))
-    start_fetch = (dt_inicio - timedelta(days=7)).strftime("%Y-%m-%d")
-    end_yf = (dt_fim + timedelta(days=1)).strftime("%Y-%m-%d")
+    start_fetch, end_yf = ibov_history_range(dt_inicio, dt_fim)
+    tickers_sa = ibov_tickers_sa(composition, start_fetch, end_yf)
     df_prices = fetch_prices(tickers_sa, start_fetch, end_yf)
     if df_prices.empty:
         st.error("Sem precos.")
         return
+    if not ibov_available(df_prices):
+        return
+    attr_index = fetch_attribution_index(tickers_sa, start_fetch, end_yf)
     ibov_all = df_prices["^BVSP"].dropna()
     dates_before = ibov_all.index[ibov_all.index < pd.Timestamp(dt_inicio)]
     if len(dates_before) == 0:
         st.warning("Sem dados antes do inicio.")
         return
     base_date = dates_before[-1]
-    df_prices_bf = df_prices.loc[df_prices.index >= base_date].copy()
-    df_ibov_attr, _ = compute_ibov_daily_attribution(composition, df_prices_bf)
+    df_prices_bf = df_prices.loc[(df_prices.index >= base_date) & (df_prices.index <= pd.Timestamp(dt_fim))].copy()
+    comp_base = composition_as_of("IBOV", base_date) or composition
+    rebalances = composition_rebalances("IBOV", base_date, pd.Timestamp(dt_fim))
+    df_ibov_attr, _ = compute_ibov_daily_attribution(comp_base, df_prices_bf, attr_index, rebalances)
     if df_ibov_attr.empty:
         st.warning("Sem dados IBOV.")
         return
@@ -2027,13 +2448,14 @@ def render_tab_comparativo():
     if not composition:
         st.error("Composição IBOV indisponível.")
         return
-    tickers_sa = tuple(sorted(f"{tk}.SA" for tk in composition.keys()))
-    start_fetch = (dt_inicio - timedelta(days=7)).strftime("%Y-%m-%d")
-    end_yf = (dt_fim + timedelta(days=1)).strftime("%Y-%m-%d")
+    start_fetch, end_yf = ibov_history_range(dt_inicio, dt_fim)
+    tickers_sa = ibov_tickers_sa(composition, start_fetch, end_yf)
     df_prices = fetch_prices(tickers_sa, start_fetch, end_yf)
     if df_prices.empty:
         st.error("Sem precos.")
         return
+    if not ibov_available(df_prices):
+        return
     # Pegar base date (ultimo dia util ANTES do periodo) para calculo correto do retorno
     ibov_all = df_prices["^BVSP"].dropna()
     dates_before = ibov_all.index[ibov_all.index < pd.Timestamp(dt_inicio)]
@@ -2041,7 +2463,7 @@ def render_tab_comparativo():
         st.warning("Sem dados suficientes antes da data de inicio.")
         return
     base_date = dates_before[-1]
-    ibov_p = ibov_all.loc[ibov_all.index >= base_date]
+    ibov_p = ibov_all.loc[(ibov_all.index >= base_date) & (ibov_all.index <= pd.Timestamp(dt_fim))]
     ret_ibov = (ibov_p.iloc[-1] / ibov_p.iloc[0] - 1) * 100 if len(ibov_p) >= 2 else 0
     ret_fia, ret_fia2, df_a_fia, df_a_fia2 = 0, 0, pd.DataFrame(), pd.DataFrame()
     if has_fia:
@@ -2325,9 +2747,8 @@ def render_tab_carteira_explodida():
     if not df_agg.empty:
         # "Fundo" type but NOT a stock ticker (BR or US) and NOT an option
         mask_fundo = df_exp["tipo_origem"] == "Fundo"
-        mask_is_stock = df_exp["ativo"].apply(_is_stock_ticker)
-        mask_is_option = df_exp["ativo"].apply(_is_option_ticker)
-        df_not_exploded = df_exp[mask_fundo & ~mask_is_stock & ~mask_is_option].copy()
+        mask_nao_acao = classificar_tickers(df_exp["ativo"], SUBFUNDO_NOMES).isin([TICKER_FUNDO, TICKER_OUTRO])
+        df_not_exploded = df_exp[mask_fundo & mask_nao_acao].copy()
         if not df_not_exploded.empty:
             # Deduplicate by fund name (keep one row per fund)
             df_not_exploded = df_not_exploded.groupby("ativo", as_index=False).agg({"exposicao_pct": "sum"})
@@ -2363,16 +2784,23 @@ def render_tab_carteira_explodida():
     if not df_hist.empty:
         # Build sector evolution: for each day, distribute component weights to real sectors
         # Use ALL historical compositions so each day uses the closest available snapshot
-        subfund_positions_all = load_subfund_positions_all()
-        etf_compositions = {}  # cache ETF compositions
-        sector_daily = []
-        hist_dates = sorted(df_hist["data"].unique())
+        subfund_store = load_subfund_store()
 
         # Pre-resolve CNPJ for each component name (avoid repeated lookups)
         _comp_cnpj_cache = {}
         for cnpj, name in SUBFUNDO_NAMES.items():
             _comp_cnpj_cache[name] = cnpj
 
+        # Prefetch ETF compositions (diretos + dentro dos sub-fundos do periodo) em paralelo
+        etf_candidates = set(df_hist["componente"].unique())
+        fundos_hist = df_hist.loc[df_hist["tipo"] == "Fundo", "componente"].unique()
+        sub_cnpjs = {_comp_cnpj_cache[c] for c in fundos_hist if c in _comp_cnpj_cache}
+        for cnpj_sub in sub_cnpjs:
+            etf_candidates |= set(subfund_positions(subfund_store, cnpj_sub)["ativo"].unique())
+        etf_compositions = prefetch_etf_compositions(tk for tk in etf_candidates if tk in ETF_INDEX_MAP)
+        sector_daily = []
+        hist_dates = sorted(df_hist["data"].unique())
+
         for dt in hist_dates:
             day_data = df_hist[df_hist["data"] == dt]
             sector_w = {}  # sector -> weight on this day
@@ -2386,8 +2814,8 @@ def render_tab_carteira_explodida():
                 if tipo == "Fundo":
                     # Try to explode into stocks — use closest historical composition
                     cnpj_sub = _comp_cnpj_cache.get(comp)
-                    if cnpj_sub and not subfund_positions_all.empty:
-                        df_snap = _get_subfund_snapshot(subfund_positions_all, cnpj_sub, pd.Timestamp(dt))
+                    if cnpj_sub:
+                        df_snap = _get_subfund_snapshot(subfund_store, cnpj_sub, pd.Timestamp(dt))
                         if not df_snap.empty:
                             total_pct = df_snap["pct_pl"].sum()
                             scale_factor = 100.0 / total_pct if total_pct > 100 else 1.0
@@ -2507,75 +2935,81 @@ def render_tab_carteira_explodida():
 # ==============================================================================
 # PAGE 6: DESEMPENHO INDIVIDUAL DOS ATIVOS
 # ==============================================================================
-@st.cache_data(ttl=3600, show_spinner="Buscando cotas dos sub-fundos...")
-def _fetch_fund_quotas(cnpjs: tuple, start: str, end: str) -> pd.DataFrame:
-    """Fetch daily quotas for sub-funds from CVM inf_diario cache."""
-    frames = []
-    cache_dir = CARTEIRA_RV_CACHE
 
-    # --- Cloud mode: read from pre-exported parquet ---
-    if not os.path.isdir(cache_dir):
-        pq_path = os.path.join(DATA_DIR, "fund_quotas.parquet")
-        if os.path.exists(pq_path):
-            df = pd.read_parquet(pq_path)
-            df["data"] = pd.to_datetime(df["data"])
-            cnpj_set = set(cnpjs)
-            df = df[df["cnpj_raw"].isin(cnpj_set)]
-            df = df[(df["data"] >= pd.Timestamp(start)) & (df["data"] <= pd.Timestamp(end))]
-            return df.sort_values("data").drop_duplicates(subset=["data", "cnpj_raw"], keep="last")
-        return pd.DataFrame()
-    inf_files = sorted(glob.glob(os.path.join(cache_dir, "cvm_inf_diario_*.parquet")))
-    cnpj_set = set(cnpjs)
-    start_dt = pd.Timestamp(start)
-    end_dt = pd.Timestamp(end)
+@st.cache_resource(show_spinner=False)
+def _quota_panel() -> dict:
+    """Painel de cotas diarias (formato longo) compartilhado por todas as sessoes.
 
-    for fpath in inf_files:
-        try:
-            df = pd.read_parquet(fpath)
-        except Exception:
+    coverage: {mes YYYYMM: (mtime do arquivo inf_diario, {cnpjs ja lidos})}; cada
+    arquivo mensal so e relido para CNPJs ainda nao lidos ou quando o arquivo muda.
+    Pedidos de periodo/CNPJs sao atendidos fatiando o painel.
+    """
+    return {"lock": threading.Lock(), "frame": None, "coverage": {}}
+
+def _top_up_quota_panel(panel: dict, cnpjs: set, start: pd.Timestamp, end: pd.Timestamp):
+    """Le, dos arquivos inf_diario do periodo (podados pelo mes no nome), so o que falta no painel."""
+    first, last = start.strftime("%Y%m"), end.strftime("%Y%m")
+    frames = []
+    for fpath in sorted(glob.glob(os.path.join(CARTEIRA_RV_CACHE, "cvm_inf_diario_*.parquet"))):
+        month = inf_diario_month(fpath) or os.path.basename(fpath)
+        if month.isdigit() and not first <= month <= last:
             continue
-        # Column names vary: cnpj_norm (filtered), CNPJ_FUNDO_CLASSE, CNPJ_FUNDO
-        cnpj_col = None
-        for c in ["cnpj_norm", "CNPJ_FUNDO_CLASSE", "CNPJ_FUNDO"]:
-            if c in df.columns:
-                cnpj_col = c
-                break
-        dt_col = "DT_COMPTC"
-        vl_col = "VL_QUOTA"
-        if cnpj_col is None or dt_col not in df.columns or vl_col not in df.columns:
+        try:
+            mtime = os.path.getmtime(fpath)
+        except OSError:
             continue
-
-        # cnpj_norm is already unformatted 14-digit; formatted CNPJs need cleaning
-        if cnpj_col == "cnpj_norm":
-            mask = df[cnpj_col].isin(cnpj_set)
-        else:
-            # Format our CNPJs to match xx.xxx.xxx/xxxx-xx
-            def _fmt(c):
-                c = c.zfill(14)
-                return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:14]}"
-            fmt_map = {_fmt(c): c for c in cnpj_set}
-            mask = df[cnpj_col].isin(fmt_map.keys())
-
-        df_f = df[mask].copy()
-        if df_f.empty:
+        seen_mtime, seen = panel["coverage"].get(month, (None, set()))
+        if seen_mtime != mtime:
+            # Arquivo novo ou atualizado (mes corrente): descarta o que foi lido dele
+            if seen and panel["frame"] is not None:
+                panel["frame"] = panel["frame"][panel["frame"]["_mes"] != month]
+            seen = set()
+        missing = cnpjs - seen
+        if not missing:
             continue
-        df_f["data"] = pd.to_datetime(df_f[dt_col])
-        df_f = df_f[(df_f["data"] >= start_dt) & (df_f["data"] <= end_dt)]
-        if df_f.empty:
+        try:
+            df = read_inf_diario(fpath, missing, SUBFUNDO_NAMES)
+        except Exception:
             continue
-        if cnpj_col == "cnpj_norm":
-            df_f["cnpj_raw"] = df_f[cnpj_col]
-        else:
-            df_f["cnpj_raw"] = df_f[cnpj_col].map(fmt_map)
-        df_f["nome"] = df_f["cnpj_raw"].map(SUBFUNDO_NAMES)
-        df_f["quota"] = pd.to_numeric(df_f[vl_col], errors="coerce")
-        frames.append(df_f[["data", "cnpj_raw", "nome", "quota"]].dropna())
+        if not df.empty:
+            frames.append(df.assign(_mes=month))
+        panel["coverage"][month] = (mtime, seen | missing)
+    if frames:
+        if panel["frame"] is not None:
+            frames.insert(0, panel["frame"])
+        panel["frame"] = pd.concat(frames, ignore_index=True)
 
-    if not frames:
+def _fetch_fund_quotas(cnpjs: tuple, start: str, end: str) -> pd.DataFrame:
+    """Fetch daily quotas for sub-funds from CVM inf_diario cache.
+
+    Served by slicing the long-lived quota panel (_quota_panel); locally, only the
+    monthly files of the requested period are read, and only for CNPJs not loaded yet.
+    """
+    start_dt = pd.Timestamp(start)
+    end_dt = pd.Timestamp(end)
+    panel = _quota_panel()
+    with panel["lock"]:
+        if os.path.isdir(CARTEIRA_RV_CACHE):
+            with st.spinner("Buscando cotas dos sub-fundos..."):
+                _top_up_quota_panel(panel, set(cnpjs), start_dt, end_dt)
+        elif not panel["coverage"]:
+            # --- Cloud mode: pre-exported parquet, carregado uma vez ---
+            pq_path = os.path.join(DATA_DIR, "fund_quotas.parquet")
+            if os.path.exists(pq_path):
+                df = pd.read_parquet(pq_path)
+                df["data"] = pd.to_datetime(df["data"])
+                panel["frame"] = df
+            panel["coverage"]["export"] = (None, None)
+        df = panel["frame"]
+    if df is None:
         return pd.DataFrame()
-    result = pd.concat(frames, ignore_index=True)
-    result = result.sort_values("data").drop_duplicates(subset=["data", "cnpj_raw"], keep="last")
-    return result
+    df = df[df["cnpj_raw"].isin(cnpjs) & (df["data"] >= start_dt) & (df["data"] <= end_dt)]
+    if df.empty:
+        return pd.DataFrame()
+    # Mesma data em dois arquivos: vale o arquivo do mes mais recente
+    order = ["data", "_mes"] if "_mes" in df else ["data"]
+    df = df.sort_values(order, kind="stable").drop_duplicates(subset=["data", "cnpj_raw"], keep="last")
+    return df[QUOTA_COLUMNS]
 
 
 def render_tab_desempenho_individual():
@@ -2612,38 +3046,27 @@ def render_tab_desempenho_individual():
 
     # --- Cloud mode: reconstruct from parquet ---
     if not HAS_LOCAL_XML and HAS_PARQUET_DATA:
-        safe_name = fundo_key.lower().replace(" ", "_")
-        parquet_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
-        if os.path.exists(parquet_path):
-            df_pq = pd.read_parquet(parquet_path)
-            df_pq["data"] = pd.to_datetime(df_pq["data"])
-            df_pq = df_pq[df_pq["data"].dt.date <= ref_dt]
-            if not df_pq.empty:
-                latest_date = df_pq["data"].max()
-                df_snap = df_pq[df_pq["data"] == latest_date]
-                posicoes = []
-                for _, row in df_snap.iterrows():
-                    pos = {"componente": row["componente"], "tipo": row["tipo"],
-                           "valor": row["valor"], "peso_pct": row["peso_pct"]}
-                    if "cnpj" in row and pd.notna(row.get("cnpj")):
-                        pos["cnpj"] = row["cnpj"]
-                    posicoes.append(pos)
-                parsed = {"posicoes": posicoes}
+        # Ultimo mes basta para a carteira mais recente; sem dados nele, leitura sem limite
+        df_pq = read_synta_timeseries(fundo_key, start=ref_dt - timedelta(days=31), end=ref_dt)
+        if df_pq.empty:
+            df_pq = read_synta_timeseries(fundo_key, end=ref_dt)
+        if not df_pq.empty:
+            latest_date = df_pq["data"].max()
+            df_snap = df_pq[df_pq["data"] == latest_date]
+            posicoes = []
+            for _, row in df_snap.iterrows():
+                pos = {"componente": row["componente"], "tipo": row["tipo"],
+                       "valor": row["valor"], "peso_pct": row["peso_pct"]}
+                if "cnpj" in row and pd.notna(row.get("cnpj")):
+                    pos["cnpj"] = row["cnpj"]
+                posicoes.append(pos)
+            parsed = {"posicoes": posicoes}
 
     # --- Local mode: parse XML ---
     if parsed is None and HAS_LOCAL_XML:
-        xml_path = None
-        for folder_name in sorted(os.listdir(XML_BASE), reverse=True):
-            try:
-                folder_date = datetime.strptime(folder_name, "%Y%m%d").date()
-            except ValueError:
-                continue
-            if folder_date <= ref_dt:
-                xml_path = _find_synta_xml(folder_name, prefix)
-                if xml_path:
-                    break
+        xml_path = synta_xml_as_of(prefix, ref_dt)
         if xml_path:
-            parsed = parse_synta_xml(xml_path)
+            parsed = parse_synta_xml(xml_path, SUBFUNDO_NAMES)
 
     subfund_cnpjs = []
     direct_tickers = []  # direct stock/ETF holdings in the fund
@@ -2655,7 +3078,7 @@ def render_tab_desempenho_individual():
                     subfund_cnpjs.append(cnpj_sub)
             elif pos["tipo"] == "Acao/ETF":
                 tk = pos.get("componente", "")
-                if tk and _is_stock_ticker(tk) and not _is_option_ticker(tk):
+                if tk and _is_stock_ticker(tk):
                     direct_tickers.append(tk)
 
     if not subfund_cnpjs:
@@ -2673,6 +3096,8 @@ def render_tab_desempenho_individual():
     ibov_series = pd.Series(dtype=float)
     if not ibov_prices.empty and "^BVSP" in ibov_prices.columns:
         ibov_series = ibov_prices["^BVSP"].dropna()
+    if ibov_series.empty:
+        st.info(IBOV_MISSING_MSG)
 
     # Build cumulative return series for each fund
     fund_returns = {}
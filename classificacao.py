@@ -0,0 +1,199 @@
+"""
+Classificacao de tickers das carteiras: setor (SETOR_MAP) e tipo do ativo
+(acao BR, acao US, opcao, fundo ou outro), por ticker ou por coluna inteira.
+"""
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+SETOR_MAP = {
+    'ITUB4': 'Financeiro', 'ITUB3': 'Financeiro', 'BBDC4': 'Financeiro', 'BBDC3': 'Financeiro',
+    'BBAS3': 'Financeiro', 'SANB11': 'Financeiro', 'B3SA3': 'Financeiro', 'BPAC11': 'Financeiro',
+    'CIEL3': 'Financeiro', 'PSSA3': 'Financeiro', 'BBSE3': 'Financeiro', 'IRBR3': 'Financeiro',
+    'SULA11': 'Financeiro', 'CXSE3': 'Financeiro', 'ABCB4': 'Financeiro',
+    'PETR4': 'Petroleo e Gas', 'PETR3': 'Petroleo e Gas', 'PRIO3': 'Petroleo e Gas',
+    'RECV3': 'Petroleo e Gas', 'UGPA3': 'Petroleo e Gas', 'CSAN3': 'Petroleo e Gas',
+    'VBBR3': 'Petroleo e Gas', 'ENAT3': 'Petroleo e Gas',
+    'VALE3': 'Mineracao e Siderurgia', 'CSNA3': 'Mineracao e Siderurgia',
+    'GGBR4': 'Mineracao e Siderurgia', 'USIM5': 'Mineracao e Siderurgia',
+    'GOAU4': 'Mineracao e Siderurgia', 'CMIN3': 'Mineracao e Siderurgia',
+    'ELET3': 'Energia Eletrica', 'ELET6': 'Energia Eletrica', 'EGIE3': 'Energia Eletrica',
+    'EQTL3': 'Energia Eletrica', 'CMIG4': 'Energia Eletrica', 'CPFE3': 'Energia Eletrica',
+    'TAEE11': 'Energia Eletrica', 'ENGI11': 'Energia Eletrica', 'NEOE3': 'Energia Eletrica',
+    'CPLE6': 'Energia Eletrica', 'ENEV3': 'Energia Eletrica',
+    'SBSP3': 'Saneamento', 'SAPR11': 'Saneamento', 'CSMG3': 'Saneamento',
+    'HAPV3': 'Saude', 'RDOR3': 'Saude', 'RADL3': 'Saude', 'FLRY3': 'Saude',
+    'HYPE3': 'Saude', 'ONCO3': 'Saude',
+    'MGLU3': 'Varejo e Consumo', 'VIVA3': 'Varejo e Consumo', 'ARZZ3': 'Varejo e Consumo',
+    'LREN3': 'Varejo e Consumo', 'PETZ3': 'Varejo e Consumo', 'NTCO3': 'Varejo e Consumo',
+    'AZZA3': 'Varejo e Consumo', 'ASAI3': 'Varejo e Consumo', 'CRFB3': 'Varejo e Consumo',
+    'PCAR3': 'Varejo e Consumo', 'ALPA4': 'Varejo e Consumo',
+    'TOTS3': 'Tecnologia', 'LWSA3': 'Tecnologia', 'CASH3': 'Tecnologia',
+    'ABEV3': 'Alimentos e Bebidas', 'JBSS3': 'Alimentos e Bebidas',
+    'MRFG3': 'Alimentos e Bebidas', 'BEEF3': 'Alimentos e Bebidas',
+    'BRFS3': 'Alimentos e Bebidas', 'SMTO3': 'Alimentos e Bebidas',
+    'SLCE3': 'Alimentos e Bebidas',
+    'CYRE3': 'Construcao e Imob.', 'EZTC3': 'Construcao e Imob.',
+    'MRVE3': 'Construcao e Imob.', 'CURY3': 'Construcao e Imob.',
+    'RENT3': 'Transporte e Logistica', 'CCRO3': 'Transporte e Logistica',
+    'AZUL4': 'Transporte e Logistica', 'RAIL3': 'Transporte e Logistica',
+    'VIVT3': 'Telecomunicacoes', 'TIMS3': 'Telecomunicacoes',
+    'WEGE3': 'Industrial', 'EMBR3': 'Industrial',
+    'SUZB3': 'Papel e Celulose', 'KLBN11': 'Papel e Celulose',
+    'YDUQ3': 'Educacao', 'COGN3': 'Educacao',
+    'MULT3': 'Shoppings', 'IGTI11': 'Shoppings', 'ALSO3': 'Shoppings',
+    'GGPS3': 'Concessoes e Infra.', 'RAIZ4': 'Industrial',
+    'BRAV3': 'Petroleo e Gas', 'RRRP3': 'Petroleo e Gas',
+    'BRAP4': 'Mineracao e Siderurgia',
+    'ALOS3': 'Shoppings', 'IGTI3': 'Shoppings',
+    'AURE3': 'Energia Eletrica', 'CPLE3': 'Energia Eletrica',
+    'ALUP11': 'Energia Eletrica', 'ISAE4': 'Energia Eletrica',
+    'COCE5': 'Energia Eletrica', 'CLSC4': 'Energia Eletrica', 'TRPL4': 'Energia Eletrica',
+    'ITSA4': 'Financeiro', 'BRBI11': 'Financeiro', 'BPAN4': 'Financeiro',
+    'BRSR6': 'Financeiro',
+    'BMOB3': 'Tecnologia', 'DESK3': 'Tecnologia', 'INTB3': 'Tecnologia',
+    'POSI3': 'Tecnologia', 'LWSA3': 'Tecnologia',
+    'MATD3': 'Saude', 'ANIM3': 'Saude', 'DASA3': 'Saude', 'QUAL3': 'Saude',
+    'ODPV3': 'Saude', 'PNVL3': 'Saude',
+    'MLAS3': 'Varejo e Consumo', 'SMFT3': 'Varejo e Consumo',
+    'CAML3': 'Alimentos e Bebidas', 'MDIA3': 'Alimentos e Bebidas',
+    'CVCB3': 'Varejo e Consumo', 'GRND3': 'Varejo e Consumo',
+    'VULC3': 'Varejo e Consumo',
+    'LAVV3': 'Construcao e Imob.', 'TRIS3': 'Construcao e Imob.',
+    'DIRR3': 'Construcao e Imob.', 'EVEN3': 'Construcao e Imob.',
+    'MDNE3': 'Construcao e Imob.', 'JHSF3': 'Construcao e Imob.',
+    'PLPL3': 'Construcao e Imob.', 'TEND3': 'Construcao e Imob.',
+    'RDNI3': 'Construcao e Imob.', 'MELK3': 'Construcao e Imob.',
+    'HBSA3': 'Construcao e Imob.', 'TCSA3': 'Construcao e Imob.',
+    'FRAS3': 'Industrial', 'TUPY3': 'Industrial', 'KEPL3': 'Industrial',
+    'LEVE3': 'Industrial', 'SHUL4': 'Industrial', 'MYPK3': 'Industrial',
+    'POMO4': 'Industrial', 'POMO3': 'Industrial', 'DXCO3': 'Industrial',
+    'TGMA3': 'Transporte e Logistica', 'STBP3': 'Transporte e Logistica',
+    'ECOR3': 'Transporte e Logistica', 'LOGN3': 'Transporte e Logistica',
+    'SIMH3': 'Transporte e Logistica', 'MILS3': 'Transporte e Logistica',
+    'PORT3': 'Transporte e Logistica', 'RAPT4': 'Transporte e Logistica',
+    'RAPT3': 'Transporte e Logistica',
+    'MOTV3': 'Varejo e Consumo', 'ORVR3': 'Varejo e Consumo',
+    'SBFG3': 'Financeiro',
+    'SRNA3': 'Industrial', 'LOGG3': 'Transporte e Logistica',
+    'CSED3': 'Educacao', 'PASS5': 'Varejo e Consumo',
+    'OPCT3': 'Saude', 'VLID3': 'Tecnologia',
+    'BRKM5': 'Petroquimica', 'UNIP6': 'Petroquimica',
+    'OFSA3': 'Saude', 'GMAT3': 'Construcao e Imob.',
+    'SOJA3': 'Alimentos e Bebidas', 'PRNR3': 'Varejo e Consumo',
+    'ZAMP3': 'Alimentos e Bebidas', 'TFCO4': 'Varejo e Consumo',
+    'CSUD3': 'Industrial', 'BRST3': 'Industrial',
+    'PGMN3': 'Construcao e Imob.', 'TTEN3': 'Industrial',
+    'VIVA3': 'Varejo e Consumo', 'HBRE3': 'Construcao e Imob.',
+    'MGEL4': 'Industrial', 'FBMC4': 'Financeiro',
+    'TOKY3': 'Tecnologia', 'MBRF3': 'Alimentos e Bebidas',
+    'NATU3': 'Varejo e Consumo',
+    'ROXO34': 'Financeiro (US)', 'XPBR31': 'Financeiro (US)',
+    'INBR32': 'Financeiro (US)', 'AURA33': 'Mineracao e Siderurgia',
+    'STOC34': 'Financeiro (US)',
+    'BOVA11': 'ETF - Ibovespa', 'DIVO11': 'ETF - Dividendos',
+    'LVOL11': 'ETF - Low Vol', 'SMAL11': 'ETF - Small Cap',
+    # ── Acoes listadas nos EUA (via BDR ou posicao direta) ──
+    'AMZN US': 'Tecnologia (US)', 'AMZN': 'Tecnologia (US)',
+    'META US': 'Tecnologia (US)', 'META': 'Tecnologia (US)',
+    'MELI US': 'E-Commerce (US)', 'MELI': 'E-Commerce (US)',
+    'NU US': 'Financeiro (US)', 'NU': 'Financeiro (US)',
+    'STNE US': 'Financeiro (US)', 'STNE': 'Financeiro (US)',
+    'INTR US': 'Financeiro (US)', 'INTR': 'Financeiro (US)',
+    'XP US': 'Financeiro (US)', 'XP': 'Financeiro (US)',
+    'DLO US': 'Financeiro (US)', 'DLO': 'Financeiro (US)',
+    'VTEX US': 'Tecnologia (US)', 'VTEX': 'Tecnologia (US)',
+    'PAGS US': 'Financeiro (US)', 'PAGS': 'Financeiro (US)',
+    'GGAL US': 'Financeiro (US)', 'GGAL': 'Financeiro (US)',
+    'BBAR US': 'Financeiro (US)', 'BBAR': 'Financeiro (US)',
+    'GLOB US': 'Tecnologia (US)', 'GLOB': 'Tecnologia (US)',
+    'MSFT US': 'Tecnologia (US)', 'GOOGL US': 'Tecnologia (US)',
+    'AAPL US': 'Tecnologia (US)', 'NVDA US': 'Tecnologia (US)',
+    'TSLA US': 'Automotivo (US)',
+}
+
+# Tickers que sao acoes (listadas fora do BR ou com formato nao-padrao) e NAO fundos
+# Usado para evitar que aparecam como "Fundos nao explodidos"
+US_STOCK_SUFFIXES = (" US",)  # Bloomberg-style tickers from CVM
+US_SETOR_SUFFIX = "(US)"  # setores do SETOR_MAP de acoes listadas nos EUA
+
+# Acoes BR padrao: 4 letras + 1-2 digitos (PETR4, KLBN11, BOVA11, etc.)
+BR_STOCK_TICKER_RE = re.compile(r'^[A-Z]{4}\d{1,2}$')
+# Opcoes BR: 4 letras + 1 letra (serie) + digitos (strike) — ex: IBOVV136, PETRM25, VALEC30
+OPTION_TICKER_RE = re.compile(r'^[A-Z]{4}[A-Z]\d+$')
+# Nomes de fundos (posicoes agregadas que aparecem no lugar de tickers)
+FUND_NAME_RE = re.compile(r'\b(?:FIC|FIA|FIM|FII|FIP|FI|FUNDO|RF)\b')
+
+# Tipos de ticker (ver ticker_tipo / classificar_tickers)
+TICKER_ACAO_BR = "Acao BR"
+TICKER_ACAO_US = "Acao US"
+TICKER_OPCAO = "Opcao"
+TICKER_FUNDO = "Fundo"
+TICKER_OUTRO = "Outro"
+TICKER_TIPOS_ACAO = (TICKER_ACAO_BR, TICKER_ACAO_US)
+TICKER_TIPO_DTYPE = pd.CategoricalDtype([TICKER_ACAO_BR, TICKER_ACAO_US, TICKER_OPCAO, TICKER_FUNDO, TICKER_OUTRO])
+
+# Todos os setores que classificar_setor pode devolver (coluna setor categorica)
+SETOR_DTYPE = pd.CategoricalDtype(sorted(set(SETOR_MAP.values()) | {'Opcoes/Protecao', 'Outros'}))
+
+
+@lru_cache(maxsize=None)
+def ticker_tipo(ticker: str, nomes_fundos: frozenset = frozenset()) -> str:
+    """Tipo do ticker: acao BR, acao US, opcao, fundo ou outro (memoizado por ticker).
+
+    nomes_fundos: nomes de fundos que aparecem no lugar do ticker (ex.: sub-fundos).
+    """
+    tk = ticker.strip().upper()
+    if BR_STOCK_TICKER_RE.match(tk):
+        return TICKER_ACAO_BR
+    # US stocks: XXXX US (Bloomberg-style)
+    if tk.endswith(US_STOCK_SUFFIXES):
+        return TICKER_ACAO_US
+    # Fora do padrao BR mas no SETOR_MAP: o setor diz se e US (VTEX, PAGS, ...) ou BR (B3SA3)
+    if tk in SETOR_MAP:
+        return TICKER_ACAO_US if SETOR_MAP[tk].endswith(US_SETOR_SUFFIX) else TICKER_ACAO_BR
+    if OPTION_TICKER_RE.match(tk):
+        return TICKER_OPCAO
+    if ticker in nomes_fundos or FUND_NAME_RE.search(tk):
+        return TICKER_FUNDO
+    return TICKER_OUTRO
+
+
+def classificar_tickers(tickers: pd.Series, nomes_fundos: frozenset = frozenset()) -> pd.Series:
+    """ticker_tipo for a whole column, as a categorical Series (TICKER_TIPO_DTYPE).
+
+    Each distinct ticker is classified once (and memoized across calls); null
+    tickers -> TICKER_OUTRO.
+    """
+    codes, uniques = pd.factorize(tickers)
+    tipos = [ticker_tipo(str(tk), nomes_fundos) for tk in uniques] + [TICKER_OUTRO]  # ultimo: codigo -1 (nulos)
+    cat_codes = TICKER_TIPO_DTYPE.categories.get_indexer(tipos)
+    return pd.Series(pd.Categorical.from_codes(cat_codes[codes], dtype=TICKER_TIPO_DTYPE),
+                     index=tickers.index, name="tipo_ticker")
+
+
+def classificar_setor(ticker: str) -> str:
+    tk = ticker.strip().upper()
+    if tk in SETOR_MAP:
+        return SETOR_MAP[tk]
+    # Opcoes
+    if OPTION_TICKER_RE.match(tk):
+        return 'Opcoes/Protecao'
+    return 'Outros'
+
+
+def classificar_setor_series(tickers: pd.Series) -> pd.Series:
+    """classificar_setor for a whole column, as a categorical Series (SETOR_DTYPE).
+
+    Each distinct ticker is classified once: SETOR_MAP through map, then the
+    precompiled option regex for the tickers not in the map. Null tickers -> 'Outros'.
+    """
+    codes, uniques = pd.factorize(tickers)
+    tk = pd.Series(uniques, dtype=object).astype(str).str.strip().str.upper()
+    fallback = pd.Series(np.where(tk.str.match(OPTION_TICKER_RE), 'Opcoes/Protecao', 'Outros'))
+    setor = tk.map(SETOR_MAP).fillna(fallback)
+    # Ultima posicao = 'Outros', alcancada pelo codigo -1 que factorize da aos nulos
+    cat_codes = np.r_[SETOR_DTYPE.categories.get_indexer(setor), SETOR_DTYPE.categories.get_loc('Outros')]
+    return pd.Series(pd.Categorical.from_codes(cat_codes[codes], dtype=SETOR_DTYPE),
+                     index=tickers.index, name="setor")
@@ -0,0 +1,100 @@
+"""
+Parser vetorizado dos arquivos COTAHIST da B3 (series historicas, layout fixo de 245 posicoes).
+Fonte offline de fechamentos para o armazem de precos do app (ver fetch_prices em app.py).
+
+O arquivo inteiro e lido como um unico buffer de bytes e fatiado como matriz
+(linhas x colunas) com NumPy; nao ha laco por linha. Aceita TXT ou o ZIP
+distribuido pela B3 (COTAHIST_A2024.ZIP, COTAHIST_D02012024.ZIP, ...).
+
+Os precos do COTAHIST sao os negociados no dia, sem ajuste por proventos: por isso
+ficam num armazem separado do Yahoo (ajustado) e so servem tickers sem serie ajustada.
+"""
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+RECORD_LEN = 245
+
+# Posicoes (base 0, fim exclusivo) dos campos usados do registro tipo 01
+_TIPREG = (0, 2)
+_DATA = (2, 10)
+_CODBDI = (10, 12)
+_CODNEG = (12, 24)
+_TPMERC = (24, 27)
+_PREULT = (108, 121)
+_FATCOT = (210, 217)
+
+# Mercado a vista; o fracionario (020) fica de fora (mesmo papel, preco redundante)
+TPMERC_VISTA = b"010"
+# BDI: 02 lote padrao, 12 FII, 14 cert. investimento / ETFs
+CODBDI_ACEITOS = (b"02", b"12", b"14")
+
+
+def _read_buffer(path: str) -> bytes:
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            name = next(n for n in zf.namelist() if not n.endswith("/"))
+            return zf.read(name)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _as_matrix(buf) -> np.ndarray:
+    """Buffer -> matriz uint8 (n_linhas, RECORD_LEN), com ou sem CRLF entre registros."""
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    nl = int(np.argmax(raw == 10)) if (raw == 10).any() else len(raw)
+    stride = nl + 1 if nl < len(raw) else RECORD_LEN
+    n = len(raw) // stride
+    # Ultima linha pode vir sem quebra de linha
+    if len(raw) - n * stride >= RECORD_LEN:
+        raw = np.concatenate([raw, np.full(stride - (len(raw) - n * stride), 10, dtype=np.uint8)])
+        n += 1
+    return raw[:n * stride].reshape(n, stride)[:, :RECORD_LEN]
+
+
+def _field_int(mat: np.ndarray, span: tuple) -> np.ndarray:
+    """Campo numerico de largura fixa -> int64 (digitos ASCII, sem sinal)."""
+    digits = mat[:, span[0]:span[1]].astype(np.int64) - 48
+    weights = 10 ** np.arange(span[1] - span[0] - 1, -1, -1, dtype=np.int64)
+    return digits @ weights
+
+
+def _field_eq(mat: np.ndarray, span: tuple, value: bytes) -> np.ndarray:
+    return (mat[:, span[0]:span[1]] == np.frombuffer(value, dtype=np.uint8)).all(axis=1)
+
+
+def parse_cotahist(source) -> pd.DataFrame:
+    """Fechamentos do mercado a vista de um arquivo COTAHIST (caminho ou bytes).
+
+    Retorna formato longo (ticker, data, close), tickers com sufixo .SA, precos em
+    R$ por acao (PREULT / FATCOT).
+    """
+    buf = _read_buffer(source) if isinstance(source, (str, os.PathLike)) else source
+    mat = _as_matrix(buf)
+    keep = _field_eq(mat, _TIPREG, b"01") & _field_eq(mat, _TPMERC, TPMERC_VISTA)
+    bdi_ok = np.zeros(len(mat), dtype=bool)
+    for bdi in CODBDI_ACEITOS:
+        bdi_ok |= _field_eq(mat, _CODBDI, bdi)
+    mat = mat[keep & bdi_ok]
+    if len(mat) == 0:
+        return pd.DataFrame(columns=["ticker", "data", "close"])
+
+    ymd = _field_int(mat, _DATA)
+    datas = pd.to_datetime(pd.DataFrame({"year": ymd // 10000, "month": ymd // 100 % 100,
+                                         "day": ymd % 100}))
+    close = _field_int(mat, _PREULT) / 100.0 / np.maximum(_field_int(mat, _FATCOT), 1)
+    codneg = np.ascontiguousarray(mat[:, _CODNEG[0]:_CODNEG[1]]).view(f"S{_CODNEG[1] - _CODNEG[0]}").ravel()
+    # Decodifica so os codigos distintos (poucos milhares) e expande pelos indices
+    uniq, inv = np.unique(codneg, return_inverse=True)
+    tickers = np.array([u.decode("ascii").strip() + ".SA" for u in uniq], dtype=object)[inv]
+    df = pd.DataFrame({"ticker": tickers, "data": datas.values, "close": close})
+    return df[df["close"] > 0].reset_index(drop=True)
+
+
+def list_cotahist_files(folder: str) -> list:
+    """Arquivos COTAHIST (TXT ou ZIP) de uma pasta, ordenados por nome."""
+    if not folder or not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                  if f.upper().startswith("COTAHIST") and f.lower().endswith((".txt", ".zip")))
@@ -0,0 +1,113 @@
+"""
+Leitura dos caches mensais da CVM (cvm_blc4_*, cvm_pl_*, cvm_inf_diario_*) usados por
+app.py e export_data.py.
+
+Os arquivos sao lidos so com as colunas usadas e com o filtro de CNPJ aplicado no
+leitor parquet. O nome da coluna de CNPJ mudou entre versoes do layout da CVM e e
+tirado do schema de cada arquivo.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+BLC4_COLUMNS = ["TP_APLIC", "CD_ATIVO", "VL_MERC_POS_FINAL"]
+# Acoes (com ou sem acento) e BDRs
+BLC4_STOCK_RE = r"(?:A.{1,3}es|Brazilian Depository)"
+QUOTA_COLUMNS = ["data", "cnpj_raw", "nome", "quota"]
+
+
+def format_cnpj(c: str) -> str:
+    """CNPJ so digitos -> xx.xxx.xxx/xxxx-xx (formato dos arquivos da CVM)."""
+    c = c.zfill(14)
+    return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:14]}"
+
+
+def read_cvm_cache(path: str, columns: list, cnpjs) -> tuple:
+    """Read only `columns` of a CVM cache parquet for the given (formatted) CNPJs.
+
+    The CNPJ filter is pushed into the parquet reader. The CNPJ column name changed
+    between CVM layout versions, so it is taken from the file schema. Returns
+    (df, cnpj_col), with df None when the file lacks any of the columns.
+    """
+    names = pq.read_schema(path).names
+    cnpj_col = "CNPJ_FUNDO_CLASSE" if "CNPJ_FUNDO_CLASSE" in names else "CNPJ_FUNDO"
+    if cnpj_col not in names or any(c not in names for c in columns):
+        return None, cnpj_col
+    df = pd.read_parquet(path, columns=[cnpj_col] + list(columns),
+                         filters=[(cnpj_col, "in", sorted(cnpjs))])
+    return df, cnpj_col
+
+
+def read_blc4_month(blc4_file: str, master_formatted: dict):
+    """Stock holdings of the given masters in one cvm_blc4_<mes>.parquet.
+
+    master_formatted: {formatted CNPJ: raw CNPJ}. Returns a DataFrame with
+    cnpj_fundo (raw), data, ativo, valor, pl and pct_pl, or None when the file
+    name or layout is not usable. PL comes from cvm_pl_<mes>.parquet next to the
+    file (joined by CNPJ); without it, it is estimated from the positions (+5%).
+    """
+    cache_dir = os.path.dirname(blc4_file)
+    month_str = os.path.basename(blc4_file).replace("cvm_blc4_", "").replace(".parquet", "")
+    try:
+        ref_date = pd.Timestamp(f"{month_str[:4]}-{month_str[4:6]}-28")
+    except ValueError:
+        return None
+    df_blc, cnpj_col = read_cvm_cache(blc4_file, BLC4_COLUMNS, master_formatted)
+    if df_blc is None:
+        return None
+
+    mask_stocks = df_blc["TP_APLIC"].str.contains(BLC4_STOCK_RE, case=False, na=False)
+    mask_value = df_blc["VL_MERC_POS_FINAL"].fillna(0) > 0
+    df_stocks = df_blc[mask_stocks & mask_value]
+
+    # PL do mes (join por CNPJ); sem PL, estimativa pela soma das posicoes (+5% nao-acoes)
+    pl = df_stocks.groupby(cnpj_col)["VL_MERC_POS_FINAL"].transform("sum") * 1.05
+    pl_file = os.path.join(cache_dir, f"cvm_pl_{month_str}.parquet")
+    if not df_stocks.empty and os.path.exists(pl_file):
+        try:
+            df_pl, pl_cnpj_col = read_cvm_cache(pl_file, ["VL_PATRIM_LIQ"], df_stocks[cnpj_col].unique())
+            if df_pl is not None:
+                df_pl = df_pl[df_pl["VL_PATRIM_LIQ"] > 0].drop_duplicates(pl_cnpj_col, keep="last")
+                pl_cvm = df_stocks[cnpj_col].map(df_pl.set_index(pl_cnpj_col)["VL_PATRIM_LIQ"])
+                pl = pl_cvm.where(pl_cvm > 0, pl)
+        except Exception:
+            pass
+
+    df = pd.DataFrame({
+        "cnpj_fundo": df_stocks[cnpj_col].map(master_formatted).to_numpy(),
+        "data": ref_date,
+        "ativo": df_stocks["CD_ATIVO"].fillna("").astype(str).str.strip().to_numpy(),
+        "valor": df_stocks["VL_MERC_POS_FINAL"].astype(float).to_numpy(),
+        "pl": pl.astype(float).to_numpy(),
+    })
+    df = df[df["ativo"] != ""].reset_index(drop=True)
+    df["pct_pl"] = np.where(df["pl"] > 0, df["valor"] / df["pl"] * 100, 0.0)
+    return df
+
+
+def inf_diario_month(path: str):
+    """Mes (YYYYMM) de um cvm_inf_diario_YYYYMM.parquet; None se o nome nao seguir o padrao."""
+    month = os.path.basename(path)[len("cvm_inf_diario_"):-len(".parquet")]
+    return month if len(month) == 6 and month.isdigit() else None
+
+
+def read_inf_diario(path: str, cnpjs, nomes: dict) -> pd.DataFrame:
+    """Quotas of `cnpjs` from one CVM inf_diario file (projected, CNPJ filter in the reader).
+
+    Returns QUOTA_COLUMNS, with nome taken from nomes ({cnpj: nome}).
+    """
+    names = pq.read_schema(path).names
+    # Column names vary: cnpj_norm (filtered), CNPJ_FUNDO_CLASSE, CNPJ_FUNDO
+    cnpj_col = next((c for c in ["cnpj_norm", "CNPJ_FUNDO_CLASSE", "CNPJ_FUNDO"] if c in names), None)
+    if cnpj_col is None or "DT_COMPTC" not in names or "VL_QUOTA" not in names:
+        return pd.DataFrame(columns=QUOTA_COLUMNS)
+    # cnpj_norm is already unformatted 14-digit; formatted CNPJs need xx.xxx.xxx/xxxx-xx
+    keys = {c: c for c in cnpjs} if cnpj_col == "cnpj_norm" else {format_cnpj(c): c for c in cnpjs}
+    df = pd.read_parquet(path, columns=[cnpj_col, "DT_COMPTC", "VL_QUOTA"],
+                         filters=[(cnpj_col, "in", sorted(keys))])
+    cnpj_raw = df[cnpj_col].map(keys)
+    out = pd.DataFrame({"data": pd.to_datetime(df["DT_COMPTC"]), "cnpj_raw": cnpj_raw,
+                        "nome": cnpj_raw.map(nomes),
+                        "quota": pd.to_numeric(df["VL_QUOTA"], errors="coerce")})
+    return out.dropna()
@@ -5,21 +5,69 @@ Esses parquets sao commitados no repo e usados pelo app na nuvem (Streamlit Clou
 Uso:
     python export_data.py          # exporta tudo
     python export_data.py --since 2025-01-01  # exporta a partir de uma data
+    python export_data.py --workers 4         # processos para parsear os XMLs (default XML_WORKERS)
+    python export_data.py --full              # ignora os manifestos e reprocessa XMLs e cotas
+    python export_data.py --bench-xml         # compara os parsers etree x lxml no ultimo ano
 """
 import os
 import sys
 import glob
+import json
+import hashlib
 import shutil
+import time
 import argparse
+import numpy as np
 import pandas as pd
-import xml.etree.ElementTree as ET
+import pyarrow as pa
+import pyarrow.parquet as pq
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
+from cvm_cache import format_cnpj, read_blc4_month, inf_diario_month, read_inf_diario
+from synta_xml import LET, TIPOS, parse_synta_xml, parse_synta_xml_columns
+
 # === Paths ===
 XML_BASE = r"G:\Drives compartilhados\SisIntegra\AMBIENTE_PRODUCAO\Posicao_XML\Mellon"
 CARTEIRA_RV_DATA = r"G:\Drives compartilhados\Gestao_AI\carteira_rv\data"
 CARTEIRA_RV_CACHE = r"G:\Drives compartilhados\Gestao_AI\carteira_rv\cache"
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# Estado local da exportacao (nao commitado, mesmo .cache/ do app.py)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# === Parsing paralelo dos XMLs ===
+XML_WORKERS = int(os.environ.get("XML_WORKERS", "0") or 0) or min(8, os.cpu_count() or 1)
+XML_POOL_MIN_FILES = 32  # abaixo disso o custo de subir os processos nao compensa
+
+# Timeseries dos fundos: dataset particionado fundo=<nome>/ano=<YYYY>, ordenado por data,
+# um row group por mes (estatisticas min/max permitem ao leitor pular meses fora do filtro)
+TIMESERIES_DIR = os.path.join(DATA_DIR, "timeseries")
+TIMESERIES_SCHEMA = pa.schema([
+    ("data", pa.timestamp("ns")), ("componente", pa.string()), ("tipo", pa.string()),
+    ("valor", pa.float64()), ("peso_pct", pa.float64()), ("patliq", pa.float64()),
+    ("valorcota", pa.float64()), ("pu", pa.float64()), ("vlajuste", pa.float64()),
+    ("cnpj", pa.string()),
+])
+
+# Carteiras (acoes/BDRs) de todos os masters do MASTER_CNPJ_MAP, todos os meses do cache
+# BLC_4 da CVM; ordenado por (cnpj_fundo, data), um row group por master
+MASTER_HOLDINGS_PATH = os.path.join(DATA_DIR, "master_holdings.parquet")
+
+# Cotas diarias dos sub-fundos e estado da exportacao incremental (ultimo mes/data por CNPJ)
+FUND_QUOTAS_PATH = os.path.join(DATA_DIR, "fund_quotas.parquet")
+QUOTAS_MANIFEST_PATH = os.path.join(DATA_DIR, "fund_quotas_manifest.json")
+
+# Fechamentos diarios do IBOV (^BVSP, formato longo ticker/data/close): o COTAHIST nao
+# traz indices, entao e a fonte offline do benchmark no app quando o Yahoo nao responde
+IBOV_PATH = os.path.join(DATA_DIR, "ibov.parquet")
+IBOV_START = "2021-01-01"  # mesmo inicio do historico de cotas dos sub-fundos
+IBOV_OVERLAP_DAYS = 10  # dias ja exportados baixados de novo a cada execucao
+
+# Manifesto dos XMLs ja exportados (caminho relativo a XML_BASE -> tamanho, mtime, hash,
+# data), por fundo. Fica no cache local: sem ele, a janela varrida e reprocessada inteira
+XML_MANIFEST_PATH = os.path.join(CACHE_DIR, "xml_manifest.json")
+LEGACY_XML_MANIFEST_PATH = os.path.join(DATA_DIR, "xml_manifest.json")
 
 # === Fund config (same as app.py) ===
 FUNDOS_CONFIG = {
@@ -72,170 +120,334 @@ MASTER_CNPJ_MAP = {
 }
 
 
-def parse_synta_xml(filepath: str) -> dict:
-    """Parse a Synta XML file (same logic as app.py)."""
-    tree = ET.parse(filepath)
-    root = tree.getroot()
-    fundo = root.find("fundo")
-    if fundo is None:
+def _parse_xml_columns(item):
+    """Worker: (data, caminho do XML) -> parse_synta_xml_columns do arquivo."""
+    return parse_synta_xml_columns(item[1], SUBFUNDO_NAMES)
+
+
+def parse_xml_files(items, max_workers=None) -> pd.DataFrame:
+    """Parse [(data, caminho do XML), ...] into one columnar timeseries frame.
+
+    Files are parsed in a ProcessPoolExecutor (max_workers, default XML_WORKERS)
+    and concatenated in the order of items, so the output is deterministic.
+    Each worker returns typed column buffers; componente/cnpj codes are re-interned
+    into one table here and only expanded to strings when the frame is built.
+    The cnpj column is dropped when no position carries one.
+    """
+    items = list(items)
+    workers = XML_WORKERS if max_workers is None else max_workers
+    if workers > 1 and len(items) >= XML_POOL_MIN_FILES:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_parse_xml_columns, items,
+                                    chunksize=max(1, len(items) // (workers * 4))))
+    else:
+        results = [_parse_xml_columns(item) for item in items]
+
+    comp_codes, cnpj_codes = {}, {}
+    datas, counts, patliq, valorcota = [], [], [], []
+    cols = {"componente": array("i"), "tipo": array("b"), "cnpj": array("i"),
+            "valor": array("d"), "peso_pct": array("d"), "pu": array("d"), "vlajuste": array("d")}
+    for (folder_date, _), res in zip(items, results):
+        if res is None:
+            continue
+        datas.append(folder_date)
+        counts.append(len(res["valor"]))
+        patliq.append(res["patliq"])
+        valorcota.append(res["valorcota"])
+        comp_map = [comp_codes.setdefault(c, len(comp_codes)) for c in res["componentes"]]
+        cols["componente"].extend(map(comp_map.__getitem__, res["componente"]))
+        # cnpj -1 (sem cnpj) indexa o ultimo elemento do mapa, que continua -1
+        cnpj_map = [cnpj_codes.setdefault(c, len(cnpj_codes)) for c in res["cnpjs"]] + [-1]
+        cols["cnpj"].extend(map(cnpj_map.__getitem__, res["cnpj"]))
+        for c in ("tipo", "valor", "peso_pct", "pu", "vlajuste"):
+            cols[c].extend(res[c])
+    if not datas:
+        return pd.DataFrame()
+
+    counts = np.array(counts)
+    comp_values = np.array(list(comp_codes), dtype=object)
+    cnpj_values = np.array(list(cnpj_codes) + [None], dtype=object)
+    df = pd.DataFrame({
+        "data": np.repeat(pd.to_datetime(datas).values, counts),
+        "componente": comp_values[np.frombuffer(cols["componente"], dtype=np.intc)],
+        "tipo": np.array(TIPOS, dtype=object)[np.frombuffer(cols["tipo"], dtype=np.int8)],
+        "valor": np.frombuffer(cols["valor"], dtype=np.float64),
+        "peso_pct": np.frombuffer(cols["peso_pct"], dtype=np.float64),
+        "patliq": np.repeat(np.array(patliq, dtype=np.float64), counts),
+        "valorcota": np.repeat(np.array(valorcota, dtype=np.float64), counts),
+        "pu": np.frombuffer(cols["pu"], dtype=np.float64),
+        "vlajuste": np.frombuffer(cols["vlajuste"], dtype=np.float64),
+        "cnpj": cnpj_values[np.frombuffer(cols["cnpj"], dtype=np.intc)],
+    })
+    if df["cnpj"].isna().all():
+        df = df.drop(columns="cnpj")
+    return df
+
+
+def scan_xml_tree(base: str, prefixes, folder_names=None) -> dict:
+    """Single walk of base: {xml_prefix: [(data, caminho), ...]} sorted by date.
+
+    Each YYYYMMDD folder is listed once and its files are routed by the prefix of
+    their name (PREFIXO_*), so the traffic on the shared drive does not grow with
+    the number of funds. The first file of each prefix in a folder wins.
+    folder_names restricts the walk to those date folders (incremental refresh).
+    """
+    prefixes = set(prefixes)
+    index = {p: [] for p in prefixes}
+    folders = []
+    if folder_names is None:
+        with os.scandir(base) as it:
+            candidates = [(entry.name, entry.path) for entry in it if entry.is_dir()]
+    else:
+        candidates = [(name, os.path.join(base, name)) for name in folder_names]
+    for name, path in candidates:
+        try:
+            folder_date = datetime.strptime(name, "%Y%m%d").date()
+        except ValueError:
+            continue
+        folders.append((folder_date, path))
+    for folder_date, folder in sorted(folders):
+        found = set()
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as it:
+            for entry in it:
+                prefix, sep, _ = entry.name.partition("_")
+                if sep and prefix in prefixes and prefix not in found:
+                    found.add(prefix)
+                    index[prefix].append((folder_date, entry.path))
+    return index
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _xml_manifest_key(path: str):
+    """Chave do XML no manifesto: caminho relativo a XML_BASE, com "/" (None se estiver fora dela)."""
+    try:
+        rel = os.path.relpath(path, XML_BASE)
+    except ValueError:  # outro drive
+        return None
+    return None if rel.startswith("..") else rel.replace(os.sep, "/")
+
+
+def load_xml_manifest() -> dict:
+    """{fundo_key: {caminho relativo: {"size", "mtime", "hash", "data"}}} dos XMLs ja exportados.
+
+    Um manifesto antigo em data/ (chaves absolutas) e convertido e removido de la.
+    """
+    path = XML_MANIFEST_PATH if os.path.exists(XML_MANIFEST_PATH) else LEGACY_XML_MANIFEST_PATH
+    if not os.path.exists(path):
         return {}
-    header = fundo.find("header")
-    result = {
-        "cnpj": header.findtext("cnpj", ""),
-        "nome": header.findtext("nome", ""),
-        "dtposicao": header.findtext("dtposicao", ""),
-        "patliq": float(header.findtext("patliq", "0") or 0),
-        "valorcota": float(header.findtext("valorcota", "0") or 0),
-        "quantidade_cotas": float(header.findtext("quantidade", "0") or 0),
-        "posicoes": [],
-    }
-    pl = result["patliq"]
-    if pl <= 0:
-        return result
-
-    # RF
-    rf_valor = 0.0
-    rf_qtd = 0.0
-    for tp in fundo.findall("titpublico"):
-        vf = float(tp.findtext("valorfindisp", "0") or 0)
-        qtd = float(tp.findtext("qtdisponivel", "0") or 0)
-        rf_valor += vf
-        rf_qtd += qtd
-    if rf_valor > 0:
-        rf_pu = rf_valor / rf_qtd if rf_qtd > 0 else 0
-        result["posicoes"].append({"componente": "Renda Fixa (LFT)", "tipo": "RF", "valor": rf_valor,
-                                    "peso_pct": rf_valor / pl * 100, "pu": rf_pu, "qtd": rf_qtd, "vlajuste": 0})
-
-    # Acoes
-    acoes_map = {}
-    for ac in fundo.findall("acoes"):
-        cod = ac.findtext("codativo", "")
-        classe = ac.findtext("classeoperacao", "C")
-        vf_disp = float(ac.findtext("valorfindisp", "0") or 0)
-        qtd_gar = float(ac.findtext("qtgarantia", "0") or 0)
-        pu = float(ac.findtext("puposicao", "0") or 0)
-        qtd_disp = float(ac.findtext("qtdisponivel", "0") or 0)
-        if cod not in acoes_map:
-            acoes_map[cod] = {"valor": 0.0, "qtd": 0.0, "pu": pu}
-        if classe == "C":
-            acoes_map[cod]["valor"] += vf_disp
-            acoes_map[cod]["qtd"] += qtd_disp
-        else:
-            acoes_map[cod]["valor"] += qtd_gar * pu
-            acoes_map[cod]["qtd"] += qtd_gar
-    for cod, info in acoes_map.items():
-        if info["valor"] > 0:
-            result["posicoes"].append({"componente": cod, "tipo": "Acao/ETF", "valor": info["valor"],
-                                        "peso_pct": info["valor"] / pl * 100, "pu": info["pu"], "qtd": info["qtd"], "vlajuste": 0})
-
-    # Futuros
-    for fut in fundo.findall("futuros"):
-        ativo = fut.findtext("ativo", "")
-        serie = fut.findtext("serie", "")
-        vl = float(fut.findtext("vltotalpos", "0") or 0)
-        vlaj = float(fut.findtext("vlajuste", "0") or 0)
-        result["posicoes"].append({"componente": f"FUT {ativo} {serie}", "tipo": "Futuro", "valor": vl,
-                                    "peso_pct": vl / pl * 100, "pu": 0, "qtd": 0, "vlajuste": vlaj})
-
-    # Opcoes
-    for op in fundo.findall("opcoes"):
-        cod = op.findtext("codativo", "")
-        vf = float(op.findtext("valorfinanceiro", "0") or 0)
-        pu = float(op.findtext("puposicao", "0") or 0)
-        qtd = float(op.findtext("qtdisponivel", "0") or 0)
-        if vf != 0:
-            result["posicoes"].append({"componente": f"OPC {cod}", "tipo": "Opcao", "valor": vf,
-                                        "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
-    for od in fundo.findall("opcoesderiv"):
-        serie = od.findtext("serie", "")
-        vf = float(od.findtext("valorfinanceiro", "0") or 0)
-        pu = float(od.findtext("puposicao", "0") or 0)
-        qtd = float(od.findtext("qtd", "0") or 0)
-        if vf != 0:
-            result["posicoes"].append({"componente": f"OPFUT {serie}", "tipo": "Opcao Futuro", "valor": vf,
-                                        "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
-
-    # Caixa
-    for cx in fundo.findall("caixa"):
-        saldo = float(cx.findtext("saldo", "0") or 0)
-        if saldo != 0:
-            result["posicoes"].append({"componente": "Caixa", "tipo": "Caixa", "valor": saldo,
-                                        "peso_pct": saldo / pl * 100, "pu": 0, "qtd": 0, "vlajuste": 0})
-
-    # Cotas de fundos
-    for cota in fundo.findall("cotas"):
-        cnpj_f = cota.findtext("cnpjfundo", "")
-        qtd = float(cota.findtext("qtdisponivel", "0") or 0)
-        pu = float(cota.findtext("puposicao", "0") or 0)
-        valor = qtd * pu
-        nome = SUBFUNDO_NAMES.get(cnpj_f, f"Fundo {cnpj_f}")
-        result["posicoes"].append({"componente": nome, "tipo": "Fundo", "cnpj": cnpj_f, "valor": valor,
-                                    "peso_pct": valor / pl * 100, "qtd_cotas": qtd, "pu": pu, "qtd": qtd, "vlajuste": 0})
-    return result
-
-
-def export_synta_timeseries(since_date=None):
-    """Export all XML data to parquet files per fund."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if path == LEGACY_XML_MANIFEST_PATH:
+        manifest = {fundo_key: {key: e for key, e in ((_xml_manifest_key(p), e) for p, e in entries.items())
+                                if key is not None}
+                    for fundo_key, entries in manifest.items()}
+        save_xml_manifest(manifest)
+        os.remove(LEGACY_XML_MANIFEST_PATH)
+    return manifest
+
+
+def save_xml_manifest(manifest: dict):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = XML_MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, XML_MANIFEST_PATH)
+
+
+def _diff_against_manifest(items, known: dict):
+    """Separa items [(data, caminho)] em alterados (novos ou modificados) e o manifesto atualizado.
+
+    Tamanho e mtime iguais bastam para considerar o arquivo inalterado; se diferirem,
+    o hash do conteudo decide (copias que so mudam o mtime nao sao reprocessadas).
+    O manifesto e indexado pelo caminho relativo a XML_BASE.
+    """
+    changed, entries = [], {}
+    for folder_date, path in items:
+        key = _xml_manifest_key(path) or path
+        st = os.stat(path)
+        entry = {"size": st.st_size, "mtime": st.st_mtime, "data": folder_date.strftime("%Y-%m-%d")}
+        old = known.get(key)
+        if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"] and old["data"] == entry["data"]:
+            entries[key] = old
+            continue
+        entry["hash"] = _file_hash(path)
+        if not (old and old.get("hash") == entry["hash"] and old["data"] == entry["data"]):
+            changed.append((folder_date, path))
+        entries[key] = entry
+    return changed, entries
+
+
+def _fund_timeseries_dir(safe_name: str) -> str:
+    return os.path.join(TIMESERIES_DIR, f"fundo={safe_name}")
+
+
+def read_fund_timeseries(safe_name: str, years=None) -> pd.DataFrame:
+    """Timeseries of one fund (all years or only `years`), sorted by date.
+
+    Falls back to the legacy single file timeseries_<nome>.parquet when the fund
+    has not been written as a partitioned dataset yet.
+    """
+    fund_dir = _fund_timeseries_dir(safe_name)
+    if os.path.isdir(fund_dir):
+        filters = [("ano", "in", list(years))] if years is not None else None
+        df = pd.read_parquet(fund_dir, filters=filters)
+        df = df.drop(columns="ano", errors="ignore")
+        return df.sort_values("data", kind="stable").reset_index(drop=True)
+    legacy_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
+    if os.path.exists(legacy_path):
+        df = pd.read_parquet(legacy_path)
+        if years is not None:
+            df = df[df["data"].dt.year.isin(list(years))]
+        return df
+    return pd.DataFrame()
+
+
+def write_fund_timeseries(safe_name: str, df: pd.DataFrame, years=None):
+    """Write the fund's ano=YYYY partitions (all of them, or only `years`).
+
+    Each partition is sorted by date and written with one row group per month, so
+    row-group statistics let a date-filtered read skip everything else. With
+    years=None the fund directory is rebuilt and the legacy single file removed.
+    """
+    fund_dir = _fund_timeseries_dir(safe_name)
+    if "cnpj" not in df.columns:
+        df = df.assign(cnpj=None)
+    df = df.sort_values("data", kind="stable")
+    if years is None:
+        if os.path.isdir(fund_dir):
+            shutil.rmtree(fund_dir)
+        years = sorted(df["data"].dt.year.unique())
+    year_of = df["data"].dt.year
+    for year in years:
+        part_dir = os.path.join(fund_dir, f"ano={int(year)}")
+        df_year = df[year_of == year]
+        if df_year.empty:
+            shutil.rmtree(part_dir, ignore_errors=True)
+            continue
+        os.makedirs(part_dir, exist_ok=True)
+        table = pa.Table.from_pandas(df_year[TIMESERIES_SCHEMA.names], schema=TIMESERIES_SCHEMA,
+                                     preserve_index=False)
+        months = df_year["data"].dt.month.to_numpy()
+        bounds = np.flatnonzero(np.diff(months)) + 1
+        out_path = os.path.join(part_dir, "part-0.parquet")
+        tmp_path = out_path + ".tmp"
+        with pq.ParquetWriter(tmp_path, TIMESERIES_SCHEMA) as writer:
+            for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(months)]):
+                writer.write_table(table.slice(lo, hi - lo))
+        os.replace(tmp_path, out_path)
+    legacy_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+
+def export_synta_timeseries(since_date=None, max_workers=None, full=False):
+    """Export XML data to the partitioned timeseries dataset, incrementally.
+
+    Only XMLs that are new or modified since the last run (XML_MANIFEST_PATH) are
+    parsed; their days replace the corresponding days of the existing data, days
+    whose XML disappeared are dropped, and only the affected years are rewritten.
+    full=True rebuilds from scratch.
+    """
     os.makedirs(DATA_DIR, exist_ok=True)
+    manifest = {} if full else load_xml_manifest()
+    xml_index = scan_xml_tree(XML_BASE, [cfg["xml_prefix"] for cfg in FUNDOS_CONFIG.values()])
 
     for fundo_key, config in FUNDOS_CONFIG.items():
         prefix = config["xml_prefix"]
         safe_name = fundo_key.lower().replace(" ", "_")
-        out_path = os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet")
+        fund_dir = _fund_timeseries_dir(safe_name)
+        has_dataset = os.path.isdir(fund_dir)
+        has_output = has_dataset or os.path.exists(os.path.join(DATA_DIR, f"timeseries_{safe_name}.parquet"))
 
         print(f"\n=== Exportando {fundo_key} ===")
-        all_rows = []
-        folder_count = 0
-
-        for folder_name in sorted(os.listdir(XML_BASE)):
-            try:
-                folder_date = datetime.strptime(folder_name, "%Y%m%d").date()
-            except ValueError:
-                continue
-
-            if since_date and folder_date < since_date:
-                continue
-
-            folder = os.path.join(XML_BASE, folder_name)
-            files = glob.glob(os.path.join(folder, f"{prefix}_*"))
-            if not files:
-                continue
-
-            parsed = parse_synta_xml(files[0])
-            if not parsed or not parsed.get("posicoes"):
-                continue
+        items = [(d, path) for d, path in xml_index[prefix] if not since_date or d >= since_date]
+
+        known = manifest.get(fundo_key, {}) if has_output else {}
+        changed, entries = _diff_against_manifest(items, known)
+        # XMLs do manifesto (dentro da janela varrida) que sumiram do diretorio
+        since_str = since_date.strftime("%Y-%m-%d") if since_date else ""
+        removed = {e["data"] for key, e in known.items()
+                   if key not in entries and e["data"] >= since_str}
+        # Fora da janela do --since o manifesto anterior continua valendo
+        entries.update({key: e for key, e in known.items() if e["data"] < since_str})
+        print(f"  {len(changed)} XMLs novos/alterados, {len(items) - len(changed)} inalterados"
+              + (f", {len(removed)} removidos" if removed else ""))
+
+        if not changed and not removed and has_dataset:
+            manifest[fundo_key] = entries
+            save_xml_manifest(manifest)
+            continue
 
-            folder_count += 1
-            for pos in parsed["posicoes"]:
-                row = {
-                    "data": pd.Timestamp(folder_date),
-                    "componente": pos["componente"],
-                    "tipo": pos["tipo"],
-                    "valor": pos["valor"],
-                    "peso_pct": pos["peso_pct"],
-                    "patliq": parsed["patliq"],
-                    "valorcota": parsed["valorcota"],
-                    "pu": pos.get("pu", 0),
-                    "vlajuste": pos.get("vlajuste", 0),
-                }
-                if pos.get("cnpj"):
-                    row["cnpj"] = pos["cnpj"]
-                all_rows.append(row)
-
-        if all_rows:
-            df = pd.DataFrame(all_rows)
-            # If we have since_date, merge with existing parquet
-            if since_date and os.path.exists(out_path):
-                df_existing = pd.read_parquet(out_path)
+        df = parse_xml_files(changed, max_workers)
+        folder_count = df["data"].nunique() if not df.empty else 0
+        replaced = removed | {d.strftime("%Y-%m-%d") for d, _ in changed}
+
+        # Substitui, nos dados existentes, os dias reprocessados ou removidos
+        # (sem manifesto, toda a janela varrida e substituida, como no --since antigo)
+        years = None
+        if has_output and not full:
+            if known and has_dataset:
+                years = sorted({int(d[:4]) for d in replaced})
+            df_existing = read_fund_timeseries(safe_name, years)
+            if known:
+                df_existing = df_existing[~df_existing["data"].isin(pd.to_datetime(sorted(replaced)))]
+            elif since_date:
                 df_existing = df_existing[df_existing["data"] < pd.Timestamp(since_date)]
-                df = pd.concat([df_existing, df], ignore_index=True)
-            df.to_parquet(out_path, index=False)
-            date_range = f"{df['data'].min().strftime('%Y-%m-%d')} a {df['data'].max().strftime('%Y-%m-%d')}"
-            print(f"  {folder_count} dias, {len(df)} linhas -> {out_path}")
-            print(f"  Periodo: {date_range}")
-            print(f"  Tamanho: {os.path.getsize(out_path) / 1024:.0f} KB")
+            else:
+                df_existing = df_existing.iloc[0:0]
+            df = pd.concat([df_existing, df], ignore_index=True)
+            df = df.sort_values("data", kind="stable").reset_index(drop=True)
+
+        if not df.empty or years:
+            write_fund_timeseries(safe_name, df, years)
+            size = sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(fund_dir) for f in files)
+            anos = "todos os anos" if years is None else ", ".join(str(y) for y in years)
+            print(f"  {folder_count} dias processados, {len(df)} linhas reescritas ({anos}) -> {fund_dir}")
+            if not df.empty:
+                print(f"  Periodo: {df['data'].min().strftime('%Y-%m-%d')} a {df['data'].max().strftime('%Y-%m-%d')}")
+            print(f"  Tamanho: {size / 1024:.0f} KB")
         else:
             print(f"  Nenhum dado encontrado")
+        manifest[fundo_key] = entries
+        save_xml_manifest(manifest)
+
+
+def benchmark_xml_backends(days=365):
+    """Time the etree and lxml parsers on the last `days` of XMLs of every fund.
+
+    Both backends parse the same files; the outputs are compared position by
+    position before the timings are reported.
+    """
+    if LET is None:
+        print("lxml nao instalado; apenas o backend etree esta disponivel")
+        return
+    xml_index = scan_xml_tree(XML_BASE, [cfg["xml_prefix"] for cfg in FUNDOS_CONFIG.values()])
+    cutoff = datetime.now().date() - timedelta(days=days)
+    files = [path for entries in xml_index.values() for d, path in entries if d >= cutoff]
+    print(f"\n=== Benchmark parser XML: {len(files)} arquivos ({days} dias) ===")
+    timings, outputs = {}, {}
+    for backend in ("etree", "lxml"):
+        t0 = time.perf_counter()
+        outputs[backend] = [parse_synta_xml(path, SUBFUNDO_NAMES, backend) for path in files]
+        timings[backend] = time.perf_counter() - t0
+        print(f"  {backend:6s} {timings[backend]:8.2f} s")
+    iguais = outputs["etree"] == outputs["lxml"]
+    print(f"  Saidas identicas: {'sim' if iguais else 'NAO'}")
+    if timings["lxml"] > 0:
+        print(f"  Speedup lxml: {timings['etree'] / timings['lxml']:.2f}x")
 
 
 def copy_subfund_positions():
@@ -251,23 +463,79 @@ def copy_subfund_positions():
             print(f"\n  {fname} nao encontrado em {CARTEIRA_RV_DATA}")
 
 
-def supplement_blc4_positions():
-    """Extract BLC4 positions for master CNPJs missing from posicoes_cvm.
+def export_master_holdings():
+    """Build MASTER_HOLDINGS_PATH: stock holdings of every tracked master, all BLC4 months.
 
-    Some funds (e.g. Organon, Absolute Pace) are only available in CVM BLC4
-    cache files, not in posicoes_cvm.parquet. This function extracts their
-    stock positions from the BLC4 cache and appends to the deployed posicoes_cvm.
+    Each monthly cvm_blc4_*.parquet is read projected to the used columns and
+    filtered to the master CNPJs in the reader; PL comes from cvm_pl_<mes>.parquet
+    (joined by CNPJ) or, when missing, is estimated from the positions (+5%).
+    The result is sorted by (cnpj_fundo, data), one row group per master, so the
+    app and supplement_blc4_positions query it instead of walking the raw files.
     """
     cache_dir = CARTEIRA_RV_CACHE
     if not os.path.isdir(cache_dir):
         print(f"\n  BLC4 cache nao encontrado: {cache_dir}")
         return
 
+    masters = sorted({m for m in MASTER_CNPJ_MAP.values() if m})
+    master_formatted = {format_cnpj(m): m for m in masters}
+    blc4_files = sorted(glob.glob(os.path.join(cache_dir, "cvm_blc4_*.parquet")))
+    print(f"\n=== Carteiras dos masters (BLC4): {len(masters)} masters, {len(blc4_files)} meses ===")
+
+    frames = []
+    for blc4_file in blc4_files:
+        try:
+            df_month = read_blc4_month(blc4_file, master_formatted)
+        except Exception:
+            continue
+        if df_month is not None and not df_month.empty:
+            frames.append(df_month)
+
+    if not frames:
+        print("  Nenhum dado BLC4 encontrado para os masters")
+        return
+
+    df = pd.concat(frames, ignore_index=True)
+    df["fonte"] = "CVM_BLC4"
+    df = df.sort_values(["cnpj_fundo", "data"], kind="stable").reset_index(drop=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    codes = df["cnpj_fundo"].to_numpy()
+    bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    tmp_path = MASTER_HOLDINGS_PATH + ".tmp"
+    with pq.ParquetWriter(tmp_path, table.schema) as writer:
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+            writer.write_table(table.slice(lo, hi - lo))
+    os.replace(tmp_path, MASTER_HOLDINGS_PATH)
+
+    n_masters = df["cnpj_fundo"].nunique()
+    size = os.path.getsize(MASTER_HOLDINGS_PATH) / 1024
+    print(f"  {len(df)} posicoes de {n_masters} masters, {df['data'].nunique()} meses -> {MASTER_HOLDINGS_PATH}")
+    print(f"  Tamanho: {size:.0f} KB")
+
+
+def load_latest_master_holdings(masters) -> pd.DataFrame:
+    """Latest month of holdings of each given master, from MASTER_HOLDINGS_PATH."""
+    if not os.path.exists(MASTER_HOLDINGS_PATH) or not masters:
+        return pd.DataFrame(columns=["cnpj_fundo", "data", "ativo", "valor", "pl", "pct_pl", "fonte"])
+    df = pd.read_parquet(MASTER_HOLDINGS_PATH, filters=[("cnpj_fundo", "in", sorted(masters))])
+    latest = df.groupby("cnpj_fundo")["data"].transform("max")
+    return df[df["data"] == latest].reset_index(drop=True)
+
+
+def supplement_blc4_positions():
+    """Extract BLC4 positions for master CNPJs missing from posicoes_cvm.
+
+    Some funds (e.g. Organon, Absolute Pace) are only available in CVM BLC4
+    cache files, not in posicoes_cvm.parquet. This function takes their latest
+    stock positions from the master-holdings dataset (export_master_holdings)
+    and appends them to the deployed posicoes_cvm.
+    """
     # Load existing cvm data to find which masters are already covered
     cvm_path = os.path.join(DATA_DIR, "posicoes_cvm.parquet")
     existing_masters = set()
     if os.path.exists(cvm_path):
-        df_cvm = pd.read_parquet(cvm_path)
+        df_cvm = pd.read_parquet(cvm_path, columns=["cnpj_fundo"])
         existing_masters = set(df_cvm["cnpj_fundo"].unique())
 
     # Find master CNPJs that are missing
@@ -289,103 +557,19 @@ def supplement_blc4_positions():
         feeder_names = [SUBFUNDO_NAMES.get(f, f) for f in feeders]
         print(f"  {m} -> {', '.join(feeder_names)}")
 
-    # Format master CNPJs for matching
-    def _fmt(c):
-        c = c.zfill(14)
-        return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:14]}"
-
-    master_formatted = {_fmt(m): m for m in needed.keys()}
-
-    blc4_files = sorted(glob.glob(os.path.join(cache_dir, "cvm_blc4_*.parquet")), reverse=True)
-    if not blc4_files:
-        print("  Nenhum arquivo BLC4 encontrado")
+    if not os.path.exists(MASTER_HOLDINGS_PATH):
+        print(f"  {MASTER_HOLDINGS_PATH} nao encontrado (rode export_master_holdings)")
         return
 
-    # Also load PL data
-    pl_data = {}
-    rows = []
-    found_masters = set()
-
-    for blc4_file in blc4_files:
-        if len(found_masters) == len(needed):
-            break
-
-        try:
-            df_blc = pd.read_parquet(blc4_file)
-        except Exception:
-            continue
-
-        cnpj_col = "CNPJ_FUNDO_CLASSE" if "CNPJ_FUNDO_CLASSE" in df_blc.columns else "CNPJ_FUNDO"
-        if "TP_APLIC" not in df_blc.columns or "CD_ATIVO" not in df_blc.columns:
-            continue
-
-        mask_stocks = df_blc["TP_APLIC"].str.contains(
-            r"(?:A.{1,3}es|Brazilian Depository)", case=False, na=False
-        )
-        mask_value = df_blc["VL_MERC_POS_FINAL"].fillna(0) > 0
-        df_stocks = df_blc[mask_stocks & mask_value].copy()
-        if df_stocks.empty:
-            continue
-
-        fname = os.path.basename(blc4_file)
-        month_str = fname.replace("cvm_blc4_", "").replace(".parquet", "")
-        try:
-            ref_date = pd.Timestamp(f"{month_str[:4]}-{month_str[4:6]}-28")
-        except Exception:
-            continue
-
-        # Load PL
-        pl_file = os.path.join(cache_dir, f"cvm_pl_{month_str}.parquet")
-        if os.path.exists(pl_file) and month_str not in pl_data:
-            try:
-                df_pl = pd.read_parquet(pl_file)
-                pl_cnpj_col = "CNPJ_FUNDO_CLASSE" if "CNPJ_FUNDO_CLASSE" in df_pl.columns else "CNPJ_FUNDO"
-                for _, row in df_pl.iterrows():
-                    cnpj_val = str(row.get(pl_cnpj_col, ""))
-                    vl_pl = row.get("VL_PATRIM_LIQ", 0)
-                    if cnpj_val and vl_pl and vl_pl > 0:
-                        pl_data[(cnpj_val, month_str)] = vl_pl
-            except Exception:
-                pass
-
-        for fmt_cnpj, raw_master in master_formatted.items():
-            if raw_master in found_masters:
-                continue
-
-            df_fund = df_stocks[df_stocks[cnpj_col] == fmt_cnpj]
-            if df_fund.empty:
-                continue
-
-            found_masters.add(raw_master)
-            fund_pl = pl_data.get((fmt_cnpj, month_str), 0)
-            if fund_pl <= 0:
-                fund_pl = df_fund["VL_MERC_POS_FINAL"].sum() * 1.05
-
-            for _, row in df_fund.iterrows():
-                ticker = str(row.get("CD_ATIVO", "")).strip()
-                valor = float(row.get("VL_MERC_POS_FINAL", 0))
-                if not ticker or valor <= 0:
-                    continue
-                pct = (valor / fund_pl * 100) if fund_pl > 0 else 0
-                rows.append({
-                    "cnpj_fundo": raw_master,
-                    "data": ref_date,
-                    "ativo": ticker,
-                    "valor": valor,
-                    "pl": fund_pl,
-                    "pct_pl": pct,
-                    "setor": "",
-                    "fonte": "CVM_BLC4",
-                })
-
-    if not rows:
+    df_supplement = load_latest_master_holdings(needed)
+    if df_supplement.empty:
         print("  Nenhum dado BLC4 encontrado para masters faltantes")
         return
 
-    df_supplement = pd.DataFrame(rows)
+    df_supplement = df_supplement.assign(setor="")[
+        ["cnpj_fundo", "data", "ativo", "valor", "pl", "pct_pl", "setor", "fonte"]]
     print(f"  Extraidos {len(df_supplement)} registros de BLC4")
-    for m in found_masters:
-        n = len(df_supplement[df_supplement["cnpj_fundo"] == m])
+    for m, n in df_supplement["cnpj_fundo"].value_counts(sort=False).items():
         print(f"    {m}: {n} holdings")
 
     # Append to posicoes_cvm.parquet
@@ -404,8 +588,40 @@ def supplement_blc4_positions():
 ALL_SUBFUND_CNPJS = list(SUBFUNDO_NAMES.keys())
 
 
-def export_fund_quotas():
-    """Export daily quotas for all sub-funds from CVM inf_diario cache into a single parquet."""
+def load_quotas_manifest() -> dict:
+    """{arquivo inf_diario: {"size", "mtime", "cnpjs"}} ja exportados para FUND_QUOTAS_PATH."""
+    if not os.path.exists(QUOTAS_MANIFEST_PATH) or not os.path.exists(FUND_QUOTAS_PATH):
+        return {}
+    try:
+        with open(QUOTAS_MANIFEST_PATH, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Formato antigo (por CNPJ) ou corrompido: reconstroi do zero
+    if not all(isinstance(e, dict) and "cnpjs" in e for e in manifest.values()):
+        return {}
+    return manifest
+
+
+def save_quotas_manifest(manifest: dict):
+    tmp_path = QUOTAS_MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, QUOTAS_MANIFEST_PATH)
+
+
+def export_fund_quotas(full=False):
+    """Export daily quotas for all sub-funds from CVM inf_diario cache into a single parquet.
+
+    Incremental: QUOTAS_MANIFEST_PATH keeps, per monthly file, its size/mtime and the
+    CNPJs already exported from it. Unchanged files are only read for CNPJs new in
+    SUBFUNDO_NAMES (backfill); new or rewritten files (current month, CVM
+    corrections) are read for every CNPJ and replace that month's rows. A file that
+    fails to read keeps its previous manifest entry, so it is retried on the next run
+    and its month is still replaced then; the manifest is only saved after the parquet. The rows
+    read are merged into the existing parquet, newer rows winning. full=True
+    rebuilds from scratch.
+    """
     cache_dir = CARTEIRA_RV_CACHE
     if not os.path.isdir(cache_dir):
         print(f"\n! Cache CVM nao encontrado: {cache_dir}")
@@ -417,72 +633,132 @@ def export_fund_quotas():
         return
 
     cnpj_set = set(ALL_SUBFUND_CNPJS)
+    manifest = {} if full else load_quotas_manifest()
 
-    # Format CNPJs as xx.xxx.xxx/xxxx-xx for matching CVM format
-    def _fmt(c):
-        c = c.zfill(14)
-        return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:14]}"
+    print(f"\n=== Exportando cotas dos sub-fundos ===")
+    if manifest:
+        print(f"  Incremental: {len(manifest)} arquivos no manifesto")
 
-    fmt_to_raw = {_fmt(c): c for c in cnpj_set}
     frames = []
-
+    replaced = []  # (mes, cnpjs) cujas linhas antigas saem: arquivo reescrito
+    new_manifest = {}
+    n_read = n_failed = 0
     for fpath in inf_files:
+        name = os.path.basename(fpath)
         try:
-            df = pd.read_parquet(fpath)
-        except Exception:
+            st = os.stat(fpath)
+        except OSError:
+            n_failed += 1
             continue
-
-        # Determine CNPJ column
-        cnpj_col = None
-        for c in ["cnpj_norm", "CNPJ_FUNDO_CLASSE", "CNPJ_FUNDO"]:
-            if c in df.columns:
-                cnpj_col = c
-                break
-        dt_col = "DT_COMPTC"
-        vl_col = "VL_QUOTA"
-        if cnpj_col is None or dt_col not in df.columns or vl_col not in df.columns:
-            continue
-
-        # Filter for our CNPJs
-        if cnpj_col == "cnpj_norm":
-            mask = df[cnpj_col].isin(cnpj_set)
-        else:
-            mask = df[cnpj_col].isin(fmt_to_raw.keys())
-
-        df_f = df[mask].copy()
-        if df_f.empty:
-            continue
-
-        df_f["data"] = pd.to_datetime(df_f[dt_col])
-        if cnpj_col == "cnpj_norm":
-            df_f["cnpj_raw"] = df_f[cnpj_col]
-        else:
-            df_f["cnpj_raw"] = df_f[cnpj_col].map(fmt_to_raw)
-        df_f["nome"] = df_f["cnpj_raw"].map(SUBFUNDO_NAMES)
-        df_f["quota"] = pd.to_numeric(df_f[vl_col], errors="coerce")
-        frames.append(df_f[["data", "cnpj_raw", "nome", "quota"]].dropna())
-
-    if not frames:
+        entry = manifest.get(name)
+        unchanged = entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+        done = set(entry["cnpjs"]) & cnpj_set if unchanged else set()
+        wanted = cnpj_set - done
+        if wanted:
+            try:
+                df_f = read_inf_diario(fpath, wanted, SUBFUNDO_NAMES)
+            except Exception:
+                # Mantem a entrada anterior (assinatura e CNPJs antigos): na proxima execucao
+                # o arquivo e relido e, se mudou, ainda substitui as linhas do mes
+                n_failed += 1
+                if entry is not None:
+                    new_manifest[name] = dict(entry, cnpjs=sorted(set(entry["cnpjs"]) & cnpj_set))
+                continue
+            n_read += 1
+            if not df_f.empty:
+                frames.append(df_f)
+            if not unchanged:
+                replaced.append((inf_diario_month(fpath), wanted))
+        new_manifest[name] = {"size": st.st_size, "mtime": st.st_mtime, "cnpjs": sorted(done | wanted)}
+
+    existing = None
+    if manifest:
+        existing = pd.read_parquet(FUND_QUOTAS_PATH)
+        keep = existing["cnpj_raw"].isin(cnpj_set)
+        mes = existing["data"].dt.strftime("%Y%m")
+        for month, cnpjs in replaced:
+            if month:
+                keep &= ~((mes == month) & existing["cnpj_raw"].isin(cnpjs))
+        existing = existing[keep]
+    parts = ([existing] if existing is not None else []) + frames
+    if not parts or all(p.empty for p in parts):
         print("\n! Nenhuma cota encontrada para os sub-fundos")
         return
 
-    result = pd.concat(frames, ignore_index=True)
-    result = result.sort_values("data").drop_duplicates(subset=["data", "cnpj_raw"], keep="last")
+    result = pd.concat(parts, ignore_index=True)
+    result = result.sort_values("data", kind="stable").drop_duplicates(subset=["data", "cnpj_raw"], keep="last")
+    result = result.reset_index(drop=True)
+
+    out_path = FUND_QUOTAS_PATH
+    tmp_path = out_path + ".tmp"
+    result.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, out_path)
+    save_quotas_manifest(new_manifest)
 
-    out_path = os.path.join(DATA_DIR, "fund_quotas.parquet")
-    result.to_parquet(out_path, index=False)
+    n_new = sum(len(f) for f in frames)
     n_funds = result["cnpj_raw"].nunique()
     n_days = result["data"].nunique()
     size = os.path.getsize(out_path) / 1024
-    print(f"\n=== Exportando cotas dos sub-fundos ===")
+    print(f"  {n_read} arquivos lidos, {n_new} linhas lidas"
+          + (f", {n_failed} arquivos com erro (relidos na proxima execucao)" if n_failed else ""))
     print(f"  {n_funds} fundos, {n_days} dias, {len(result)} linhas -> {out_path}")
     print(f"  Periodo: {result['data'].min().date()} a {result['data'].max().date()}")
     print(f"  Tamanho: {size:.0f} KB")
 
 
+def export_ibov_series(full=False):
+    """Export ^BVSP daily closes from Yahoo Finance to IBOV_PATH, incrementally.
+
+    Only the days after the last exported one (plus IBOV_OVERLAP_DAYS) are
+    downloaded and merged, newer rows winning. full=True downloads from IBOV_START.
+    """
+    print(f"\n=== Exportando IBOV (^BVSP) ===")
+    try:
+        import yfinance as yf
+    except ImportError:
+        print("  ! yfinance nao instalado, IBOV nao exportado")
+        return
+
+    existing = None
+    start = IBOV_START
+    if not full and os.path.exists(IBOV_PATH):
+        existing = pd.read_parquet(IBOV_PATH)
+        if not existing.empty:
+            start = (existing["data"].max() - pd.Timedelta(days=IBOV_OVERLAP_DAYS)).strftime("%Y-%m-%d")
+    try:
+        df = yf.download("^BVSP", start=start, auto_adjust=True, progress=False)
+    except Exception as exc:
+        print(f"  ! Falha ao baixar ^BVSP: {exc}")
+        return
+    if df.empty:
+        print("  ! Nenhum fechamento retornado para ^BVSP")
+        return
+    close = df["Close"]
+    if isinstance(close, pd.DataFrame):
+        close = close.iloc[:, 0]
+    close = close.dropna()
+    df_new = pd.DataFrame({"ticker": "^BVSP", "data": pd.to_datetime(close.index).tz_localize(None),
+                           "close": close.to_numpy(dtype=float)})
+
+    result = pd.concat([existing, df_new], ignore_index=True) if existing is not None else df_new
+    result = (result.drop_duplicates(subset=["data"], keep="last")
+              .sort_values("data").reset_index(drop=True))
+    tmp_path = IBOV_PATH + ".tmp"
+    result.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, IBOV_PATH)
+    print(f"  {len(df_new)} dias baixados, {len(result)} dias -> {IBOV_PATH}")
+    print(f"  Periodo: {result['data'].min().date()} a {result['data'].max().date()}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Exportar dados XMLs para parquets")
     parser.add_argument("--since", type=str, help="Data inicio (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"Processos para parsear os XMLs (default {XML_WORKERS})")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignora os manifestos e reprocessa todos os XMLs e cotas")
+    parser.add_argument("--bench-xml", action="store_true",
+                        help="Compara os parsers etree x lxml no ultimo ano de XMLs e sai")
     args = parser.parse_args()
 
     since_date = None
@@ -493,15 +769,21 @@ def main():
         print(f"ERRO: Diretorio XML nao encontrado: {XML_BASE}")
         sys.exit(1)
 
+    if args.bench_xml:
+        benchmark_xml_backends()
+        return
+
     print(f"Diretorio XML: {XML_BASE}")
     print(f"Diretorio output: {DATA_DIR}")
     if since_date:
         print(f"Exportando desde: {since_date}")
 
-    export_synta_timeseries(since_date)
+    export_synta_timeseries(since_date, args.workers, args.full)
     copy_subfund_positions()
+    export_master_holdings()
     supplement_blc4_positions()
-    export_fund_quotas()
+    export_fund_quotas(args.full)
+    export_ibov_series(args.full)
 
     print("\nExportacao concluida!")
     print(f"Arquivos em {DATA_DIR}:")
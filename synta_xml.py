@@ -0,0 +1,256 @@
+"""
+Parser dos XMLs de carteira Synta (Mellon), compartilhado por app.py e export_data.py.
+
+Um unico passe em streaming por arquivo: cada bloco filho do primeiro <fundo> e
+despachado pela tag e descartado em seguida. Usa lxml quando instalado (iterparse
+filtrado pelas tags dos blocos), senao ElementTree; as saidas sao identicas.
+"""
+import xml.etree.ElementTree as ET
+from array import array
+try:
+    from lxml import etree as LET
+except ImportError:
+    LET = None
+
+XML_BACKEND = "lxml" if LET is not None else "etree"
+SYNTA_BLOCK_TAGS = ("header", "titpublico", "acoes", "futuros", "opcoes", "opcoesderiv", "caixa", "cotas")
+
+
+def _iter_synta_blocks_etree(filepath: str):
+    """(tag, findtext) for each direct child of the first <fundo>, via ElementTree.iterparse."""
+    depth = 0
+    in_fundo = False
+    for event, elem in ET.iterparse(filepath, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and elem.tag == "fundo":
+                in_fundo = True
+            continue
+        depth -= 1
+        if not in_fundo:
+            continue
+        if depth == 1:  # fim do primeiro <fundo>; o resto do arquivo nao e usado
+            break
+        if depth != 2:
+            continue
+        yield elem.tag, elem.findtext
+        elem.clear()
+
+
+def _iter_synta_blocks_lxml(filepath: str):
+    """Same as _iter_synta_blocks_etree, via lxml.
+
+    iterparse is filtered on the block tags, so the leaf fields never reach Python
+    as events; each block's children are read once into {tag: text or ""} (first
+    occurrence wins), whose .get(name, default) answers exactly like findtext.
+    """
+    fundo = None
+    for _, elem in LET.iterparse(filepath, events=("end",), tag=SYNTA_BLOCK_TAGS + ("fundo",)):
+        parent = elem.getparent()
+        if parent is None:
+            continue
+        if elem.tag == "fundo":
+            if parent.getparent() is None:  # fim do primeiro <fundo>; o resto do arquivo nao e usado
+                break
+            continue
+        if parent is not fundo:
+            if parent.tag != "fundo" or parent.getparent() is None or parent.getparent().getparent() is not None:
+                continue
+            fundo = parent
+        yield elem.tag, {child.tag: child.text or "" for child in reversed(elem)}.get
+        elem.clear()
+        while elem.getprevious() is not None:
+            del fundo[0]
+
+
+def iter_synta_blocks(filepath: str, backend: str = None):
+    """(tag, findtext) for each block of the first <fundo>.
+
+    backend: "lxml" or "etree" (default XML_BACKEND, lxml when installed).
+    """
+    if (backend or XML_BACKEND) == "lxml":
+        return _iter_synta_blocks_lxml(filepath)
+    return _iter_synta_blocks_etree(filepath)
+
+
+def _scan_synta_xml(filepath: str, backend: str = None):
+    """Single streaming pass over a Synta XML; raw values per block, or None.
+
+    Each direct child of <fundo> is dispatched on its tag and cleared right after,
+    so memory stays flat. parse_synta_xml / parse_synta_xml_columns turn the result
+    into positions (RF, acoes, futuros, opcoes, opcoes de futuro, caixa, cotas).
+    backend: "lxml" or "etree" (default XML_BACKEND, lxml when installed).
+    """
+    header = None
+    rf_valor = 0.0
+    rf_qtd = 0.0
+    acoes_map = {}
+    futuros, opcoes, opcoesderiv, caixas, cotas = [], [], [], [], []
+    for tag, findtext in iter_synta_blocks(filepath, backend):
+        if tag == "header":
+            header = {
+                "cnpj": findtext("cnpj", ""),
+                "nome": findtext("nome", ""),
+                "dtposicao": findtext("dtposicao", ""),
+                "patliq": float(findtext("patliq", "0") or 0),
+                "valorcota": float(findtext("valorcota", "0") or 0),
+                "quantidade_cotas": float(findtext("quantidade", "0") or 0),
+            }
+        # RF — agrupar todos titulos publicos; calcular PU medio ponderado para retorno
+        elif tag == "titpublico":
+            rf_valor += float(findtext("valorfindisp", "0") or 0)
+            rf_qtd += float(findtext("qtdisponivel", "0") or 0)
+        # Acoes — agregar por codigo, guardar PU e QTD total
+        elif tag == "acoes":
+            cod = findtext("codativo", "")
+            classe = findtext("classeoperacao", "C")
+            pu = float(findtext("puposicao", "0") or 0)
+            if cod not in acoes_map:
+                acoes_map[cod] = {"valor": 0.0, "qtd": 0.0, "pu": pu}
+            if classe == "C":
+                acoes_map[cod]["valor"] += float(findtext("valorfindisp", "0") or 0)
+                acoes_map[cod]["qtd"] += float(findtext("qtdisponivel", "0") or 0)
+            else:
+                qtd_gar = float(findtext("qtgarantia", "0") or 0)
+                acoes_map[cod]["valor"] += qtd_gar * pu
+                acoes_map[cod]["qtd"] += qtd_gar
+        # Futuros — usar vlajuste (ajuste diario = P&L real), nao vltotalpos
+        elif tag == "futuros":
+            futuros.append((findtext("ativo", ""), findtext("serie", ""),
+                            float(findtext("vltotalpos", "0") or 0),
+                            float(findtext("vlajuste", "0") or 0)))
+        elif tag == "opcoes":
+            opcoes.append((findtext("codativo", ""),
+                           float(findtext("valorfinanceiro", "0") or 0),
+                           float(findtext("puposicao", "0") or 0),
+                           float(findtext("qtdisponivel", "0") or 0)))
+        elif tag == "opcoesderiv":
+            opcoesderiv.append((findtext("serie", ""),
+                                float(findtext("valorfinanceiro", "0") or 0),
+                                float(findtext("puposicao", "0") or 0),
+                                float(findtext("qtd", "0") or 0)))
+        elif tag == "caixa":
+            caixas.append(float(findtext("saldo", "0") or 0))
+        elif tag == "cotas":
+            cotas.append((findtext("cnpjfundo", ""),
+                          float(findtext("qtdisponivel", "0") or 0),
+                          float(findtext("puposicao", "0") or 0)))
+
+    if header is None:
+        return None
+    return {"header": header, "rf_valor": rf_valor, "rf_qtd": rf_qtd, "acoes": acoes_map,
+            "futuros": futuros, "opcoes": opcoes, "opcoesderiv": opcoesderiv,
+            "caixas": caixas, "cotas": cotas}
+
+
+def parse_synta_xml(filepath: str, nomes: dict, backend: str = None) -> dict:
+    """Parse a Synta XML file into header fields plus a list of position dicts.
+
+    nomes: {cnpj: nome} for the fund quotas (cotas); unknown CNPJs -> "Fundo <cnpj>".
+    """
+    raw = _scan_synta_xml(filepath, backend)
+    if raw is None:
+        return {}
+    header = raw["header"]
+    rf_valor, rf_qtd, acoes_map = raw["rf_valor"], raw["rf_qtd"], raw["acoes"]
+    futuros, opcoes, opcoesderiv = raw["futuros"], raw["opcoes"], raw["opcoesderiv"]
+    caixas, cotas = raw["caixas"], raw["cotas"]
+    result = dict(header, posicoes=[])
+    pl = result["patliq"]
+    if pl <= 0:
+        return result
+    posicoes = result["posicoes"]
+    if rf_valor > 0:
+        rf_pu = rf_valor / rf_qtd if rf_qtd > 0 else 0
+        posicoes.append({"componente": "Renda Fixa (LFT)", "tipo": "RF", "valor": rf_valor,
+                         "peso_pct": rf_valor / pl * 100, "pu": rf_pu, "qtd": rf_qtd, "vlajuste": 0})
+    for cod, info in acoes_map.items():
+        if info["valor"] > 0:
+            posicoes.append({"componente": cod, "tipo": "Acao/ETF", "valor": info["valor"],
+                             "peso_pct": info["valor"] / pl * 100, "pu": info["pu"], "qtd": info["qtd"], "vlajuste": 0})
+    for ativo, serie, vl, vlaj in futuros:
+        posicoes.append({"componente": f"FUT {ativo} {serie}", "tipo": "Futuro", "valor": vl,
+                         "peso_pct": vl / pl * 100, "pu": 0, "qtd": 0, "vlajuste": vlaj})
+    for cod, vf, pu, qtd in opcoes:
+        if vf != 0:
+            posicoes.append({"componente": f"OPC {cod}", "tipo": "Opcao", "valor": vf,
+                             "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
+    for serie, vf, pu, qtd in opcoesderiv:
+        if vf != 0:
+            posicoes.append({"componente": f"OPFUT {serie}", "tipo": "Opcao Futuro", "valor": vf,
+                             "peso_pct": vf / pl * 100, "pu": pu, "qtd": qtd, "vlajuste": 0})
+    for saldo in caixas:
+        if saldo != 0:
+            posicoes.append({"componente": "Caixa", "tipo": "Caixa", "valor": saldo,
+                             "peso_pct": saldo / pl * 100, "pu": 0, "qtd": 0, "vlajuste": 0})
+    # Cotas de fundos
+    for cnpj_f, qtd, pu in cotas:
+        valor = qtd * pu
+        nome = nomes.get(cnpj_f, f"Fundo {cnpj_f}")
+        posicoes.append({"componente": nome, "tipo": "Fundo", "cnpj": cnpj_f, "valor": valor,
+                         "peso_pct": valor / pl * 100, "qtd_cotas": qtd, "pu": pu, "qtd": qtd, "vlajuste": 0})
+    return result
+
+
+TIPOS = ("RF", "Acao/ETF", "Futuro", "Opcao", "Opcao Futuro", "Caixa", "Fundo")
+_TIPO_CODE = {t: i for i, t in enumerate(TIPOS)}
+
+
+def parse_synta_xml_columns(filepath: str, nomes: dict):
+    """Columnar (struct-of-arrays) variant of parse_synta_xml, without per-position dicts.
+
+    Returns {"patliq", "valorcota", "componentes", "componente", "tipo", "valor",
+    "peso_pct", "pu", "vlajuste", "cnpjs", "cnpj"} or None when there are no positions.
+    valor/peso_pct/pu/vlajuste are array("d"); componente and cnpj are array("i") codes
+    into the file's componentes / cnpjs lists (cnpj -1 = none); tipo is array("b")
+    codes into TIPOS. Same positions, in the same order, as parse_synta_xml.
+    """
+    raw = _scan_synta_xml(filepath)
+    if raw is None or raw["header"]["patliq"] <= 0:
+        return None
+    header = raw["header"]
+    pl = header["patliq"]
+    cols = {"patliq": pl, "valorcota": header["valorcota"], "componentes": [], "cnpjs": [],
+            "componente": array("i"), "tipo": array("b"), "cnpj": array("i"),
+            "valor": array("d"), "peso_pct": array("d"), "pu": array("d"), "vlajuste": array("d")}
+    comp_codes, cnpj_codes = {}, {}
+
+    def add(componente, tipo, valor, pu, vlajuste=0.0, cnpj=None):
+        code = comp_codes.get(componente)
+        if code is None:
+            code = comp_codes[componente] = len(cols["componentes"])
+            cols["componentes"].append(componente)
+        cols["componente"].append(code)
+        cols["tipo"].append(_TIPO_CODE[tipo])
+        if cnpj:
+            if cnpj not in cnpj_codes:
+                cnpj_codes[cnpj] = len(cols["cnpjs"])
+                cols["cnpjs"].append(cnpj)
+            cols["cnpj"].append(cnpj_codes[cnpj])
+        else:
+            cols["cnpj"].append(-1)
+        cols["valor"].append(valor)
+        cols["peso_pct"].append(valor / pl * 100)
+        cols["pu"].append(pu)
+        cols["vlajuste"].append(vlajuste)
+
+    rf_valor, rf_qtd = raw["rf_valor"], raw["rf_qtd"]
+    if rf_valor > 0:
+        add("Renda Fixa (LFT)", "RF", rf_valor, rf_valor / rf_qtd if rf_qtd > 0 else 0)
+    for cod, info in raw["acoes"].items():
+        if info["valor"] > 0:
+            add(cod, "Acao/ETF", info["valor"], info["pu"])
+    for ativo, serie, vl, vlaj in raw["futuros"]:
+        add(f"FUT {ativo} {serie}", "Futuro", vl, 0, vlaj)
+    for cod, vf, pu, _ in raw["opcoes"]:
+        if vf != 0:
+            add(f"OPC {cod}", "Opcao", vf, pu)
+    for serie, vf, pu, _ in raw["opcoesderiv"]:
+        if vf != 0:
+            add(f"OPFUT {serie}", "Opcao Futuro", vf, pu)
+    for saldo in raw["caixas"]:
+        if saldo != 0:
+            add("Caixa", "Caixa", saldo, 0)
+    for cnpj_f, qtd, pu in raw["cotas"]:
+        add(nomes.get(cnpj_f, f"Fundo {cnpj_f}"), "Fundo", qtd * pu, pu, cnpj=cnpj_f)
+    return cols if len(cols["valor"]) else None
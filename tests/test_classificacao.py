@@ -0,0 +1,29 @@
+import pandas as pd
+
+from classificacao import (
+    TICKER_ACAO_BR, TICKER_ACAO_US, TICKER_FUNDO, TICKER_OPCAO, TICKER_OUTRO,
+    classificar_tickers, ticker_tipo,
+)
+
+
+def test_ticker_br_com_digito_na_raiz():
+    # B3SA3 nao casa com 4 letras + digitos, mas e acao BR (setor do SETOR_MAP)
+    assert ticker_tipo("B3SA3") == TICKER_ACAO_BR
+
+
+def test_ticker_us():
+    assert ticker_tipo("AMZN") == TICKER_ACAO_US
+    assert ticker_tipo("MSFT US") == TICKER_ACAO_US
+
+
+def test_ticker_outros_tipos():
+    assert ticker_tipo("PETR4") == TICKER_ACAO_BR
+    assert ticker_tipo("PETRM25") == TICKER_OPCAO
+    assert ticker_tipo("XYZ FIA") == TICKER_FUNDO
+    assert ticker_tipo("Atmos Institucional", frozenset({"Atmos Institucional"})) == TICKER_FUNDO
+    assert ticker_tipo("DI1F25") == TICKER_OUTRO
+
+
+def test_classificar_tickers_coluna():
+    tipos = classificar_tickers(pd.Series(["B3SA3", "AMZN", None, "B3SA3"]))
+    assert list(tipos) == [TICKER_ACAO_BR, TICKER_ACAO_US, TICKER_OUTRO, TICKER_ACAO_BR]